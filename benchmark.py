@@ -0,0 +1,206 @@
+from argparse import ArgumentParser
+from hashlib import md5
+from json import dumps, loads
+from os import chdir
+from os.path import abspath, dirname, exists, join
+from platform import node
+from shutil import rmtree
+from sys import argv, exit
+from tempfile import mkdtemp
+from time import time
+
+from synthrom import make_fixture
+from profiler import PROFILER, get_peak_rss
+
+
+# Times the randomizer against the synthetic rom from synthrom.py and
+# compares the numbers to a stored baseline. Timings are only compared on
+# the machine that saved the baseline. Anywhere else only the output is,
+# which is the same on every machine.
+
+BASELINE = join(dirname(abspath(__file__)), "benchmark_baseline.json")
+SEEDS = "1-10"
+TOLERANCE = 0.25
+MIN_DIFFERENCE = 0.001
+RANK_REPEATS = 5
+
+
+def get_rank_times(randomizer):
+    # Cold is the first pass after a fresh snapshot restore, warm is every
+    # pass after that, when the ranks are cached.
+    classes = [randomizer.MonsterObject, randomizer.FormationObject,
+               randomizer.BattleFormationObject]
+    randomizer.restore_objects(randomizer.LOADED_ROM["snapshot"])
+    times = {}
+    for c in classes:
+        start = time()
+        c.ranked
+        [o.rank for o in c.every]
+        times[c.__name__] = {"cold": time() - start}
+    for c in classes:
+        start = time()
+        for _ in xrange(RANK_REPEATS):
+            c.ranked
+            [o.rank for o in c.every]
+        times[c.__name__]["warm"] = (time() - start) / RANK_REPEATS
+    return times
+
+
+def get_world_results(randomizer, romfile, seeds, flags):
+    # Keeps a world of every seed in memory, as a batch or a search might,
+    # with the tables in columns. Sizes are what each world adds to the
+    # worlds before it.
+    randomizer.restore_objects(randomizer.LOADED_ROM["snapshot"])
+    randomizer.load_rom(randomizer.read_rom(romfile), columns=True)
+    base = randomizer.LOADED_ROM["snapshot"]["world"]
+    seen = set()
+    results = {"world:base_size": (base.get_size(seen) / 1024.0, "kb",
+                                   "lower")}
+    worlds, size, restore, fork = [], 0, 0, 0
+    for seed in seeds:
+        start = time()
+        randomizer.restore_objects(randomizer.LOADED_ROM["snapshot"])
+        restore += time() - start
+        randomizer.randomize_objects(randomizer.ALL_OBJECTS, seed, flags)
+        start = time()
+        worlds.append(randomizer.fork_world())
+        fork += time() - start
+        size += worlds[-1].get_size(seen)
+    results["world:size"] = (size / 1024.0 / len(seeds), "kb", "lower")
+    results["world:restore"] = (restore / len(seeds), "s", "lower")
+    results["world:fork"] = (fork / len(seeds), "s", "lower")
+    return results
+
+
+def run_benchmarks(directory, seeds, flags):
+    romfile = make_fixture(directory)
+    # The randomizer reads its tables relative to the working directory
+    # when it is imported.
+    chdir(directory)
+    import randomizer
+
+    seeds = randomizer.parse_seeds(seeds)
+    results = {}
+    start = time()
+    randomizer.load_rom(randomizer.read_rom(romfile))
+    results["load"] = (time() - start, "s", "lower")
+
+    PROFILER.reset()
+    PROFILER.enable()
+    digest = md5()
+    start = time()
+    for seed in seeds:
+        digest.update(randomizer.make_patch(seed, flags, enemy_jump=True))
+    elapsed = time() - start
+    PROFILER.disable()
+    results["seed"] = (elapsed / len(seeds), "s", "lower")
+    results["seeds_per_second"] = (len(seeds) / elapsed, "/s", "higher")
+
+    for s in PROFILER.get_stats():
+        if s.phase in ["mutate", "cleanup"]:
+            key = "%s:%s" % (s.phase, s.name)
+        else:
+            key = s.phase
+        results[key] = (s.wall / s.calls, "s", "lower")
+
+    for name, times in sorted(get_rank_times(randomizer).items()):
+        for kind, value in sorted(times.items()):
+            results["rank:%s:%s" % (name, kind)] = (value, "s", "lower")
+
+    results["peak_rss"] = (get_peak_rss(), "kb", "lower")
+    results.update(get_world_results(randomizer, romfile, seeds, flags))
+    return {"seeds": seeds, "flags": flags, "output": digest.hexdigest(),
+            "machine": node(), "results": results}
+
+
+def compare(report, baseline, tolerance=TOLERANCE):
+    # Returns the names of the measurements that got worse by more than the
+    # tolerance, plus "output" if the same seeds now produce other roms.
+    # Timings that moved by less than a millisecond are noise.
+    problems = []
+    old = baseline["results"]
+    if baseline.get("machine") != report["machine"]:
+        old = {}
+    for key, (value, unit, better) in sorted(report["results"].items()):
+        if key not in old or value is None or not old[key][0]:
+            continue
+        if unit == "s" and abs(value - old[key][0]) < MIN_DIFFERENCE:
+            continue
+        ratio = float(value) / old[key][0]
+        if (better == "lower" and ratio > 1 + tolerance) or (
+                better == "higher" and ratio < 1 / (1 + tolerance)):
+            problems.append(key)
+    if (baseline["seeds"] == report["seeds"]
+            and baseline["flags"] == report["flags"]
+            and baseline["output"] != report["output"]):
+        problems.append("output")
+    return problems
+
+
+def format_report(report, baseline=None, problems=()):
+    lines = ["%-44s %12s %12s %8s" % ("BENCHMARK", "VALUE", "BASELINE",
+                                      "CHANGE")]
+    old = baseline["results"] if baseline else {}
+    for key, (value, unit, better) in sorted(report["results"].items()):
+        if unit == "s":
+            value, unit = value * 1000, "ms"
+        text = "%.2f %s" % (value, unit) if value is not None else "-"
+        basetext, change = "", ""
+        if key in old and old[key][0] and value is not None:
+            basevalue = old[key][0] * (1000 if old[key][1] == "s" else 1)
+            basetext = "%.2f %s" % (basevalue, unit)
+            change = "%+.0f%%" % (((float(value) / basevalue) - 1) * 100)
+        flag = " REGRESSION" if key in problems else ""
+        lines.append("%-44s %12s %12s %8s%s" % (key, text, basetext, change,
+                                                 flag))
+    lines.append("output %s%s" % (report["output"],
+                                  " CHANGED" if "output" in problems else ""))
+    if baseline and baseline.get("machine") != report["machine"]:
+        lines.append("The baseline is from another machine, so only the "
+                     "output was compared.")
+    return "\n".join(lines)
+
+
+def write_report(report, filename):
+    f = open(filename, "w")
+    f.write(dumps(report, indent=2, sort_keys=True, separators=(",", ": ")))
+    f.write("\n")
+    f.close()
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Benchmark the randomizer with a synthetic rom.")
+    parser.add_argument("--seeds", default=SEEDS)
+    parser.add_argument("--flags", default="cfmt")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save", action="store_true",
+                        help="store the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    parser.add_argument("--json", default=None)
+    parser.add_argument("--workdir", default=None,
+                        help="where to build the synthetic rom")
+    args = parser.parse_args(argv[1:])
+
+    baselinefile = abspath(args.baseline)
+    jsonfile = abspath(args.json) if args.json else None
+    directory = args.workdir or mkdtemp(prefix="ffmq-benchmark-")
+    try:
+        report = run_benchmarks(abspath(directory), args.seeds, args.flags)
+    finally:
+        if args.workdir is None:
+            rmtree(directory)
+
+    baseline = None
+    if exists(baselinefile) and not args.save:
+        baseline = loads(open(baselinefile).read())
+    problems = compare(report, baseline, args.tolerance) if baseline else []
+    print format_report(report, baseline, problems)
+    if jsonfile:
+        write_report(report, jsonfile)
+    if args.save:
+        write_report(report, baselinefile)
+        print "Saved baseline to %s." % baselinefile
+    if problems:
+        print "Regressions: %s" % ", ".join(problems)
+        exit(1)
@@ -0,0 +1,67 @@
+from itertools import permutations
+
+from randomtools.utils import utilrandom as random
+from columns import get_numpy
+
+
+# Lookup tables for mutating small bit fields like elements, statuses and
+# resistances.
+
+POPCOUNT = tuple(bin(i).count("1") for i in xrange(0x100))
+BIT_MASKS = {}
+PERMUTATION_TABLES = {}
+TABLE_SIZES = [4, 5]
+
+
+def popcount(value):
+    if value < 0x100:
+        return POPCOUNT[value]
+    return bin(value).count("1")
+
+
+def get_bit_masks(size):
+    if size not in BIT_MASKS:
+        BIT_MASKS[size] = tuple(1 << i for i in xrange(size))
+    return BIT_MASKS[size]
+
+
+def shuffle_bits(value, size=8):
+    # Moves the set bits of value to as many random positions below size.
+    # Draws the same numbers as randomtools' shuffle_bits, so a seed gives
+    # the same values with either.
+    numbits = popcount(value)
+    if not numbits:
+        return value
+    return sum(random.sample(get_bit_masks(size), numbits))
+
+
+def get_permutation_table(size):
+    # Every order of size bits, as a table from a value to the value with
+    # its bits in that order. 4 and 5 bit fields have 24 and 120 orders.
+    if size not in PERMUTATION_TABLES:
+        numpy = get_numpy()
+        orders = numpy.array(list(permutations(range(size))))
+        values = numpy.arange(1 << size)
+        table = numpy.zeros((len(orders), len(values)), dtype=numpy.int_)
+        for i in xrange(size):
+            table |= ((values >> i) & 1)[numpy.newaxis, :] << orders[:, [i]]
+        PERMUTATION_TABLES[size] = table
+    return PERMUTATION_TABLES[size]
+
+
+def shuffle_column_bits(values, size, generator):
+    # shuffle_bits for a whole column at once. Every value gets a random
+    # order of its bits, which puts its set bits at random positions just
+    # the same. Wider fields have too many orders for a table, so their
+    # bits are moved one position at a time.
+    numpy = get_numpy()
+    values = numpy.asarray(values, dtype=numpy.int_)
+    assert not (values >> size).any()
+    if size in TABLE_SIZES:
+        table = get_permutation_table(size)
+        return table[generator.randint(0, len(table), len(values)), values]
+    orders = generator.random_sample((len(values), size)).argsort(axis=1)
+    shuffled = numpy.zeros(len(values), dtype=numpy.int_)
+    for i in xrange(size):
+        shuffled |= ((values >> i) & 1) << orders[:, i]
+    return shuffled
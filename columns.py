@@ -0,0 +1,227 @@
+from array import array
+
+
+NUMPY = {}
+
+
+def get_numpy():
+    # numpy is optional, and importing it takes longer than parsing the
+    # rom, so it is only imported once columns are actually used.
+    if "numpy" not in NUMPY:
+        try:
+            import numpy
+        except ImportError:
+            numpy = None
+        NUMPY["numpy"] = numpy
+    return NUMPY["numpy"]
+
+
+def make_array(typecode, values):
+    # Fields too wide for any array type are kept in a list instead.
+    if typecode is None:
+        return list(values)
+    return array(typecode, values)
+
+
+class Column(object):
+    # Data descriptor that keeps one attribute of every object of a table
+    # in a single array, indexed by the object's index. Setting it marks
+    # the store it belongs to as changed.
+    def __init__(self, values, typecode="l"):
+        self.values = make_array(typecode, values)
+        self.store = None
+        self.name = None
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return self.values[obj.index]
+
+    def __set__(self, obj, value):
+        self.values[obj.index] = value
+        self.store.changed = True
+
+    @property
+    def arrays(self):
+        return [self.values]
+
+    def copy(self):
+        return [self.values[:]]
+
+    def restore(self, arrays):
+        self.values[:] = arrays[0]
+
+
+class ColumnRow(list):
+    # What a ListColumn hands out: a copy of one object's row that sets
+    # itself on the object again whenever it is changed in place, so that
+    # the change reaches the columns and the object's __setattr__ sees it.
+    # Rows have a fixed length, so changes that make a row longer or
+    # shorter fail and leave the columns as they were. Rows pickle as
+    # plain lists.
+    def __init__(self, values, obj, name):
+        super(ColumnRow, self).__init__(values)
+        self.obj = obj
+        self.name = name
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+
+def write_through(method):
+    def changed(self, *args, **kwargs):
+        result = method(self, *args, **kwargs)
+        setattr(self.obj, self.name, list(self))
+        return result
+    return changed
+
+
+for name in ["__setitem__", "__delitem__", "__setslice__", "__delslice__",
+             "__iadd__", "__imul__", "append", "extend", "insert", "pop",
+             "remove", "reverse", "sort"]:
+    setattr(ColumnRow, name, write_through(getattr(list, name)))
+
+
+class ListColumn(Column):
+    # Fixed length list attributes are stored as one array per position.
+    def __init__(self, rows, typecode="l"):
+        length = len(rows[0])
+        assert all([len(row) == length for row in rows])
+        self.columns = [make_array(typecode, [row[i] for row in rows])
+                        for i in xrange(length)]
+        self.store = None
+        self.name = None
+
+    def __get__(self, obj, objtype=None):
+        if obj is None:
+            return self
+        return ColumnRow([c[obj.index] for c in self.columns], obj,
+                         self.name)
+
+    def __set__(self, obj, value):
+        assert len(value) == len(self.columns)
+        for c, v in zip(self.columns, value):
+            c[obj.index] = v
+        self.store.changed = True
+
+    @property
+    def arrays(self):
+        return self.columns
+
+    def copy(self):
+        return [c[:] for c in self.columns]
+
+    def restore(self, arrays):
+        for c, a in zip(self.columns, arrays):
+            c[:] = a
+
+
+class ColumnStore(object):
+    # Moves the given attributes of every object of a table out of the
+    # objects and into columns. The objects keep working as before, as
+    # views over the columns, until the store is detached. Attributes an
+    # object does not have yet start out as the class default, which comes
+    # back when the store is detached. typecodes picks the array type of
+    # some attributes, "l" otherwise, and None for a list.
+    #
+    # changed is set whenever a column is set or restored, and cleared by
+    # World, which uses it to know which tables it has to copy.
+    def __init__(self, objtype, attributes, typecodes=None):
+        self.objtype = objtype
+        self.columns = {}
+        self.replaced = {}
+        self.changed = True
+        self.source = None
+        objs = objtype.every
+        assert [o.index for o in objs] == range(len(objs))
+        for attr in attributes:
+            if attr in objtype.__dict__:
+                self.replaced[attr] = objtype.__dict__[attr]
+            default = getattr(objtype, attr, None)
+            values = [o.__dict__.pop(attr, default) for o in objs]
+            typecode = (typecodes or {}).get(attr, "l")
+            if isinstance(values[0], list):
+                column = ListColumn(values, typecode)
+            else:
+                column = Column(values, typecode)
+            column.store = self
+            column.name = attr
+            self.columns[attr] = column
+            setattr(objtype, attr, column)
+
+    def __len__(self):
+        return len(self.objtype.every)
+
+    def get_arrays(self, attr):
+        # As 64 bit NumPy arrays, since a C long is only 32 bits on Windows.
+        # Columns kept in lists are copied, and fail if a value is too wide.
+        numpy = get_numpy()
+        if numpy is None:
+            return self.columns[attr].arrays
+        arrays = []
+        for a in self.columns[attr].arrays:
+            if isinstance(a, list):
+                arrays.append(numpy.array(a, dtype=numpy.int64))
+            else:
+                arrays.append(numpy.frombuffer(a, dtype=a.typecode).astype(
+                    numpy.int64))
+        return arrays
+
+    def snapshot(self):
+        return dict((attr, column.copy())
+                    for (attr, column) in self.columns.items())
+
+    def restore(self, snapshot):
+        for attr, arrays in snapshot.items():
+            self.columns[attr].restore(arrays)
+        self.changed = True
+
+    def detach(self):
+        objs = self.objtype.every
+        for attr, column in self.columns.items():
+            values = [getattr(o, attr) for o in objs]
+            if isinstance(column, ListColumn):
+                values = [list(value) for value in values]
+            delattr(self.objtype, attr)
+            if attr in self.replaced:
+                setattr(self.objtype, attr, self.replaced[attr])
+            for o, value in zip(objs, values):
+                o.__dict__[attr] = value
+        self.columns = {}
+        self.replaced = {}
+
+
+class World(object):
+    # The contents of some column stores at one point, to go back to later
+    # with restore(). Only the stores that changed since the last world was
+    # made or restored are copied. The others share their arrays with that
+    # world, so worlds that differ in a few tables only hold those, and the
+    # arrays of a world are never written to.
+    def __init__(self, stores):
+        self.tables = []
+        for store in stores:
+            if store.changed or store.source is None:
+                store.source = store.snapshot()
+                store.changed = False
+            self.tables.append((store, store.source))
+
+    def restore(self):
+        for store, state in self.tables:
+            if store.changed or store.source is not state:
+                store.restore(state)
+                store.source = state
+                store.changed = False
+
+    def get_size(self, seen=None):
+        # Bytes in the world's arrays, leaving out arrays in seen, which is
+        # what a world adds to the others that seen was used for.
+        if seen is None:
+            seen = set()
+        size = 0
+        for store, state in self.tables:
+            for arrays in state.values():
+                for a in arrays:
+                    if id(a) not in seen:
+                        seen.add(id(a))
+                        size += len(a) * getattr(a, "itemsize", 8)
+        return size
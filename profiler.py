@@ -0,0 +1,217 @@
+from cProfile import Profile
+from json import dumps
+from os import times
+from os.path import exists
+from time import time
+
+try:
+    from resource import getrusage, RUSAGE_SELF
+except ImportError:
+    getrusage = None
+
+try:
+    from os import sysconf
+except ImportError:
+    sysconf = None
+
+
+STATM = "/proc/self/statm"
+PAGE_KB = sysconf("SC_PAGE_SIZE") / 1024 if sysconf else None
+
+
+def get_cpu_time():
+    t = times()
+    return t[0] + t[1]
+
+
+def get_peak_rss():
+    # Peak resident set size of the process so far, in kilobytes.
+    if getrusage is None:
+        return None
+    return getrusage(RUSAGE_SELF).ru_maxrss
+
+
+def get_rss():
+    if PAGE_KB is None or not exists(STATM):
+        return None
+    f = open(STATM)
+    rss = int(f.read().split()[1]) * PAGE_KB
+    f.close()
+    return rss
+
+
+class PhaseStats(object):
+    def __init__(self, phase, name):
+        self.phase = phase
+        self.name = name
+        self.calls = 0
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss = None
+        self.rss_growth = None
+        self.profile = None
+
+    def add(self, wall, cpu, peak_rss, rss_growth):
+        self.calls += 1
+        self.wall += wall
+        self.cpu += cpu
+        if peak_rss is not None:
+            self.peak_rss = max(self.peak_rss, peak_rss)
+        if rss_growth is not None:
+            self.rss_growth = (self.rss_growth or 0) + rss_growth
+
+    def to_dict(self):
+        return {"phase": self.phase, "name": self.name, "calls": self.calls,
+                "wall": self.wall, "cpu": self.cpu,
+                "peak_rss_kb": self.peak_rss, "rss_growth_kb": self.rss_growth}
+
+
+class PhaseTimer(object):
+    def __init__(self, profiler, stats):
+        self.profiler = profiler
+        self.stats = stats
+
+    def __enter__(self):
+        profiler = self.profiler
+        profiler.stack.append(self)
+        self.nested_wall = self.nested_cpu = 0.0
+        self.nested_growth = 0
+        self.profile = None
+        if profiler.use_cprofile and profiler.active is None:
+            if self.stats.profile is None:
+                self.stats.profile = Profile()
+            self.profile = self.stats.profile
+        if profiler.active is None:
+            profiler.active = self
+        self.rss = get_rss()
+        self.cpu = get_cpu_time()
+        self.wall = time()
+        if self.profile is not None:
+            self.profile.enable()
+        return self
+
+    def __exit__(self, *args):
+        if self.profile is not None:
+            self.profile.disable()
+        wall = time() - self.wall
+        cpu = get_cpu_time() - self.cpu
+        rss = get_rss()
+        growth = None if rss is None else rss - self.rss
+        # Time spent in phases nested inside this one counts toward them
+        # instead, so that no time is counted twice.
+        stack = self.profiler.stack
+        stack.pop()
+        if stack:
+            stack[-1].nested_wall += wall
+            stack[-1].nested_cpu += cpu
+            stack[-1].nested_growth += growth or 0
+        if growth is not None:
+            growth -= self.nested_growth
+        self.stats.add(wall - self.nested_wall, cpu - self.nested_cpu,
+                       get_peak_rss(), growth)
+        if self.profiler.active is self:
+            self.profiler.active = None
+
+
+class NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+
+NULL_TIMER = NullTimer()
+
+
+class Profiler(object):
+    # Wall time, cpu time and memory use per phase of the pipeline, and per
+    # object class within a phase. Disabled until enable() is called, in
+    # which case phase() costs next to nothing. A phase started inside
+    # another one is left out of the outer one's time, so the totals add up
+    # to the time that was measured.
+    def __init__(self):
+        self.enabled = False
+        self.use_cprofile = False
+        self.reset()
+
+    def reset(self):
+        self.stats = {}
+        self.order = []
+        self.stack = []
+        self.active = None
+
+    def enable(self, use_cprofile=False):
+        self.enabled = True
+        self.use_cprofile = use_cprofile
+
+    def disable(self):
+        self.enabled = False
+
+    def phase(self, phase, name=None):
+        if not self.enabled:
+            return NULL_TIMER
+        key = (phase, name)
+        if key not in self.stats:
+            self.stats[key] = PhaseStats(phase, name)
+            self.order.append(key)
+        return PhaseTimer(self, self.stats[key])
+
+    def get_stats(self):
+        return [self.stats[key] for key in self.order]
+
+    def get_totals(self):
+        totals = {}
+        for s in self.get_stats():
+            if s.phase not in totals:
+                totals[s.phase] = PhaseStats(s.phase, None)
+            t = totals[s.phase]
+            t.calls = max(t.calls, s.calls)
+            t.wall += s.wall
+            t.cpu += s.cpu
+            t.peak_rss = max(t.peak_rss, s.peak_rss)
+        return [totals[p] for p in sorted(totals,
+                                          key=lambda p: -totals[p].wall)]
+
+    def get_hot_phase(self):
+        # The slowest single phase, i.e. the one most worth profiling.
+        stats = [s for s in self.get_stats() if s.profile is not None]
+        if not stats:
+            return None
+        return max(stats, key=lambda s: s.wall)
+
+    def to_json(self):
+        return dumps({
+            "phases": [s.to_dict() for s in self.get_stats()],
+            "totals": [s.to_dict() for s in self.get_totals()],
+            "wall": sum([s.wall for s in self.get_stats()]),
+            "cpu": sum([s.cpu for s in self.get_stats()]),
+            "peak_rss_kb": get_peak_rss(),
+            }, indent=2, sort_keys=True)
+
+    def format_table(self):
+        def format_row(s):
+            peak = "-" if s.peak_rss is None else "%.1f" % (
+                s.peak_rss / 1024.0)
+            return "%-16s %-24s %6s %10.2f %10.2f %9s" % (
+                s.phase, s.name or "", s.calls, s.wall * 1000, s.cpu * 1000,
+                peak)
+
+        header = "%-16s %-24s %6s %10s %10s %9s" % (
+            "PHASE", "CLASS", "CALLS", "WALL MS", "CPU MS", "PEAK MB")
+        lines = [header]
+        lines.extend(map(format_row, self.get_stats()))
+        lines.append("")
+        lines.append(header)
+        lines.extend(map(format_row, self.get_totals()))
+        return "\n".join(lines)
+
+    def dump_hot_phase(self, filename):
+        hot = self.get_hot_phase()
+        if hot is None:
+            return None
+        hot.profile.dump_stats(filename)
+        return hot
+
+
+PROFILER = Profiler()
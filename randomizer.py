@@ -1,11 +1,34 @@
-from randomtools.tablereader import TableObject, get_global_label
+from randomtools.tablereader import (
+    TableObject, get_global_label, set_global_label, sort_good_order,
+    set_table_specs, set_global_output_filename)
 from randomtools.utils import (
-    classproperty, mutate_normal, shuffle_bits,
-    utilrandom as random)
+    classproperty, mutate_normal, utilrandom as random)
 from randomtools.interface import (
-    get_outfile, get_seed, get_flags, run_interface, rewrite_snes_meta,
-    clean_and_write, finish_interface)
+    get_outfile, get_seed, get_flags, run_interface, finish_interface)
+from randomtools import interface
+from romimage import (
+    TableLayoutMixin, write_objects, make_ips, rewrite_snes_meta,
+    register_rom_data, is_loaded, add_load_hook, get_table_records,
+    INT_FORMATS)
+from romcache import read_cache, write_cache, clear_cache, get_tables_key
+from columns import ColumnStore, World, get_numpy
+from rankcache import RankCache
+from profiler import PROFILER
+from textcodec import TextCodec
+from scheduler import Scheduler
+from statengine import (
+    get_generator, get_bounds, shuffle_columns, draw_stats, draw_bits)
+from bitfields import shuffle_bits, popcount
+from statecache import (StateCache, STATE_CACHE_BYTES, get_state_key,
+                        clear_states)
+from argparse import ArgumentParser
+from bisect import bisect_right
+from cPickle import dumps, loads
+from hashlib import md5
+from multiprocessing import Pool
 from os import path
+from sys import argv, exit, stdout, stderr
+from time import time
 
 
 RANDOMIZE = True
@@ -19,7 +42,9 @@ except ImportError:
     tblpath = "tables"
 TEXTTABLEFILE = path.join(tblpath, "mq.tbl")
 ITEMNAMESFILE = path.join(tblpath, "itemnames.txt")
-itemnames = [line.strip() for line in open(ITEMNAMESFILE).readlines()]
+MASTERFILE = path.join(tblpath, "master.txt")
+HEADLESS_ROM = "<rom>"
+ITEM_NAMES = []
 CONSUMABLES = [0x10, 0x11, 0x12, 0x13, 0xDD, 0xDE, 0xDF]
 BANNED_ITEMS = [0x07, 0x08, 0x29, 0x2a, 0x2b]  # Rock, Cap, All bombs
 BROKEN_ITEMS = [i for i in range(0x10) +
@@ -37,50 +62,153 @@ assert not set(BANNED_ITEMS) & set(
     DESIRABLE_ITEMS + UNDESIRABLE_ITEMS + BROKEN_ITEMS
     + CONSUMABLES + LOW_EQUIP_ITEMS)
 chest_items = None
+MAX_REWARD_ATTEMPTS = 100
 
 
-texttable = {}
-for line in open(TEXTTABLEFILE):
-    a, b = line.strip("\n").split("=")
-    a = int(a, 0x10)
-    texttable[a] = b
-    texttable[b] = a
+def get_item_names():
+    if not ITEM_NAMES:
+        ITEM_NAMES.extend([line.strip() for line in open(ITEMNAMESFILE)])
+    return ITEM_NAMES
 
 
-def write_title_screen(outfile, seed, flags):
-    assert texttable["A"] == 0x9a
-    pointer = 0x60EDB
+class ItemPool(object):
+    # An ordered pool of items with constant time availability checks.
+    # Items taken out of the middle of the pool are only marked as
+    # unavailable and skipped when the end of the order reaches them.
+    def __init__(self, items):
+        self.order = list(items)
+        self.available = set(items)
+
+    def __len__(self):
+        return len(self.available)
+
+    def __contains__(self, item):
+        return item in self.available
+
+    def shuffle(self):
+        self.order = [i for i in self.order if i in self.available]
+        random.shuffle(self.order)
+
+    def pop(self, exclude=None):
+        # Takes the last available item that is not excluded.
+        for i in xrange(len(self.order)-1, -1, -1):
+            item = self.order[i]
+            if item not in self.available:
+                del(self.order[i])
+                continue
+            if exclude and item in exclude:
+                continue
+            self.available.remove(item)
+            del(self.order[i])
+            return item
+        return None
+
+
+class ItemLedger(object):
+    # Tracks which items are still available to place in chests and
+    # battlefield rewards, which chest items are well hidden, and which
+    # items have already been given out as battlefield rewards.
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pools = {"desirable": ItemPool(DESIRABLE_ITEMS),
+                      "undesirable": ItemPool(UNDESIRABLE_ITEMS)}
+        self.broken = frozenset(BROKEN_ITEMS)
+        self.consumable = frozenset(CONSUMABLES)
+        self.well_hidden = set([])
+        self.reserved = set([])
+
+    def has(self, category):
+        return bool(self.pools[category])
+
+    def any_left(self):
+        return any(self.pools.values())
+
+    def shuffle(self, category):
+        self.pools[category].shuffle()
+
+    def pop(self, category, exclude=None):
+        return self.pools[category].pop(exclude=exclude)
+
+    def hide(self, item):
+        self.well_hidden.add(item)
+
+    def pop_hidden(self):
+        value = random.choice(sorted(self.well_hidden))
+        self.well_hidden.remove(value)
+        return value
+
+    def is_reserved(self, item):
+        return item in self.reserved
+
+    def reserve(self, item):
+        # Each item is only given out once, so reserving an item that is
+        # already reserved fails.
+        if item in self.reserved:
+            return False
+        self.reserved.add(item)
+        return True
+
+    def release(self, item):
+        self.reserved.discard(item)
+
+    def get_state(self):
+        return (dict((category, (list(pool.order), set(pool.available)))
+                     for (category, pool) in self.pools.items()),
+                set(self.well_hidden), set(self.reserved))
+
+    def set_state(self, state):
+        pools, well_hidden, reserved = state
+        for category, (order, available) in pools.items():
+            self.pools[category].order = list(order)
+            self.pools[category].available = set(available)
+        self.well_hidden = set(well_hidden)
+        self.reserved = set(reserved)
+
+
+ITEMS = ItemLedger()
+
+
+TEXT = TextCodec(TEXTTABLEFILE)
+TEXT_SPACE = chr(0xFE)
+
+
+TITLE_SCREEN_POINTER = 0x60EDB
+
+
+def get_title_screen_data(seed, flags):
+    assert TEXT.encode("A") == [0x9a]
     seed = "{0:0>10}".format(seed)
     flags = "{0: <4}".format(flags)
     version = "v{0: <3}".format(VERSION)
     assert len(seed) == 10
     assert len(flags) == 4
-    space = [chr(0xFE)]
-    to_write = "".join(
-        (space*2) +
-        [chr(texttable[c]) for c in seed[-5:]] +
-        (space) +
-        [chr(texttable[c]) for c in flags.upper()] +
-        [chr(texttable[c]) for c in version.upper()] +
-        [chr(texttable[c]) for c in "TERRIBLE"] +
-        (space*len("Press any button")) +
-        [chr(texttable[c]) for c in seed[:5]] +
-        (space*2) +
-        [chr(texttable[c]) for c in "SECRET"] +
-        (space*2)
-        )
-    to_write = to_write.replace(chr(texttable[" "]), chr(0xFE))
-    f = open(outfile, "r+b")
-    f.seek(pointer)
-    f.write(to_write)
-    f.close()
+    to_write = "".join([
+        TEXT_SPACE*2,
+        TEXT.encode_bytes(seed[-5:]),
+        TEXT_SPACE,
+        TEXT.encode_bytes(flags.upper() + version.upper() + "TERRIBLE"),
+        TEXT_SPACE*len("Press any button"),
+        TEXT.encode_bytes(seed[:5]),
+        TEXT_SPACE*2,
+        TEXT.encode_bytes("SECRET"),
+        TEXT_SPACE*2,
+        ])
+    return to_write.replace(TEXT.encode_bytes(" "), TEXT_SPACE)
+
+
+def write_title_screen(image, seed, flags):
+    to_write = get_title_screen_data(seed, flags)
+    image[TITLE_SCREEN_POINTER:TITLE_SCREEN_POINTER+len(to_write)] = to_write
+    return (TITLE_SCREEN_POINTER, TITLE_SCREEN_POINTER+len(to_write))
 
 
 def bytes_to_text(data):
-    return "".join([texttable[d] if d in texttable else "~" for d in data])
+    return TEXT.decode(data)
 
 
-class TreasureIndexObject(TableObject):
+class TreasureIndexObject(TableLayoutMixin, TableObject):
     flag = "t"
     consumable_options = (
         [0x10] * 69 +
@@ -91,16 +219,13 @@ class TreasureIndexObject(TableObject):
         [0xde] * 55 +
         [0xdf] * 1
         )
-    desirable_left = list(DESIRABLE_ITEMS)
-    undesirable_left = list(UNDESIRABLE_ITEMS)
-    well_hidden = set([])
 
     def __repr__(self):
         return "%x: %s" % (self.index, self.contents_name)
 
     @property
     def is_consumable(self):
-        return self.contents in CONSUMABLES
+        return self.contents in ITEMS.consumable
 
     @property
     def is_key(self):
@@ -114,16 +239,16 @@ class TreasureIndexObject(TableObject):
                       }
         if self.contents in additional:
             return additional[self.contents]
-        return itemnames[self.contents]
+        return get_item_names()[self.contents]
 
     @classmethod
     def mutate_all(self):
         chests = list(self.every)
         random.shuffle(chests)
-        random.shuffle(self.desirable_left)
-        random.shuffle(self.undesirable_left)
+        ITEMS.shuffle("desirable")
+        ITEMS.shuffle("undesirable")
         for o in chests:
-            if hasattr(o, "mutated") and o.mutated:
+            if o.mutated:
                 continue
             o.mutate()
             o.mutated = True
@@ -137,38 +262,85 @@ class TreasureIndexObject(TableObject):
             self.contents = 0x2A
             return
 
-        any_left = self.desirable_left + self.undesirable_left
+        any_left = ITEMS.any_left()
         value = None
         if self.is_consumable and (not any_left or random.randint(1, 7) != 7):
             self.contents = random.choice(self.consumable_options)
             return
         elif self.is_consumable:
-            if self.undesirable_left and (
-                    not self.desirable_left or random.randint(1, 10) != 10):
-                value = self.undesirable_left.pop()
+            if ITEMS.has("undesirable") and (
+                    not ITEMS.has("desirable") or random.randint(1, 10) != 10):
+                value = ITEMS.pop("undesirable")
             else:
-                value = self.desirable_left.pop()
+                value = ITEMS.pop("desirable")
 
         if value is None:
-            if self.desirable_left:
-                value = self.desirable_left.pop()
-            elif self.undesirable_left:
-                value = self.undesirable_left.pop()
+            if ITEMS.has("desirable"):
+                value = ITEMS.pop("desirable")
+            elif ITEMS.has("undesirable"):
+                value = ITEMS.pop("undesirable")
             else:
                 value = 0x12  # seed
 
         if (value not in [0x12, 0x14] and value in DESIRABLE_ITEMS
                 and self.is_consumable):
-            self.well_hidden.add(value)
+            ITEMS.hide(value)
         self.contents = value
 
 
-class CombatObject(object):
+STAT_ENGINE = {}
+DRAWN_STATS = {}
+DRAWN_BITS = {}
+
+
+class StatMutationMixin(object):
+    # With the stat engine on, the intershuffles, the new stats and the
+    # shuffled bit_fields of a whole table are drawn at once, and mutate()
+    # only applies what was drawn for its object. Anything else mutate()
+    # does is unchanged.
+    bit_fields = []
+
+    @classmethod
+    def mutate_all(cls):
+        if not STAT_ENGINE:
+            return super(StatMutationMixin, cls).mutate_all()
+        generator = get_generator(random.randint(0, 0xFFFFFFFF))
+        shuffle_columns([o for o in cls.every if o.intershuffle_valid],
+                        getattr(cls, "intershuffle_attributes", []),
+                        generator)
+        DRAWN_STATS.update(draw_stats(cls.every, get_bounds(cls), generator))
+        DRAWN_BITS.update(draw_bits(cls.every, cls.bit_fields, generator))
+        try:
+            for o in cls.every:
+                if o.mutated:
+                    continue
+                o.mutate()
+                o.mutated = True
+        finally:
+            DRAWN_STATS.clear()
+            DRAWN_BITS.clear()
+
+    def mutate(self):
+        if not STAT_ENGINE:
+            return super(StatMutationMixin, self).mutate()
+        for attr, value in DRAWN_STATS[self].items():
+            setattr(self, attr, value)
+
+    def get_shuffled_bits(self, attr, size=8, shift=0):
+        # The bits of attr from shift up, shuffled within size bits. The
+        # fields the engine draws for must be listed in bit_fields.
+        if STAT_ENGINE:
+            return DRAWN_BITS[self][attr, size, shift]
+        return shuffle_bits(getattr(self, attr) >> shift, size=size) << shift
+
+
+class CombatObject(StatMutationMixin):
     mutate_attributes = {"power": None}
+    bit_fields = [("status", 8, 0)]
 
     def mutate(self):
         super(CombatObject, self).mutate()
-        self.status = shuffle_bits(self.status)
+        self.status = self.get_shuffled_bits("status")
 
 
 class ItemNameMixin(object):
@@ -176,10 +348,10 @@ class ItemNameMixin(object):
 
     @property
     def name(self):
-        return itemnames[self.index + self.first_name_index]
+        return get_item_names()[self.index + self.first_name_index]
 
 
-class WeaponObject(CombatObject, ItemNameMixin, TableObject):
+class WeaponObject(CombatObject, ItemNameMixin, TableLayoutMixin, TableObject):
     first_name_index = 32
     flag = "c"
     intershuffle_attributes = ["statboost", "status"]
@@ -195,14 +367,16 @@ class WeaponObject(CombatObject, ItemNameMixin, TableObject):
             self.element |= element
 
 
-class AttackObject(CombatObject, TableObject):
+class AttackObject(CombatObject, TableLayoutMixin, TableObject):
     flag = "m"
 
 
-class ArmorObject(CombatObject, ItemNameMixin, TableObject):
+class ArmorObject(CombatObject, ItemNameMixin, TableLayoutMixin, TableObject):
     first_name_index = 47
     flag = "c"
     intershuffle_attributes = ["statboost", "element", "status"]
+    bit_fields = CombatObject.bit_fields + [("element", 8, 0),
+                                            ("element", 5, 3)]
 
     @property
     def rank(self):
@@ -211,10 +385,9 @@ class ArmorObject(CombatObject, ItemNameMixin, TableObject):
     def mutate(self):
         super(ArmorObject, self).mutate()
         if random.randint(1, 4) == 4:
-            self.element = shuffle_bits(self.element)
+            self.element = self.get_shuffled_bits("element")
         else:
-            value = shuffle_bits(self.element >> 3, size=5)
-            value = value << 3
+            value = self.get_shuffled_bits("element", size=5, shift=3)
             self.element = self.element & 0x7
             self.element |= value
 
@@ -224,7 +397,7 @@ class ArmorObject(CombatObject, ItemNameMixin, TableObject):
             self.status &= 0x7F
 
 
-class DropObject(TableObject):
+class DropObject(StatMutationMixin, TableLayoutMixin, TableObject):
     flag = "t"
     flag_description = "treasure"
     mutate_attributes = {"xp": None,
@@ -232,7 +405,7 @@ class DropObject(TableObject):
                          }
 
 
-class MonsterObject(TableObject):
+class MonsterObject(StatMutationMixin, TableLayoutMixin, TableObject):
     flag = "m"
     flag_description = "monster stats"
     mutate_attributes = {"hp": (0, 0xFFFE),
@@ -245,6 +418,8 @@ class MonsterObject(TableObject):
         "resistances", "weaknesses", "immunities",
         "hp", "strength", "defense", "speed", "magic",
         ]
+    bit_fields = [("resistances", 4, 4), ("weaknesses", 4, 4),
+                  ("immunities", 4, 4)]
 
     @classproperty
     def after_order(self):
@@ -252,8 +427,21 @@ class MonsterObject(TableObject):
             return [FormationObject]
         return []
 
+    def __setattr__(self, name, value):
+        super(MonsterObject, self).__setattr__(name, value)
+        if name in RANK_ATTRIBUTES:
+            MONSTER_RANKS.invalidate(self)
+            LEADERS.reset()
+
+    @classproperty
+    def ranked(cls):
+        return MONSTER_RANKS.get_ranked()
+
     @property
     def rank(self):
+        return MONSTER_RANKS.get_rank(self)
+
+    def compute_rank(self):
         values = [getattr(self, attr) for attr in
                   ["hp", "defense", "speed"]]
         values = [v for v in values if v]
@@ -304,19 +492,18 @@ class MonsterObject(TableObject):
         for attr in ["resistances", "weaknesses", "immunities"]:
             if self.is_boss and attr == "immunities":
                 continue
-            value = getattr(self, attr) >> 4
-            value = shuffle_bits(value, size=4) << 4
+            value = self.get_shuffled_bits(attr, size=4, shift=4)
         while random.choice([True, False]):
             attr = random.choice(["resistances", "weaknesses", "immunities"])
             value = getattr(self, attr)
-            if attr != "immunities" and bin(value).count("1") > 6:
+            if attr != "immunities" and popcount(value) > 6:
                 continue
             flag = (1 << random.randint(0, 7))
             if ((attr == "weaknesses" or not self.is_boss) and
                     random.randint(1, 10) == 10):
                 value ^= flag
             else:
-                if attr != "immunities" and bin(value).count("1") > 4:
+                if attr != "immunities" and popcount(value) > 4:
                     continue
                 value |= flag
             setattr(self, attr, value)
@@ -329,7 +516,7 @@ class MonsterObject(TableObject):
             self.counter |= newcounter
 
 
-class BattleRewardObject(TableObject):
+class BattleRewardObject(TableLayoutMixin, TableObject):
     flag = "t"
 
     @classproperty
@@ -356,7 +543,7 @@ class BattleRewardObject(TableObject):
     def contents_name(self):
         if not self.is_item:
             return "NONE"
-        return itemnames[self.reward & 0xFF]
+        return get_item_names()[self.reward & 0xFF]
 
     @property
     def contents_description(self):
@@ -376,7 +563,7 @@ class BattleRewardObject(TableObject):
         brs = list(self.every)
         random.shuffle(brs)
         for o in brs:
-            if hasattr(o, "mutated") and o.mutated:
+            if o.mutated:
                 continue
             o.mutate()
             o.mutated = True
@@ -384,28 +571,35 @@ class BattleRewardObject(TableObject):
     def mutate(self):
         if self.is_item and self.value == 0x14:
             # Exit battlefield is fixed
+            ITEMS.reserve(0x14)
             return
 
+        # Rolls for an item somebody already has are thrown away.
+        for _ in xrange(MAX_REWARD_ATTEMPTS):
+            self.roll_reward()
+            if not self.is_item or ITEMS.reserve(self.reward & 0xFF):
+                return
+
+        # Give up on rolling and hand out any item nobody has yet.
+        self.reward = 0x4000 | random.choice(
+            [i for i in sorted(set(DESIRABLE_ITEMS + UNDESIRABLE_ITEMS))
+             if not ITEMS.is_reserved(i)])
+        ITEMS.reserve(self.reward & 0xFF)
+
+    def roll_reward(self):
         self.reward = 0
-        done_items = [t.reward & 0xFF for t in BattleRewardObject.every
-                      if hasattr(t, "mutated") and t.mutated
-                      and t.reward & 0x4000]
-        assert len(done_items) == len(set(done_items))
-        if TreasureIndexObject.desirable_left:
-            value = TreasureIndexObject.desirable_left.pop()
-            if value == 0x14 and TreasureIndexObject.desirable_left:
-                value = TreasureIndexObject.desirable_left.pop()
+        if ITEMS.has("desirable"):
+            value = ITEMS.pop("desirable")
+            if value == 0x14 and ITEMS.has("desirable"):
+                value = ITEMS.pop("desirable")
             if value != 0x14:
                 self.reward |= 0x4000
                 self.reward |= value
-        if TreasureIndexObject.undesirable_left:
-            remaining = [i for i in TreasureIndexObject.undesirable_left
-                         if i not in BROKEN_ITEMS]
-            if remaining:
-                value = remaining.pop()
+        if ITEMS.has("undesirable"):
+            value = ITEMS.pop("undesirable", exclude=ITEMS.broken)
+            if value is not None:
                 self.reward |= 0x4000
                 self.reward |= value
-                TreasureIndexObject.undesirable_left.remove(value)
 
         if self.reward == 0:
             rewardtype = random.choice(["xp", "xp", "item", "gp"])
@@ -418,18 +612,14 @@ class BattleRewardObject(TableObject):
                     self.reward |= 0x8000
                 self.reward |= random.randint(1, 0x3FF)
 
-        if self.reward & 0x4000 and (self.reward & 0xFF) in done_items:
-            self.reward = 0
-            return self.mutate()
-
 
-class MonsterNameObject(TableObject):
+class MonsterNameObject(TableLayoutMixin, TableObject):
     @property
     def name(self):
         return bytes_to_text(self.text)
 
 
-class CharacterObject(TableObject):
+class CharacterObject(StatMutationMixin, TableLayoutMixin, TableObject):
     flag = "c"
     flag_description = "characters"
     mutate_attributes = {"level": (1, 99),
@@ -446,6 +636,7 @@ class CharacterObject(TableObject):
     intershuffle_attributes = [
         "max_hp", "attack", "defense", "speed", "magic", "accuracy",
         ("white", "black", "known_magic"), ("wizard", "known_wizard")]
+    bit_fields = [("known_magic", 8, 0), ("known_wizard", 4, 4)]
 
     @property
     def rank(self):
@@ -464,9 +655,9 @@ class CharacterObject(TableObject):
         return self.known_magic >> 4
 
     def mutate(self):
-        self.known_magic = shuffle_bits(self.known_magic)
-        known_wizard = self.known_wizard >> 4
-        self.known_wizard = shuffle_bits(known_wizard, size=4) << 4
+        self.known_magic = self.get_shuffled_bits("known_magic")
+        self.known_wizard = self.get_shuffled_bits("known_wizard", size=4,
+                                                   shift=4)
         super(CharacterObject, self).mutate()
 
     def cleanup(self):
@@ -495,7 +686,8 @@ class CharacterObject(TableObject):
             setattr(self, "%s2" % attr, getattr(self, attr))
 
 
-class BattleRoundsObject(TableObject):
+class BattleRoundsObject(StatMutationMixin, TableLayoutMixin,
+                         TableObject):
     flag = "t"
     mutate_attributes = {"num_rounds": (0, 0xFF)}
 
@@ -504,12 +696,13 @@ class BattleRoundsObject(TableObject):
         return [BattleFormationObject]
 
 
-class FormationObject(TableObject):
+class FormationObject(TableLayoutMixin, TableObject):
     flag = "f"
     flag_description = "formations"
     done_bosses = set([])
     banned_bosses = [0x4c, 0x4d, 0x4e, 0x4f, 0x50]
     unused = []
+    special_boss = False
 
     @classproperty
     def after_order(self):
@@ -569,8 +762,25 @@ class FormationObject(TableObject):
         else:
             return self.enemies[0]
 
+    def __setattr__(self, name, value):
+        old_ids = None
+        if name == "enemy_ids" and hasattr(self, "enemy_ids"):
+            old_ids = self.enemy_ids
+        super(FormationObject, self).__setattr__(name, value)
+        if old_ids is not None:
+            FORMATION_RANKS.relink(self, get_enemy_indexes(old_ids))
+            COMPOSITIONS.update(self, get_composition(old_ids))
+            LEADERS.reset()
+
+    @classproperty
+    def ranked(cls):
+        return FORMATION_RANKS.get_ranked()
+
     @property
     def rank(self):
+        return FORMATION_RANKS.get_rank(self)
+
+    def compute_rank(self):
         if self.is_broken or not self.enemies:
             return -1
         ranks = sorted([e.rank for e in self.enemies], reverse=True)
@@ -616,9 +826,8 @@ class FormationObject(TableObject):
                     lower = 0
                 else:
                     lower = MonsterObject.get(e).rank
-                candidates = [m for m in MonsterObject.ranked
-                              if lower <= m.rank < upper
-                              and m.index not in self.banned_bosses]
+                candidates = [m for m in MONSTER_RANKS.get_range(lower, upper)
+                              if m.index not in self.banned_bosses]
                 if not candidates:
                     return
                 upper_index = max(len(candidates)-2, 0)
@@ -649,24 +858,21 @@ class FormationObject(TableObject):
                 continue
             if new in self.done_bosses and random.randint(1, 10) != 10:
                 continue
-            self.enemy_ids[i] = new.index
+            enemy_ids = list(self.enemy_ids)
+            enemy_ids[i] = new.index
+            self.enemy_ids = enemy_ids
             if new.is_boss:
                 self.done_bosses.add(new)
 
-        new_tuple = sorted(tuple(self.enemy_ids))
-        if new_tuple == sorted(tuple(old_ids)):
+        new_tuple = get_composition(self.enemy_ids)
+        if new_tuple == get_composition(old_ids):
             return
-        for f in FormationObject.every:
-            if f.index == self.index:
-                continue
-            if sorted(tuple(f.enemy_ids)) == new_tuple:
-                self.enemy_ids = old_ids
-                break
+        if COMPOSITIONS.get(new_tuple) - set([self.index]):
+            self.enemy_ids = old_ids
 
     @classmethod
     def full_cleanup(cls):
-        specials = [f for f in cls.every
-                    if hasattr(f, "special_boss") and f.special_boss]
+        specials = [f for f in cls.every if f.special_boss]
         specials = sorted(specials, key=lambda f: f.rank)
         if specials:
             for i, s in enumerate(specials):
@@ -678,7 +884,7 @@ class FormationObject(TableObject):
         super(FormationObject, cls).full_cleanup()
 
 
-class BattleFormationObject(TableObject):
+class BattleFormationObject(TableLayoutMixin, TableObject):
     num_special = 0
 
     @classproperty
@@ -701,8 +907,23 @@ class BattleFormationObject(TableObject):
     def formations(self):
         return [FormationObject.get(f) for f in self.formation_ids]
 
+    def __setattr__(self, name, value):
+        old_ids = None
+        if name == "formation_ids" and hasattr(self, "formation_ids"):
+            old_ids = self.formation_ids
+        super(BattleFormationObject, self).__setattr__(name, value)
+        if old_ids is not None:
+            BATTLE_FORMATION_RANKS.relink(self, old_ids)
+
+    @classproperty
+    def ranked(cls):
+        return BATTLE_FORMATION_RANKS.get_ranked()
+
     @property
     def rank(self):
+        return BATTLE_FORMATION_RANKS.get_rank(self)
+
+    def compute_rank(self):
         return max(f.rank for f in self.formations)
 
     @property
@@ -727,8 +948,7 @@ class BattleFormationObject(TableObject):
             maxrank = max([f.maxrank for f in self.formations])
             assert len(set(leaders)) == 1
             leader = leaders[0]
-            candidates = [f for f in FormationObject.every
-                          if f.leader == leader and f.maxrank <= maxrank]
+            candidates = LEADERS.get_formations(leader, maxrank)
         else:
             candidates = list(FormationObject.every)
 
@@ -742,14 +962,12 @@ class BattleFormationObject(TableObject):
         battlefields = [bf for bf in BattleFormationObject.ranked
                         if bf.index < 20]
         my_index = battlefields.index(self)
-        candidates = [m for m in MonsterObject.ranked
-                      if m.rank >= flamerus_rank]
+        candidates = MONSTER_RANKS.get_range(lower=flamerus_rank)
         new_index = int(round(my_index * (len(candidates) / 20.0)))
         new_index = mutate_normal(new_index, minimum=0,
                                   maximum=len(candidates)-1)
         leader = candidates[new_index]
-        candidates = [m for m in MonsterObject.ranked
-                      if m.rank < leader.rank]
+        candidates = MONSTER_RANKS.get_range(upper=leader.rank)
         max_index = len(candidates)-1
         follow_index = random.randint(random.randint(0, max_index), max_index)
         follower = candidates[follow_index].index
@@ -772,18 +990,18 @@ class BattleFormationObject(TableObject):
         if "t" not in get_flags():
             return
         br2 = BattleRewardObject.get(self.index)
+        if br2.mutated and br2.is_item:
+            # The reward this battlefield had is not given out after all.
+            ITEMS.release(br2.reward & 0xFF)
         br2.reward = 0x4000
-        done_items = [t.reward & 0xFF for t in BattleRewardObject.every
-                      if hasattr(t, "mutated") and t.mutated
-                      and t.reward & 0x4000]
-        if TreasureIndexObject.well_hidden:
-            value = random.choice(sorted(TreasureIndexObject.well_hidden))
-            TreasureIndexObject.well_hidden.remove(value)
+        if ITEMS.well_hidden:
+            value = ITEMS.pop_hidden()
         else:
             value = random.choice([i for i in DESIRABLE_ITEMS
-                                   if i != 0x14 and i not in done_items])
+                                   if i != 0x14 and not ITEMS.is_reserved(i)])
         br2.reward |= value
         br2.mutated = True
+        ITEMS.reserve(value)
 
     @classmethod
     def mutate_all(cls):
@@ -792,42 +1010,889 @@ class BattleFormationObject(TableObject):
         random.shuffle(battlefields)
         random.shuffle(everything_else)
         for o in everything_else + battlefields:
-            if hasattr(o, "mutated") and o.mutated:
+            if o.mutated:
                 continue
             o.mutate()
             o.mutated = True
 
 
+RANK_ATTRIBUTES = ["hp", "strength", "defense", "speed", "magic"]
+
+
+def get_enemy_indexes(enemy_ids):
+    return [eid & 0x7F for eid in enemy_ids if eid < 0xFF]
+
+
+def get_monster_ranks(child_ranks=None):
+    # With the monsters in columns and NumPy, ranks every monster at once,
+    # the same way as MonsterObject.compute_rank. Ranks go well past 2**32,
+    # so they are 64 bit everywhere.
+    if MonsterObject not in COLUMN_STORES or get_numpy() is None:
+        return None
+    numpy = get_numpy()
+    store = COLUMN_STORES[MonsterObject]
+    hp, defense, speed, strength, magic = [
+        store.get_arrays(attr)[0]
+        for attr in ["hp", "defense", "speed", "strength", "magic"]]
+    ranks = numpy.maximum(strength, magic)
+    for values in [hp, defense, speed]:
+        ranks = ranks * numpy.where(values, values, 1)
+    return ranks.tolist()
+
+
+def get_formation_ranks(monster_ranks):
+    if FormationObject not in COLUMN_STORES or get_numpy() is None:
+        return None
+    numpy = get_numpy()
+    store = COLUMN_STORES[FormationObject]
+    enemy_ids = numpy.column_stack(store.get_arrays("enemy_ids"))
+    present = enemy_ids < 0xFF
+    indexes = enemy_ids & 0x7F
+    broken = ((indexes > 0x50) & (enemy_ids != 0xFF)).any(axis=1)
+    indexes = numpy.where(present & (indexes <= 0x50), indexes, 0)
+    monster_ranks = numpy.array(monster_ranks, dtype=numpy.int64)
+    ranks = numpy.where(present, monster_ranks[indexes], 0)
+    ranks = -numpy.sort(-ranks, axis=1)
+    totals = ranks[:, 0] + (0.5 * ranks[:, 1])
+    totals = totals + (0.25 * ranks[:, 2])
+    totals = totals.astype(numpy.int64)
+    return numpy.where(broken | ~present.any(axis=1), -1, totals).tolist()
+
+
+def get_battle_formation_ranks(formation_ranks):
+    if BattleFormationObject not in COLUMN_STORES or get_numpy() is None:
+        return None
+    numpy = get_numpy()
+    store = COLUMN_STORES[BattleFormationObject]
+    formation_ids = numpy.column_stack(store.get_arrays("formation_ids"))
+    formation_ranks = numpy.array(formation_ranks, dtype=numpy.int64)
+    return formation_ranks[formation_ids].max(axis=1).tolist()
+
+
+MONSTER_RANKS = RankCache(MonsterObject, MonsterObject.compute_rank,
+                          compute_all=get_monster_ranks)
+FORMATION_RANKS = RankCache(
+    FormationObject, FormationObject.compute_rank, child=MONSTER_RANKS,
+    get_children=lambda f: get_enemy_indexes(f.enemy_ids),
+    compute_all=get_formation_ranks)
+BATTLE_FORMATION_RANKS = RankCache(
+    BattleFormationObject, BattleFormationObject.compute_rank,
+    child=FORMATION_RANKS, get_children=lambda bf: bf.formation_ids,
+    compute_all=get_battle_formation_ranks)
+RANK_CACHES = [MONSTER_RANKS, FORMATION_RANKS, BATTLE_FORMATION_RANKS]
+
+
+def get_composition(enemy_ids):
+    return tuple(sorted(enemy_ids))
+
+
+class CompositionIndex(object):
+    # Maps each sorted enemy_ids tuple to the indexes of the formations
+    # that have it, kept current as enemy_ids are reassigned.
+    def __init__(self, objtype):
+        self.objtype = objtype
+        self.reset()
+
+    def reset(self):
+        self.built = False
+        self.groups = {}
+
+    def build(self):
+        self.groups = {}
+        for o in self.objtype.every:
+            key = get_composition(o.enemy_ids)
+            self.groups.setdefault(key, set([])).add(o.index)
+        self.built = True
+
+    def update(self, obj, old_key):
+        if not self.built:
+            return
+        self.groups[old_key].discard(obj.index)
+        if not self.groups[old_key]:
+            del(self.groups[old_key])
+        key = get_composition(obj.enemy_ids)
+        self.groups.setdefault(key, set([])).add(obj.index)
+
+    def get(self, key):
+        if not self.built:
+            self.build()
+        return self.groups.get(key, set([]))
+
+
+COMPOSITIONS = CompositionIndex(FormationObject)
+
+
+class LeaderIndex(object):
+    # Maps each leader to its formations sorted by maxrank. Any change to
+    # a formation's enemies or a monster's rank drops the whole index,
+    # which is then rebuilt on the next query.
+    def __init__(self, objtype):
+        self.objtype = objtype
+        self.reset()
+
+    def reset(self):
+        self.leaders = None
+
+    def build(self):
+        self.leaders = {}
+        for o in self.objtype.every:
+            if o.leader is None:
+                continue
+            self.leaders.setdefault(o.leader.index, []).append(
+                (o.maxrank, o.index))
+        for entries in self.leaders.values():
+            entries.sort()
+
+    def get_formations(self, leader, maxrank):
+        # Formations led by leader with a maxrank of at most maxrank.
+        if leader is None:
+            return [o for o in self.objtype.every
+                    if o.leader is None and o.maxrank <= maxrank]
+        if self.leaders is None:
+            self.build()
+        entries = self.leaders.get(leader.index, [])
+        end = bisect_right(entries, (maxrank, len(self.objtype.every)))
+        return [self.objtype.get(i) for (r, i) in entries[:end]]
+
+
+LEADERS = LeaderIndex(FormationObject)
+
+
+def get_all_objects():
+    return [g for g in globals().values()
+            if isinstance(g, type) and issubclass(g, TableObject)
+            and g not in [TableObject]]
+
+
+def copy_state(state):
+    return dict((k, list(v) if isinstance(v, list) else v)
+                for (k, v) in state.items())
+
+
+def snapshot_objects(objects):
+    # Tables in column stores keep everything that changes in the columns,
+    # so only the objects of other tables are copied.
+    snapshot = {"objects": []}
+    for o in objects:
+        if not is_loaded(o) or o in COLUMN_STORES:
+            continue
+        snapshot["objects"].extend(
+            [(obj, copy_state(obj.__dict__)) for obj in o.every])
+    snapshot["world"] = World(COLUMN_STORES.values())
+    return snapshot
+
+
+def snapshot_new_table(objtype):
+    # Tables that load after the snapshot was taken are added to it as
+    # soon as they are parsed, before anything can modify them.
+    if "snapshot" in LOADED_ROM:
+        LOADED_ROM["snapshot"]["objects"].extend(
+            [(obj, copy_state(obj.__dict__)) for obj in objtype.every])
+
+
+add_load_hook(snapshot_new_table)
+
+
+def reset_class_state():
+    global chest_items
+    chest_items = None
+    ITEMS.reset()
+    FormationObject.done_bosses = set([])
+    FormationObject.unused = []
+    BattleFormationObject.num_special = 0
+    for cache in RANK_CACHES:
+        cache.reset()
+    COMPOSITIONS.reset()
+    LEADERS.reset()
+
+
+def restore_objects(snapshot):
+    with PROFILER.phase("restore"):
+        for obj, state in snapshot["objects"]:
+            obj.__dict__.clear()
+            obj.__dict__.update(copy_state(state))
+        snapshot["world"].restore()
+        reset_class_state()
+
+
+def fork_world():
+    # The state of every table, to come back to with restore_world(). With
+    # columns it takes only the tables that changed since the last world
+    # was made or restored, so many seeds can be kept in memory at once.
+    if not COLUMN_STORES:
+        raise RuntimeError("Worlds need the tables in columns.")
+    return World(COLUMN_STORES.values())
+
+
+def restore_world(world):
+    with PROFILER.phase("restore"):
+        world.restore()
+        reset_class_state()
+
+
+COLUMN_STORES = {}
+# Attributes besides the fields that change while a seed is made.
+STATE_ATTRIBUTES = ["dirty", "mutated", "special_boss"]
+
+
+def use_columns():
+    # Moves every field of every table, and the state attributes it has,
+    # into arrays as wide as the fields are in the rom, or lists for the
+    # few that are too wide. The objects are left with nothing that
+    # changes between seeds.
+    for objtype in sort_good_order(ALL_OBJECTS):
+        if objtype in COLUMN_STORES:
+            continue
+        attributes, typecodes = [], {}
+        for name, size, other in objtype.specs.attributes:
+            attributes.append(name)
+            if other in [None, "int"]:
+                typecodes[name] = INT_FORMATS.get(size)
+            else:
+                typecodes[name] = "B"
+        for attr in STATE_ATTRIBUTES:
+            if hasattr(objtype, attr):
+                attributes.append(attr)
+                typecodes[attr] = "B"
+        COLUMN_STORES[objtype] = ColumnStore(objtype, attributes, typecodes)
+
+
+def rename_demo_character():
+    if get_global_label() == "FFMQ_NA_1.1":
+        DemoPlay = CharacterObject.get(0)
+        DemoPlay.name_text = TEXT.encode("Abyssnym", length=16)
+
+
+def get_enemy_jump_address():
+    if get_global_label() == "FFMQ_NA_1.1":
+        return 0xef8e
+    elif get_global_label() == "FFMQ_JP":
+        return 0xef92
+
+
+def write_enemy_jump(image):
+    enemy_jump = get_enemy_jump_address()
+    image[enemy_jump] = 0x80
+    return (enemy_jump, enemy_jump+1)
+
+
+def write_image(image, outfile):
+    # The only place a randomized rom is written out. Accepts a filename,
+    # "-" for stdout, or anything with a write method such as a socket file.
+    if hasattr(outfile, "write"):
+        outfile.write(image)
+        return
+    if outfile == "-":
+        stdout.write(image)
+        stdout.flush()
+        return
+    f = open(outfile, "wb")
+    f.write(image)
+    f.close()
+
+
+def parse_seeds(text):
+    seeds = []
+    for part in text.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            low, high = part.split("-")
+            seeds.extend(range(int(low), int(high)+1))
+        else:
+            seeds.append(int(part))
+    return [s % (10**10) for s in seeds]
+
+
+def parse_rerolls(text):
+    # "m,t=2" rerolls the monster flag once and the treasure flag twice.
+    rerolls = {}
+    for part in (text or "").split(","):
+        part = part.strip()
+        if not part:
+            continue
+        key, _, count = part.partition("=")
+        rerolls[key.strip()] = int(count) if count else 1
+    return rerolls
+
+
+def get_seed_outfile(sourcefile, seed):
+    if "." in sourcefile:
+        tempname = sourcefile.rsplit(".", 1)
+    else:
+        tempname = [sourcefile, "smc"]
+    return ".".join([tempname[0], str(seed), tempname[1]])
+
+
+def get_stream_seed(objtype, seed, rerolls=None):
+    # Every flag's tables draw from their own stream, and tables with no
+    # flag from one each. Without a reroll the stream starts from the seed
+    # itself, as it always has. Rerolling a flag moves its streams, so the
+    # rest of the seed stays the same.
+    key = getattr(objtype, "flag", objtype.__name__)
+    reroll = (rerolls or {}).get(key, 0)
+    if not reroll:
+        return seed
+    return int(md5("%s:%s:%s" % (seed, key, reroll)).hexdigest(),
+               0x10) % (10**10)
+
+
+def get_shared_tables(objtype):
+    # What a table's mutation touches besides itself and its after_order.
+    if objtype is BattleFormationObject and "f" in get_flags():
+        # Bosses take over unused formations, which also changes their
+        # rounds and rewards, and formations track which are unused.
+        return [FormationObject, MonsterObject, BattleRoundsObject,
+                BattleRewardObject]
+    return []
+
+
+def get_checked_flags(objtype):
+    # The flags that are set and that a table's mutation checks, besides
+    # the one that turns it on.
+    if objtype is BattleFormationObject:
+        return [f for f in "ft" if f in get_flags()]
+    return []
+
+
+def get_written_tables(objtype):
+    # The tables besides its own that a table's mutation writes to.
+    if objtype is BattleFormationObject and "f" in get_flags():
+        return [FormationObject, BattleRoundsObject, BattleRewardObject]
+    return []
+
+
+def get_read_state(objtype):
+    # What a table's mutation reads besides its own records and the tables
+    # it writes to: other tables, and parts of get_mutation_state().
+    if objtype is FormationObject:
+        return [MonsterObject, BattleFormationObject, "done_bosses",
+                "unused"]
+    if objtype is BattleFormationObject and "f" in get_flags():
+        return [MonsterObject, "items", "num_special", "unused"]
+    if objtype in [BattleRewardObject, TreasureIndexObject]:
+        return ["items"]
+    return []
+
+
+def get_mutation_state():
+    # What mutating a table can leave behind outside of the tables, for the
+    # tables mutated after it.
+    return {"items": ITEMS.get_state(),
+            "done_bosses": sorted([m.index
+                                   for m in FormationObject.done_bosses]),
+            "unused": [f.index for f in FormationObject.unused],
+            "num_special": BattleFormationObject.num_special}
+
+
+def set_mutation_state(state):
+    if "items" in state:
+        ITEMS.set_state(state["items"])
+    if "done_bosses" in state:
+        FormationObject.done_bosses = set([MonsterObject.get(i)
+                                           for i in state["done_bosses"]])
+    if "unused" in state:
+        FormationObject.unused = [FormationObject.get(i)
+                                  for i in state["unused"]]
+    if "num_special" in state:
+        BattleFormationObject.num_special = state["num_special"]
+
+
+def export_states(objects):
+    return [([obj.__dict__ for obj in o.every],
+             COLUMN_STORES[o].snapshot() if o in COLUMN_STORES else None)
+            for o in objects]
+
+
+def import_states(objects, states):
+    for o, (dicts, columns) in zip(objects, states):
+        with PROFILER.phase("import", o.__name__):
+            for obj, state in zip(o.every, dicts):
+                obj.__dict__.clear()
+                obj.__dict__.update(state)
+            if columns is not None:
+                COLUMN_STORES[o].restore(columns)
+    # The ranks here were worked out before those tables changed.
+    for cache in RANK_CACHES:
+        cache.reset()
+    COMPOSITIONS.reset()
+    LEADERS.reset()
+
+
+STATE_CACHE = {}
+
+
+def use_state_cache(max_bytes=STATE_CACHE_BYTES, directory=None):
+    # Reuse mutated tables between seeds that differ only in flags that do
+    # not affect them, e.g. "cm" and then "cmf".
+    STATE_CACHE["cache"] = StateCache(max_bytes, directory)
+    STATE_CACHE["tables"] = get_tables_key(tblpath)
+    return STATE_CACHE["cache"]
+
+
+def use_stat_engine():
+    # Mutates stat tables with statengine instead of mutate_normal. Seeds
+    # made this way differ from the same seeds made without it.
+    if get_numpy() is None:
+        raise RuntimeError("The stat engine needs NumPy.")
+    STAT_ENGINE["enabled"] = True
+
+
+def mutate_objects(objects, verbose=False, rerolls=None, workers=1,
+                   hook=None, first=None):
+    # The same mutate/cleanup sequence as clean_and_write, without writing.
+    # With more than one worker, tables that after_order does not tie
+    # together are mutated in separate processes. hook(objtype) is called
+    # after each table is mutated, and the tables in first are mutated as
+    # early as their dependencies allow.
+    objects = sort_good_order(objects)
+    seed = get_seed()
+
+    cache = STATE_CACHE.get("cache")
+    cache_key = (LOADED_ROM.get("md5"), STATE_CACHE.get("tables"), VERSION,
+                 seed, sorted((rerolls or {}).items()), bool(COLUMN_STORES),
+                 bool(STAT_ENGINE))
+
+    scheduler = Scheduler([o for o in objects if not hasattr(o, "flag")
+                           or o.flag in get_flags()],
+                          get_shared=get_shared_tables)
+    # With a state cache, every table is kept as it was right after it
+    # mutated, along with the tables it writes to and what it changed
+    # outside of the tables, and restored in its turn. It is keyed by the
+    # flags it checks and, for everything it reads or writes, the keys of
+    # the tables that wrote to it before.
+    writers = {}
+    added = []
+
+    def get_key(o, tables):
+        inputs = tables + get_read_state(o)
+        return get_state_key(
+            cache_key, o.__name__, "".join(get_checked_flags(o)),
+            [(getattr(i, "__name__", i), writers.get(i, []))
+             for i in inputs])
+
+    def mutate(o):
+        if verbose and hasattr(o, "flag_description"):
+            print "Randomizing %s." % o.flag_description
+        tables = [o] + get_written_tables(o)
+        key, data = None, None
+        if cache is not None:
+            key = get_key(o, tables)
+            data = cache.get(key)
+        if data is not None:
+            states, changed = loads(data)
+            import_states(tables, states)
+            set_mutation_state(changed)
+        else:
+            before = get_mutation_state() if key is not None else None
+            with PROFILER.phase("mutate", o.__name__):
+                random.seed(get_stream_seed(o, seed, rerolls))
+                o.mutate_all()
+            if key is not None:
+                changed = dict([(k, v) for (k, v)
+                                in get_mutation_state().items()
+                                if v != before[k]])
+                data = dumps((export_states(tables), changed), 2)
+                cache.add(key, data)
+                added.append((key, data))
+        if key is not None:
+            for i in tables + changed.keys():
+                writers[i] = writers.get(i, []) + [key]
+        if hook is not None:
+            hook(o)
+
+    def export(group):
+        # States added to the cache in another process go back with it.
+        return export_states(group), added
+
+    def restore(group, result):
+        # Tables from another process count as mutated here once they are
+        # imported.
+        states, entries = result
+        import_states(group, states)
+        for key, data in entries:
+            cache.add(key, data)
+        if hook is not None:
+            for o in group:
+                if o in scheduler.objects:
+                    hook(o)
+
+    scheduler.run(mutate, workers=workers, export=export, restore=restore,
+                  first=first)
+    for o in objects:
+        if not is_loaded(o):
+            # Never loaded, so there is nothing to clean up.
+            o.cleaned = True
+            continue
+        with PROFILER.phase("cleanup", o.__name__):
+            random.seed(get_stream_seed(o, seed, rerolls))
+            o.full_cleanup()
+
+
+def get_needed_objects(objects):
+    # The tables a seed with the current flags will mutate, what they
+    # depend on through after_order, and the tables whose cleanup changes
+    # records that were not mutated. Anything else loads on first access.
+    needed = [o for o in objects
+              if not hasattr(o, "flag") or o.flag in get_flags()]
+    pending = list(needed)
+    while pending:
+        for o in getattr(pending.pop(), "after_order", []):
+            if o not in needed:
+                needed.append(o)
+                pending.append(o)
+    needed.extend([o for o in objects if o not in needed
+                   and o.cleanup.im_func is not TableObject.cleanup.im_func])
+    return [o for o in sort_good_order(objects) if o in needed]
+
+
+def load_tables(objects):
+    for o in get_needed_objects(objects):
+        if not is_loaded(o):
+            with PROFILER.phase("parse", o.__name__):
+                o.every
+
+
+def randomize_objects(objects, seed, flags, verbose=False, rerolls=None,
+                      branches=1, hook=None, first=None):
+    # Randomizes the loaded objects without writing them anywhere.
+    interface.seed = seed
+    interface.flags = flags
+    load_tables(objects)
+    random.seed(seed)
+    with PROFILER.phase("rename"):
+        rename_demo_character()
+    mutate_objects(objects, verbose=verbose, rerolls=rerolls,
+                   workers=branches, hook=hook, first=first)
+
+
+def randomize_image(objects, rom_data, seed, flags, enemy_jump=False,
+                    verbose=False, rerolls=None, branches=1):
+    # Runs the whole pipeline against an in-memory copy of the rom and
+    # returns it along with the regions that may have been modified.
+    randomize_objects(objects, seed, flags, verbose=verbose,
+                      rerolls=rerolls, branches=branches)
+    with PROFILER.phase("write_objects"):
+        image = bytearray(rom_data)
+        regions = write_objects(objects, image)
+    if get_global_label() == "FFMQ_NA_1.1":
+        with PROFILER.phase("title_screen"):
+            regions.append(write_title_screen(image, seed, flags))
+    if enemy_jump:
+        regions.append(write_enemy_jump(image))
+    with PROFILER.phase("snes_meta"):
+        regions.extend(rewrite_snes_meta(image, "FFMQ-R %s" % seed, VERSION,
+                                         megabits=24, lorom=True,
+                                         original=rom_data, regions=regions))
+    return image, regions
+
+
+def get_rom_labels():
+    labels = {}
+    for line in open(MASTERFILE):
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+        label, md5hash, tablefile = line.split()
+        labels[md5hash] = (label, tablefile)
+    return labels
+
+
+def strip_snes_header(rom_data):
+    if len(rom_data) % 0x400 == 0x200:
+        return rom_data[0x200:]
+    return rom_data
+
+
+def identify_rom(rom_data):
+    md5hash = md5(rom_data).hexdigest()
+    labels = get_rom_labels()
+    if md5hash not in labels:
+        raise ValueError("Unrecognized rom file: %s" % md5hash)
+    label, tablefile = labels[md5hash]
+    return md5hash, label, tablefile
+
+
+def get_all_flags(objects):
+    return "".join(sorted(set([o.flag for o in objects
+                               if hasattr(o, "flag")])))
+
+
+LOADED_ROM = {}
+
+
+def load_rom(rom_data, columns=False, identity=None, records=None):
+    # Identifies the rom once per process without touching the disk or the
+    # console. Tables are parsed as seeds need them, and every seed starts
+    # by restoring the snapshot of the tables parsed so far. identity and
+    # records let a caller that already knows them skip that work.
+    global ALL_OBJECTS
+    if LOADED_ROM and rom_data is LOADED_ROM["source"]:
+        identity = (LOADED_ROM["md5"], None, None)
+    source, rom_data = rom_data, strip_snes_header(rom_data)
+    if identity is None:
+        with PROFILER.phase("identify"):
+            identity = identify_rom(rom_data)
+    md5hash, label, tablefile = identity
+    if LOADED_ROM and LOADED_ROM["md5"] != md5hash:
+        raise RuntimeError("A different rom is already loaded.")
+    if not LOADED_ROM:
+        set_global_label(label)
+        set_table_specs(tablefile)
+        register_rom_data(HEADLESS_ROM, rom_data, records=records)
+        set_global_output_filename(HEADLESS_ROM)
+        ALL_OBJECTS = get_all_objects()
+        LOADED_ROM["md5"] = md5hash
+        LOADED_ROM["label"] = label
+        LOADED_ROM["tablefile"] = tablefile
+        LOADED_ROM["source"] = source
+        LOADED_ROM["rom_data"] = rom_data
+        LOADED_ROM["snapshot"] = snapshot_objects(ALL_OBJECTS)
+    if columns and not COLUMN_STORES:
+        use_columns()
+        LOADED_ROM["snapshot"] = snapshot_objects(ALL_OBJECTS)
+    return LOADED_ROM
+
+
+def randomize(rom_data, seed, flags="", enemy_jump=False, rerolls=None,
+              branches=1):
+    # Headless entry point: returns the randomized rom as a string of bytes
+    # without prompting or printing. Errors are raised, not reported.
+    loaded = load_rom(rom_data)
+    flags = flags.lower() or get_all_flags(ALL_OBJECTS)
+    seed = int(seed) % (10**10)
+    restore_objects(loaded["snapshot"])
+    image, _ = randomize_image(ALL_OBJECTS, loaded["rom_data"], seed, flags,
+                               enemy_jump=enemy_jump, rerolls=rerolls,
+                               branches=branches)
+    return str(image)
+
+
+def make_patch(seed, flags="", enemy_jump=False, rerolls=None, branches=1):
+    # Like randomize(), but for the rom that is already loaded, and the
+    # result is an IPS patch against it.
+    flags = flags.lower() or get_all_flags(ALL_OBJECTS)
+    seed = int(seed) % (10**10)
+    restore_objects(LOADED_ROM["snapshot"])
+    image, regions = randomize_image(ALL_OBJECTS, LOADED_ROM["rom_data"],
+                                     seed, flags, enemy_jump=enemy_jump,
+                                     rerolls=rerolls, branches=branches)
+    with PROFILER.phase("ips"):
+        return make_ips(LOADED_ROM["rom_data"], image, regions)
+
+
+def read_rom(sourcefile):
+    f = open(sourcefile, "rb")
+    rom_data = f.read()
+    f.close()
+    return rom_data
+
+
+def get_all_records():
+    return dict((o.__name__, get_table_records(o, LOADED_ROM["rom_data"]))
+                for o in sort_good_order(ALL_OBJECTS))
+
+
+def open_rom(sourcefile, columns=False, cache=None, verify_cache=False):
+    # Reads and loads a rom file. With a cache directory, the rom's label
+    # and parsed tables are kept there, so that later runs with the same
+    # unchanged file skip hashing and parsing. verify_cache still hashes
+    # the rom and rebuilds the entry if it does not match.
+    rom_data = read_rom(sourcefile)
+    if cache is None:
+        return load_rom(rom_data, columns=columns)
+
+    tables_key = get_tables_key(tblpath)
+    with PROFILER.phase("cache_read"):
+        entry = read_cache(cache, sourcefile, tables_key)
+    if entry is not None and verify_cache:
+        with PROFILER.phase("identify"):
+            md5hash = md5(strip_snes_header(rom_data)).hexdigest()
+        if md5hash != entry["md5"]:
+            entry = None
+    if entry is not None:
+        return load_rom(
+            rom_data, columns=columns, records=entry["records"],
+            identity=(entry["md5"], entry["label"], entry["tablefile"]))
+
+    loaded = load_rom(rom_data, columns=columns)
+    with PROFILER.phase("cache_write"):
+        write_cache(cache, sourcefile, tables_key, loaded["md5"],
+                    loaded["label"], loaded["tablefile"], get_all_records())
+    return loaded
+
+
+BATCH_STATE = {}
+
+
+def prepare_batch(sourcefile, flags, columns=False, cache=None,
+                  verify_cache=False, rerolls=None, branches=1):
+    open_rom(sourcefile, columns=columns, cache=cache,
+             verify_cache=verify_cache)
+    BATCH_STATE["sourcefile"] = sourcefile
+    BATCH_STATE["flags"] = flags.lower() or get_all_flags(ALL_OBJECTS)
+    BATCH_STATE["rerolls"] = rerolls
+    BATCH_STATE["branches"] = branches
+
+
+def batch_job(job):
+    seed, flags, enemy_jump, ips = job
+    if flags is None:
+        flags = BATCH_STATE["flags"]
+    outfile = get_seed_outfile(BATCH_STATE["sourcefile"], seed)
+    rom_data = LOADED_ROM["rom_data"]
+    restore_objects(LOADED_ROM["snapshot"])
+    image, regions = randomize_image(
+        ALL_OBJECTS, rom_data, seed, flags, enemy_jump=enemy_jump,
+        rerolls=BATCH_STATE["rerolls"], branches=BATCH_STATE["branches"])
+    if ips:
+        outfile = "%s.ips" % outfile.rsplit(".", 1)[0]
+        with PROFILER.phase("ips"):
+            patch = make_ips(rom_data, image, regions)
+        write_image(patch, outfile)
+    else:
+        write_image(image, outfile)
+    return outfile
+
+
+def run_batch(sourcefile, seeds, flags, enemy_jump=False, workers=1,
+              ips=False, columns=False, cache=None, verify_cache=False,
+              rerolls=None, branches=1):
+    prepare_batch(sourcefile, flags, columns=columns, cache=cache,
+                  verify_cache=verify_cache, rerolls=rerolls,
+                  branches=branches)
+    jobs = [(seed, None, enemy_jump, ips) for seed in seeds]
+    if workers <= 1:
+        return map(batch_job, jobs)
+
+    # The pool is created after loading so that forked workers inherit
+    # the parsed objects. Every job restores the snapshot and reseeds,
+    # so the output does not depend on which worker runs it.
+    pool = Pool(workers)
+    try:
+        chunksize = max(1, len(jobs) / (workers * 4))
+        return pool.map(batch_job, jobs, chunksize=chunksize)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def run_cli(args):
+    parser = ArgumentParser(
+        description='Final Fantasy Mystic Quest "A Terrible Secret" '
+                    'randomizer version %s.' % VERSION)
+    parser.add_argument("sourcefile")
+    parser.add_argument("--seed", default=None)
+    parser.add_argument("--seeds", default=None)
+    parser.add_argument("--flags", default="")
+    parser.add_argument("--jump", action="store_true")
+    parser.add_argument("--output", default=None)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--ips", action="store_true")
+    parser.add_argument("--columns", action="store_true")
+    parser.add_argument("--profile", action="store_true")
+    parser.add_argument("--profile-json", default=None)
+    parser.add_argument("--profile-dump", default=None)
+    parser.add_argument("--cache", default=None)
+    parser.add_argument("--verify-cache", action="store_true")
+    parser.add_argument("--clear-cache", action="store_true")
+    parser.add_argument("--state-cache", action="store_true")
+    parser.add_argument("--reroll", default=None)
+    parser.add_argument("--branches", type=int, default=1)
+    parser.add_argument("--vector-stats", action="store_true")
+    args = parser.parse_args(args)
+    try:
+        args.reroll = parse_rerolls(args.reroll)
+    except ValueError:
+        parser.error("--reroll takes flags with optional counts, e.g. m,t=2")
+    if args.clear_cache:
+        if args.cache is None:
+            parser.error("--clear-cache needs --cache")
+        clear_cache(args.cache, args.sourcefile)
+        clear_states(args.cache)
+    if args.state_cache:
+        use_state_cache(directory=args.cache)
+    if args.vector_stats:
+        try:
+            use_stat_engine()
+        except RuntimeError, e:
+            parser.error(str(e))
+    profiling = args.profile or args.profile_json or args.profile_dump
+    if profiling and args.workers > 1:
+        parser.error("profiling only works with --workers 1")
+    if profiling:
+        PROFILER.enable(use_cprofile=bool(args.profile_dump))
+    run_seeds(args)
+    if not profiling:
+        return
+
+    # The report goes to stderr, since the rom may be on stdout.
+    if args.profile:
+        print >>stderr, PROFILER.format_table()
+    if args.profile_json:
+        f = open(args.profile_json, "w")
+        f.write(PROFILER.to_json())
+        f.close()
+    if args.profile_dump:
+        hot = PROFILER.dump_hot_phase(args.profile_dump)
+        if hot is not None:
+            print >>stderr, "Profiled %s %s in %s." % (
+                hot.phase, hot.name or "", args.profile_dump)
+
+
+def run_seeds(args):
+    if args.seeds is not None:
+        run_batch(args.sourcefile, parse_seeds(args.seeds), args.flags,
+                  enemy_jump=args.jump, workers=args.workers, ips=args.ips,
+                  columns=args.columns, cache=args.cache,
+                  verify_cache=args.verify_cache, rerolls=args.reroll,
+                  branches=args.branches)
+        return
+
+    seed = args.seed
+    if seed is None:
+        seed = time()
+    seed = int(seed) % (10**10)
+    loaded = open_rom(args.sourcefile, cache=args.cache,
+                      verify_cache=args.verify_cache)
+    outfile = args.output or get_seed_outfile(args.sourcefile, seed)
+    if args.ips:
+        if args.output is None:
+            outfile = "%s.ips" % outfile.rsplit(".", 1)[0]
+        write_image(make_patch(seed, args.flags, enemy_jump=args.jump,
+                               rerolls=args.reroll, branches=args.branches),
+                    outfile)
+        return
+    write_image(randomize(loaded["source"], seed, args.flags,
+                          enemy_jump=args.jump, rerolls=args.reroll,
+                          branches=args.branches), outfile)
+
+
 if __name__ == "__main__":
+    if any([arg.startswith("--") for arg in argv[1:]]):
+        # Non-interactive mode: no prompts, and errors are not caught.
+        run_cli(argv[1:])
+        exit(0)
     try:
         print ('You are using the Final Fantasy Mystic Quest "A Terrible Secret" '
                'randomizer version %s.' % VERSION)
-        ALL_OBJECTS = [g for g in globals().values()
-                       if isinstance(g, type) and issubclass(g, TableObject)
-                       and g not in [TableObject]]
+        ALL_OBJECTS = get_all_objects()
         run_interface(ALL_OBJECTS, snes=True)
-        if get_global_label() == "FFMQ_NA_1.1":
-            DemoPlay = CharacterObject.get(0)
-            DemoPlay.name_text = [texttable[c] for c in "Abyssnym"]
-            while len(DemoPlay.name_text) < 16:
-                DemoPlay.name_text += [0x03]
         hexify = lambda x: "{0:0>2}".format("%x" % x)
         numify = lambda x: "{0: >3}".format(x)
         minmax = lambda x: (min(x), max(x))
-        clean_and_write(ALL_OBJECTS)
-        if get_global_label() == "FFMQ_NA_1.1":
-            write_title_screen(get_outfile(), get_seed(), get_flags())
-            enemy_jump = 0xef8e
-        elif get_global_label() == "FFMQ_JP":
-            enemy_jump = 0xef92
         x = raw_input("Do you want to give Benjamin the power "
                       "to jump over enemies? (y/n) ")
-        if x and x[0].lower() == 'y':
-            f = open(get_outfile(), "r+b")
-            f.seek(enemy_jump)
-            f.write(chr(0x80))
-            f.close()
-        rewrite_snes_meta("FFMQ-R", VERSION, megabits=24, lorom=True)
+        enemy_jump = bool(x and x[0].lower() == 'y')
+        f = open(get_outfile(), "rb")
+        rom_data = f.read()
+        f.close()
+        image, _ = randomize_image(ALL_OBJECTS, rom_data, get_seed(),
+                                   get_flags(), enemy_jump=enemy_jump,
+                                   verbose=True)
+        print "Saving game objects."
+        write_image(image, get_outfile())
         finish_interface()
     except Exception, e:
         print "ERROR: %s" % e
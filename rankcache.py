@@ -0,0 +1,123 @@
+from bisect import bisect_left, insort
+
+
+class RankCache(object):
+    # Memoizes the rank of every object of a table and keeps the objects
+    # sorted by (rank, index). Objects are only re-ranked after they have
+    # been invalidated, and a re-ranked object is moved within the sorted
+    # list instead of sorting the whole table again.
+    #
+    # A cache may have a child cache whose ranks its own ranks are built
+    # from, e.g. formations are ranked from their monsters. get_children
+    # returns the child indexes an object depends on; invalidating a child
+    # invalidates every object that currently depends on it.
+    #
+    # compute_all(child_ranks) may rank the whole table at once when the
+    # cache is built, given the child's ranks in index order. It returns
+    # None when it cannot, and then every object is ranked with compute.
+    def __init__(self, objtype, compute, child=None, get_children=None,
+                 compute_all=None):
+        self.objtype = objtype
+        self.compute = compute
+        self.compute_all = compute_all
+        self.child = child
+        self.get_children = get_children
+        self.parent = None
+        if child is not None:
+            child.parent = self
+        self.reset()
+
+    def reset(self):
+        self.built = False
+        self.objects = None
+        self.ranks = {}
+        self.keys = []
+        self.dirty = set([])
+        self.used_by = {}
+
+    def build(self):
+        self.objects = list(self.objtype.every)
+        assert [o.index for o in self.objects] == range(len(self.objects))
+        self.built = True
+        self.dirty = set([])
+        ranks = None
+        if self.compute_all is not None:
+            ranks = self.compute_all(
+                self.child.get_ranks() if self.child is not None else None)
+        if ranks is None:
+            ranks = [self.compute(o) for o in self.objects]
+        self.ranks = dict(enumerate(ranks))
+        self.keys = sorted((r, i) for (i, r) in self.ranks.items())
+        if self.child is not None:
+            self.child.used_by = {}
+            for o in self.objects:
+                self.link(o.index, self.get_children(o))
+
+    def link(self, index, children):
+        for c in children:
+            self.child.used_by.setdefault(c, set([])).add(index)
+
+    def unlink(self, index, children):
+        for c in children:
+            if c in self.child.used_by:
+                self.child.used_by[c].discard(index)
+
+    def invalidate(self, obj):
+        self.invalidate_index(obj.index)
+
+    def invalidate_index(self, index):
+        if not self.built or index in self.dirty:
+            return
+        self.dirty.add(index)
+        if self.parent is not None and self.parent.built:
+            for p in sorted(self.used_by.get(index, [])):
+                self.parent.invalidate_index(p)
+
+    def relink(self, obj, old_children):
+        # Called when the children of an object have been reassigned.
+        if not self.built:
+            return
+        self.unlink(obj.index, old_children)
+        self.link(obj.index, self.get_children(obj))
+        self.dirty.discard(obj.index)
+        self.invalidate(obj)
+
+    def refresh(self, index):
+        old = (self.ranks[index], index)
+        i = bisect_left(self.keys, old)
+        assert self.keys[i] == old
+        del(self.keys[i])
+        self.ranks[index] = self.compute(self.objects[index])
+        insort(self.keys, (self.ranks[index], index))
+        self.dirty.discard(index)
+
+    def get_rank(self, obj):
+        if not self.built:
+            self.build()
+        if obj.index in self.dirty:
+            self.refresh(obj.index)
+        return self.ranks[obj.index]
+
+    def get_ranks(self):
+        # Every rank, in index order.
+        if not self.built:
+            self.build()
+        for index in sorted(self.dirty):
+            self.refresh(index)
+        return [self.ranks[i] for i in xrange(len(self.objects))]
+
+    def get_ranked(self):
+        return self.get_range()
+
+    def get_range(self, lower=None, upper=None):
+        # Objects with lower <= rank < upper, in ranked order.
+        if not self.built:
+            self.build()
+        for index in sorted(self.dirty):
+            self.refresh(index)
+        start, end = 0, len(self.keys)
+        if lower is not None:
+            start = bisect_left(self.keys, (lower, -1))
+        if upper is not None:
+            end = bisect_left(self.keys, (upper, -1))
+        return [self.objects[i] for (r, i) in self.keys[start:end]]
@@ -0,0 +1,99 @@
+from hashlib import md5
+from marshal import dumps, loads
+from os import getpid, listdir, makedirs, remove, rename, stat
+from os.path import abspath, exists, join
+
+
+# Keeps what loading a rom works out -- its md5, label and parsed tables --
+# in a directory, so that later runs with the same file can skip hashing
+# and parsing. Entries are keyed by the rom's path, size and mtime, and by
+# the table specs they were parsed with. Entries are written to a
+# temporary file and renamed into place, so a reader sees either the old
+# entry or the new one, never part of one.
+
+CACHE_VERSION = 1
+CACHE_SUFFIX = ".romcache"
+
+
+def get_cache_filename(directory, romfile):
+    return join(directory, "%s%s" % (md5(abspath(romfile)).hexdigest(),
+                                     CACHE_SUFFIX))
+
+
+def get_rom_key(romfile):
+    s = stat(romfile)
+    return [abspath(romfile), s.st_size, s.st_mtime]
+
+
+def get_tables_key(tblpath):
+    key = []
+    for filename in sorted(listdir(tblpath)):
+        s = stat(join(tblpath, filename))
+        key.append([filename, s.st_size, s.st_mtime])
+    return key
+
+
+def read_cache(directory, romfile, tables_key):
+    # Returns the entry for the rom, or None if there is no usable one.
+    filename = get_cache_filename(directory, romfile)
+    if not exists(filename):
+        return None
+    try:
+        f = open(filename, "rb")
+        try:
+            entry = loads(f.read())
+        finally:
+            f.close()
+    except (IOError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(entry, dict) or entry.get("version") != CACHE_VERSION:
+        return None
+    if (entry.get("rom") != get_rom_key(romfile)
+            or entry.get("tables") != tables_key):
+        return None
+    return entry
+
+
+def write_cache(directory, romfile, tables_key, md5hash, label, tablefile,
+                records):
+    if not exists(directory):
+        try:
+            makedirs(directory)
+        except OSError:
+            # Another process may have just created it.
+            if not exists(directory):
+                raise
+    entry = {"version": CACHE_VERSION,
+             "rom": get_rom_key(romfile),
+             "tables": tables_key,
+             "md5": md5hash,
+             "label": label,
+             "tablefile": tablefile,
+             "records": records}
+    filename = get_cache_filename(directory, romfile)
+    tempname = "%s.%s.tmp" % (filename, getpid())
+    f = open(tempname, "wb")
+    f.write(dumps(entry))
+    f.close()
+    try:
+        rename(tempname, filename)
+    except OSError:
+        # Windows will not rename over an existing file.
+        if exists(filename):
+            remove(filename)
+        rename(tempname, filename)
+    return entry
+
+
+def clear_cache(directory, romfile=None):
+    # Removes the entry for one rom, or every entry in the directory.
+    if not exists(directory):
+        return
+    if romfile is not None:
+        filenames = [get_cache_filename(directory, romfile)]
+    else:
+        filenames = [join(directory, f) for f in listdir(directory)
+                     if f.endswith(CACHE_SUFFIX)]
+    for filename in filenames:
+        if exists(filename):
+            remove(filename)
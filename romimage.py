@@ -0,0 +1,382 @@
+from os import stat
+from struct import Struct
+
+from randomtools.utils import classproperty
+
+
+IPS_HEADER = "PATCH"
+IPS_FOOTER = "EOF"
+IPS_EOF_OFFSET = 0x454F46
+IPS_MAX_RECORD = 0xFFFF
+IPS_MERGE_GAP = 5
+
+
+INT_FORMATS = {1: "B", 2: "H", 4: "I"}
+LAYOUTS = {}
+ROM_DATA = {}
+LOAD_HOOKS = []
+ROM_SUMS = {}
+
+
+def int_to_bytes(value, length):
+    assert value >= 0
+    data = []
+    for _ in xrange(length):
+        data.append(value & 0xFF)
+        value >>= 8
+    assert not value
+    return data
+
+
+def bytes_to_int(data):
+    value = 0
+    for c in reversed(data):
+        value = (value << 8) | ord(c)
+    return value
+
+
+class TableLayout(object):
+    # A table spec compiled into a struct format, so that whole tables can
+    # be decoded and encoded with a single call.
+    def __init__(self, attributes, tablename="table"):
+        formats = []
+        self.fields = []
+        for name, size, other in attributes:
+            if other in [None, "int"] and size in INT_FORMATS:
+                formats.append(INT_FORMATS[size])
+                self.fields.append((name, size, None))
+            elif other in [None, "int", "str", "list"]:
+                formats.append("%ss" % size)
+                self.fields.append((name, size, other or "int"))
+            else:
+                raise ValueError("%s field %s has unsupported type %s." % (
+                    tablename, name, other))
+        self.record_format = "".join(formats)
+        self.size = Struct("<" + self.record_format).size
+        self.structs = {}
+
+    def get_struct(self, count):
+        if count not in self.structs:
+            self.structs[count] = Struct("<" + (self.record_format * count))
+        return self.structs[count]
+
+    def unpack(self, data, pointer, count=1):
+        values = self.get_struct(count).unpack_from(data, pointer)
+        numfields = len(self.fields)
+        records = []
+        for i in xrange(count):
+            record = []
+            for (name, size, other), value in zip(
+                    self.fields, values[i*numfields:(i+1)*numfields]):
+                if other == "int":
+                    value = bytes_to_int(value)
+                elif other == "list":
+                    value = list(bytearray(value))
+                record.append((name, value))
+            records.append(record)
+        return records
+
+    def pack(self, objects):
+        values = []
+        for obj in objects:
+            for name, size, other in self.fields:
+                value = getattr(obj, name)
+                if other == "int":
+                    value = str(bytearray(int_to_bytes(value, size)))
+                elif other == "list":
+                    assert len(value) == size
+                    value = str(bytearray(value))
+                elif other == "str":
+                    assert len(value) == size
+                values.append(value)
+        return self.get_struct(len(objects)).pack(*values)
+
+
+def get_layout(objtype):
+    key = objtype.__name__
+    if key not in LAYOUTS:
+        LAYOUTS[key] = TableLayout(objtype.specs.attributes,
+                                   tablename=key)
+    return LAYOUTS[key]
+
+
+def register_rom_data(name, data, records=None):
+    # Lets tables be read from rom data that was never written to disk.
+    # Records from get_table_records() can be passed in so that those
+    # tables are not unpacked again.
+    ROM_DATA[name] = {"data": data}
+    for objname, table in (records or {}).items():
+        ROM_DATA[name][objname] = dict(table)
+
+
+def get_rom_data(filename):
+    if filename in ROM_DATA:
+        return ROM_DATA[filename]
+    s = stat(filename)
+    key = (filename, s.st_size, s.st_mtime)
+    if key not in ROM_DATA:
+        for k in [k for k in ROM_DATA
+                  if isinstance(k, tuple) and k[0] == filename]:
+            del(ROM_DATA[k])
+        f = open(filename, "rb")
+        ROM_DATA[key] = {"data": f.read()}
+        f.close()
+    return ROM_DATA[key]
+
+
+def is_loaded(objtype):
+    return "every" in objtype.__dict__
+
+
+def add_load_hook(hook):
+    # hook(objtype) is called once for every table, right after it loads.
+    LOAD_HOOKS.append(hook)
+
+
+def get_table_records(objtype, data):
+    # Unpacks a whole table, as {pointer: [(name, value), ...]}. Pointed
+    # tables are read object by object instead.
+    specs = objtype.specs
+    records = {}
+    if not getattr(specs, "pointed", False):
+        layout = get_layout(objtype)
+        unpacked = layout.unpack(data, specs.pointer, specs.count)
+        for i, record in enumerate(unpacked):
+            records[specs.pointer + (i * layout.size)] = record
+    return records
+
+
+class TableLayoutMixin(object):
+    # Decodes the whole table region on the first read, then hands each
+    # object its record instead of seeking and reading field by field.
+    #
+    # Tables are parsed on first access. The parsed list is then stored on
+    # the class itself, which shadows this property from then on.
+    #
+    # Setting a field to something other than what was read marks the
+    # object dirty, so that only records that may have changed are written
+    # back. old_data keeps its own copy of list fields, so that lists that
+    # are changed in place can be told apart from what was read. dirty and
+    # randomtools' mutated are plain attributes that default to False
+    # here, so snapshots and column stores carry them like fields.
+    dirty = False
+    mutated = False
+
+    @classproperty
+    def every(cls):
+        objs = super(TableLayoutMixin, cls).every
+        cls.every = objs
+        for hook in LOAD_HOOKS:
+            hook(cls)
+        return objs
+
+    @classmethod
+    def get(cls, index):
+        cls.every
+        return super(TableLayoutMixin, cls).get(index)
+
+    def __setattr__(self, name, value):
+        super(TableLayoutMixin, self).__setattr__(name, value)
+        old_data = self.__dict__.get("old_data")
+        if old_data and name in old_data and value != old_data[name]:
+            super(TableLayoutMixin, self).__setattr__("dirty", True)
+
+    def read_data(self, filename=None, pointer=None):
+        if pointer is None:
+            pointer = self.pointer
+        if pointer is None:
+            return
+        if filename is None:
+            filename = self.filename
+        objtype = type(self)
+        layout = get_layout(objtype)
+        rom = get_rom_data(filename)
+        if objtype.__name__ not in rom:
+            rom[objtype.__name__] = get_table_records(objtype, rom["data"])
+        records = rom[objtype.__name__]
+        if pointer in records:
+            record = records.pop(pointer)
+        else:
+            record = layout.unpack(rom["data"], pointer)[0]
+        self.old_data = {}
+        for name, value in record:
+            setattr(self, name, value)
+            if isinstance(value, list):
+                value = list(value)
+            self.old_data[name] = value
+        super(TableLayoutMixin, self).__setattr__("dirty", False)
+
+    def has_changed(self):
+        # Lists can also be changed in place, which __setattr__ never sees,
+        # so they are compared with what was read.
+        if self.dirty:
+            return True
+        return any([getattr(self, name) != value
+                    for (name, value) in self.old_data.items()
+                    if isinstance(value, list)])
+
+
+def write_objects(objects, image):
+    # Serializes the changed objects of every table into the in-memory image
+    # at the address they were read from, one run of consecutive records at
+    # a time, skipping runs whose bytes did not change. Returns the regions
+    # written, with touching regions joined. Tables that were never loaded
+    # still match the rom.
+    regions = []
+    for o in objects:
+        if not is_loaded(o):
+            continue
+        objs = [obj for obj in o.every if obj.pointer is not None]
+        if issubclass(o, TableLayoutMixin):
+            objs = [obj for obj in objs if obj.has_changed()]
+        if not objs:
+            continue
+        layout = get_layout(o)
+        runs = []
+        for obj in objs:
+            if runs and obj.pointer == runs[-1][-1].pointer + layout.size:
+                runs[-1].append(obj)
+            else:
+                runs.append([obj])
+        for run in runs:
+            data = layout.pack(run)
+            start, end = run[0].pointer, run[0].pointer + len(data)
+            if image[start:end] != data:
+                image[start:end] = data
+                regions.append((start, end))
+    return merge_regions(regions)
+
+
+def merge_regions(regions, gap=0):
+    # Joins regions that overlap or are at most gap bytes apart.
+    merged = []
+    for start, end in sorted(regions):
+        if merged and start <= merged[-1][1] + gap:
+            merged[-1] = (merged[-1][0], max(end, merged[-1][1]))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def rewrite_snes_title(image, text, version, lorom=False):
+    while len(text) < 20:
+        text += ' '
+    if len(text) > 20:
+        text = text[:19] + "?"
+    mask = 0x7FFF if lorom else 0xFFFF
+    image[0xFFC0 & mask:(0xFFC0 & mask)+20] = bytearray(text)
+    image[0xFFDB & mask] = int(version)
+    return (0xFFC0 & mask, (0xFFDB & mask)+1)
+
+
+def get_rom_sum(data, length):
+    # The sum of the first length bytes of the rom. Every seed starts from
+    # the same rom, so the last sum is kept along with the data it is for.
+    if ROM_SUMS.get(length, (None, None))[0] is not data:
+        ROM_SUMS[length] = (data, sum(bytearray(data[:length])))
+    return ROM_SUMS[length][1]
+
+
+def rewrite_snes_checksum(image, megabits=24, lorom=False, original=None,
+                          regions=None):
+    # Sums the same bytes as randomtools' rewrite_snes_checksum reads from
+    # the written rom: the first megabits of it, or all of it if it is
+    # shorter, with no padding. tests/test_romimage.py compares the two.
+    #
+    # Given the rom the image was made from and the regions where they may
+    # differ, only those regions are summed again. That includes the old
+    # checksum bytes, which are still in the image while it is summed.
+    length = megabits * 0x20000
+    if original is None or regions is None or len(original) != len(image):
+        checksum = sum(image[:length])
+    else:
+        checksum = get_rom_sum(original, length)
+        for start, end in merge_regions(regions):
+            start, end = min(start, length), min(end, length)
+            checksum += (sum(image[start:end])
+                         - sum(bytearray(original[start:end])))
+    checksum &= 0xFFFF
+    mask = 0x7FFF if lorom else 0xFFFF
+    image[0xFFDE & mask:(0xFFDE & mask)+2] = bytearray(
+        int_to_bytes(checksum, 2))
+    image[0xFFDC & mask:(0xFFDC & mask)+2] = bytearray(
+        int_to_bytes(checksum ^ 0xFFFF, 2))
+    return (0xFFDC & mask, (0xFFDE & mask)+2)
+
+
+def rewrite_snes_meta(image, title, version, megabits=24, lorom=False,
+                      original=None, regions=None):
+    title = rewrite_snes_title(image, title, version, lorom=lorom)
+    if regions is not None:
+        regions = regions + [title]
+    return merge_regions([title, rewrite_snes_checksum(
+        image, megabits=megabits, lorom=lorom, original=original,
+        regions=regions)])
+
+
+def get_changes(original, modified, regions=None):
+    # Yields (offset, data) runs where the two images differ, only looking
+    # inside the given regions. Runs separated by fewer bytes than an IPS
+    # record header are joined into one.
+    if not isinstance(original, bytearray):
+        original = bytearray(original)
+    if regions is None:
+        regions = [(0, len(modified))]
+    # Regions closer than the gap that joins runs are scanned as one, so
+    # the runs do not depend on how the regions were split.
+    for start, end in merge_regions(regions, gap=IPS_MERGE_GAP):
+        runstart = None
+        gap = 0
+        for i in xrange(start, min(end, len(modified))):
+            same = i < len(original) and original[i] == modified[i]
+            if runstart is None:
+                if not same:
+                    runstart, gap = i, 0
+                continue
+            if same:
+                gap += 1
+                if gap > IPS_MERGE_GAP:
+                    yield runstart, modified[runstart:i+1-gap]
+                    runstart = None
+            else:
+                gap = 0
+        if runstart is not None:
+            yield runstart, modified[runstart:min(end, len(modified))-gap]
+
+
+def make_ips(original, modified, regions=None):
+    data = [IPS_HEADER]
+    for offset, run in get_changes(original, modified, regions):
+        if offset == IPS_EOF_OFFSET:
+            offset -= 1
+            run = modified[offset:offset+1] + run
+        while run:
+            chunk, run = run[:IPS_MAX_RECORD], run[IPS_MAX_RECORD:]
+            data.append(str(bytearray(int_to_bytes(offset, 3)[::-1])))
+            data.append(str(bytearray(int_to_bytes(len(chunk), 2)[::-1])))
+            data.append(str(chunk))
+            offset += len(chunk)
+    data.append(IPS_FOOTER)
+    return "".join(data)
+
+
+def apply_ips(original, patch):
+    assert patch[:len(IPS_HEADER)] == IPS_HEADER
+    image = bytearray(original)
+    patch = bytearray(patch)
+    i = len(IPS_HEADER)
+    while str(patch[i:i+3]) != IPS_FOOTER:
+        offset = (patch[i] << 16) | (patch[i+1] << 8) | patch[i+2]
+        size = (patch[i+3] << 8) | patch[i+4]
+        i += 5
+        if size:
+            run = patch[i:i+size]
+            i += size
+        else:
+            size = (patch[i] << 8) | patch[i+1]
+            run = patch[i+2:i+3] * size
+            i += 3
+        if offset + size > len(image):
+            image.extend(bytearray(offset + size - len(image)))
+        image[offset:offset+size] = run
+    return image
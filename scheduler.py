@@ -0,0 +1,122 @@
+from cPickle import dumps, loads
+from sys import stdout
+import os
+
+
+class Scheduler(object):
+    # Runs a task for every table class in an order that respects their
+    # after_order dependencies. Classes that after_order does not connect,
+    # directly or through other classes, form separate branches. Branches
+    # share no state, so they can run in separate processes: each forked
+    # worker exports the state of its classes when it is done, and the
+    # parent imports it. get_shared returns the classes a class reads or
+    # writes while mutating that after_order does not mention; they join
+    # its branch whether or not they are mutated themselves.
+    def __init__(self, objects, get_shared=None):
+        # objects must already be in a valid serial order.
+        self.objects = list(objects)
+        self.depends = {}
+        self.shared = {}
+        for i, o in enumerate(self.objects):
+            self.depends[o] = [o2 for o2 in getattr(o, "after_order", [])
+                               if o2 in self.objects]
+            for o2 in self.depends[o]:
+                if self.objects.index(o2) > i:
+                    raise ValueError("%s must run after %s." % (
+                        o.__name__, o2.__name__))
+            self.shared[o] = list(get_shared(o)) if get_shared else []
+        self.members = list(self.objects)
+        for o in self.objects:
+            self.members.extend([o2 for o2 in self.shared[o]
+                                 if o2 not in self.members])
+
+    def get_branches(self):
+        # Each branch lists its classes in serial order, followed by the
+        # shared classes that are not mutated.
+        group = dict((o, o) for o in self.members)
+
+        def find(o):
+            while group[o] is not o:
+                o = group[o]
+            return o
+
+        for o in self.objects:
+            for o2 in self.depends[o] + self.shared[o]:
+                group[find(o2)] = find(o)
+        branches = {}
+        for o in self.members:
+            branches.setdefault(find(o), []).append(o)
+        return sorted(branches.values(),
+                      key=lambda b: self.members.index(b[0]))
+
+    def run(self, task, workers=1, export=None, restore=None, first=None):
+        # Branches with any of the classes in first run before the others.
+        branches = self.get_branches()
+        if first:
+            branches = sorted(branches, key=lambda b: not (set(b) & first))
+        if workers <= 1 or len(branches) <= 1 or not hasattr(os, "fork"):
+            if first:
+                # Branches are independent, so they can run one by one.
+                for branch in branches:
+                    for o in branch:
+                        if o in self.objects:
+                            task(o)
+                return
+            for o in self.objects:
+                task(o)
+            return
+
+        # The largest branch stays in this process, the others are split
+        # between the remaining workers.
+        main = max(branches, key=len)
+        others = [b for b in branches if b is not main]
+        numgroups = min(workers - 1, len(others))
+        groups = [sorted(sum(others[i::numgroups], []),
+                         key=self.members.index)
+                  for i in xrange(numgroups)]
+        stdout.flush()
+        children = [(self.fork(task, group, export), group)
+                    for group in groups]
+        for o in main:
+            if o in self.objects:
+                task(o)
+
+        errors = []
+        for (pid, read), group in children:
+            f = os.fdopen(read, "rb")
+            data = f.read()
+            f.close()
+            os.waitpid(pid, 0)
+            if not data:
+                errors.append("Worker %s exited without a result." % pid)
+                continue
+            success, result = loads(data)
+            if success:
+                restore(group, result)
+            else:
+                errors.append(result)
+        if errors:
+            raise RuntimeError(" ".join(errors))
+
+    def fork(self, task, group, export):
+        read, write = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(write)
+            return pid, read
+
+        try:
+            os.close(read)
+            try:
+                for o in group:
+                    if o in self.objects:
+                        task(o)
+                result = (True, export(group))
+            except Exception, e:
+                result = (False, "%s: %s" % (type(e).__name__, e))
+            f = os.fdopen(write, "wb")
+            f.write(dumps(result, 2))
+            f.close()
+            stdout.flush()
+        finally:
+            os._exit(0)
@@ -0,0 +1,218 @@
+from argparse import ArgumentParser
+from itertools import izip
+from multiprocessing import Pool, cpu_count
+from sys import argv, stderr
+from time import time
+
+import randomizer
+from randomizer import (
+    BATCH_STATE, LOADED_ROM, BattleRewardObject, BattleFormationObject,
+    TreasureIndexObject, MonsterObject, prepare_batch, restore_objects,
+    randomize_objects, parse_seeds, get_item_names)
+from seedstats import is_boss_battlefield
+
+
+# Looks for seeds with given properties. Each predicate is tied to the
+# table whose mutation settles what it looks at, and is tested as soon as
+# that table is done. Those tables are mutated first, so a seed that fails
+# is dropped before most of it is made. Every predicate is tested again
+# once the seed is finished.
+
+SEEDS = "1-100000"
+CHUNK_SIZE = 20
+SEARCH = {}
+
+
+class SeedRejected(Exception):
+    pass
+
+
+class Predicate(object):
+    # test() looks at the current objects. after names the table that
+    # settles them, or is None if only the finished seed can tell.
+    def __init__(self, description, test, after=None):
+        self.description = description
+        self.test = test
+        self.after = after
+
+    def __repr__(self):
+        return self.description
+
+
+def get_item(name):
+    names = [n.lower() for n in get_item_names()]
+    if name.lower() not in names:
+        raise ValueError("Unknown item: %s" % name)
+    return names.index(name.lower())
+
+
+def reward_predicate(item, battlefield=None):
+    def test():
+        if battlefield is None:
+            rewards = BattleRewardObject.every
+        else:
+            rewards = [BattleRewardObject.get(battlefield)]
+        return any([br.is_item and (br.reward & 0xFF) == item
+                    for br in rewards])
+    where = "a battlefield" if battlefield is None else (
+        "battlefield %s" % battlefield)
+    return Predicate("%s is the reward of %s" % (
+        get_item_names()[item], where), test, after="BattleRewardObject")
+
+
+def chest_predicate(item):
+    def test():
+        return any([t.contents == item for t in TreasureIndexObject.every])
+    return Predicate("%s is in a chest" % get_item_names()[item], test,
+                     after="TreasureIndexObject")
+
+
+def boss_predicate(battlefield):
+    def test():
+        return is_boss_battlefield(BattleFormationObject.get(battlefield))
+    return Predicate("battlefield %s is a boss fight" % battlefield, test,
+                     after="BattleFormationObject")
+
+
+def hp_predicate(index, minimum=None, maximum=None):
+    def test():
+        hp = MonsterObject.get(index).hp
+        return ((minimum is None or hp > minimum)
+                and (maximum is None or hp < maximum))
+    bounds = " and ".join(
+        [s for s in ["above %s" % minimum if minimum is not None else "",
+                     "below %s" % maximum if maximum is not None else ""]
+         if s])
+    return Predicate("monster %x has hp %s" % (index, bounds), test,
+                     after="MonsterObject")
+
+
+def parse_predicate(text):
+    # reward:ITEM, reward:ITEM@BATTLEFIELD, chest:ITEM, boss:BATTLEFIELD,
+    # hp:INDEX>VALUE or hp:INDEX<VALUE, with the monster index in hex.
+    kind, _, value = text.partition(":")
+    kind = kind.strip().lower()
+    if kind == "reward":
+        item, _, battlefield = value.partition("@")
+        return reward_predicate(
+            get_item(item.strip()),
+            int(battlefield) if battlefield.strip() else None)
+    if kind == "chest":
+        return chest_predicate(get_item(value.strip()))
+    if kind == "boss":
+        return boss_predicate(int(value))
+    if kind == "hp":
+        for op in "<>":
+            if op in value:
+                index, threshold = value.split(op)
+                index, threshold = int(index, 0x10), int(threshold)
+                if op == ">":
+                    return hp_predicate(index, minimum=threshold)
+                return hp_predicate(index, maximum=threshold)
+    raise ValueError("Unknown requirement: %s" % text)
+
+
+def check_seed(seed, flags, predicates):
+    restore_objects(LOADED_ROM["snapshot"])
+    early = {}
+    for p in predicates:
+        if p.after is not None:
+            early.setdefault(p.after, []).append(p)
+
+    def hook(objtype):
+        for p in early.get(objtype.__name__, []):
+            if not p.test():
+                raise SeedRejected(p)
+
+    first = set([getattr(randomizer, name) for name in early])
+    try:
+        randomize_objects(randomizer.ALL_OBJECTS, seed, flags, hook=hook,
+                          first=first)
+    except SeedRejected:
+        return False
+    return all([p.test() for p in predicates])
+
+
+def search_seeds(seeds):
+    return [seed for seed in seeds
+            if check_seed(seed, BATCH_STATE["flags"], SEARCH["predicates"])]
+
+
+def run_search(sourcefile, seeds, flags, predicates, limit=1, workers=1,
+               cache=None, progress=False):
+    # Returns the first matches in the order of seeds, whatever the number
+    # of workers, and how many seeds were tried. Predicates can be given as
+    # text, since item names are only known once the rom is loaded.
+    prepare_batch(sourcefile, flags, cache=cache)
+    predicates = [parse_predicate(p) if isinstance(p, basestring) else p
+                  for p in predicates]
+    # Set before the pool forks, since predicates do not pickle.
+    SEARCH["predicates"] = predicates
+    chunks = [seeds[i:i+CHUNK_SIZE] for i in xrange(0, len(seeds),
+                                                      CHUNK_SIZE)]
+    if workers <= 1:
+        pool = None
+        results = (search_seeds(chunk) for chunk in chunks)
+    else:
+        # Created after loading so that the workers inherit the objects.
+        pool = Pool(workers)
+        results = pool.imap(search_seeds, chunks)
+    found, tried = [], 0
+    try:
+        # izip, so that no chunk is asked for after the limit is reached.
+        for chunk, matches in izip(chunks, results):
+            found.extend(matches)
+            tried += len(chunk)
+            if progress:
+                stderr.write("\r%s seeds tried, %s found" % (tried,
+                                                             len(found)))
+            if len(found) >= limit:
+                break
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    if progress:
+        stderr.write("\n")
+    if len(found) > limit:
+        tried = seeds.index(found[limit-1]) + 1
+    return found[:limit], tried
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Find seeds that meet some requirements.")
+    parser.add_argument("sourcefile")
+    parser.add_argument("--seeds", default=SEEDS)
+    parser.add_argument("--flags", default="")
+    parser.add_argument("--require", action="append", default=[],
+                        help="reward:ITEM[@BATTLEFIELD], chest:ITEM, "
+                             "boss:BATTLEFIELD, hp:INDEX>VALUE or "
+                             "hp:INDEX<VALUE")
+    parser.add_argument("--limit", type=int, default=1)
+    parser.add_argument("--workers", type=int, default=cpu_count())
+    parser.add_argument("--cache", default=None)
+    parser.add_argument("--vector-stats", action="store_true")
+    args = parser.parse_args(argv[1:])
+    if args.vector_stats:
+        try:
+            randomizer.use_stat_engine()
+        except RuntimeError, e:
+            parser.error(str(e))
+    if not args.require:
+        parser.error("at least one --require is needed")
+
+    start = time()
+    try:
+        found, tried = run_search(
+            args.sourcefile, parse_seeds(args.seeds), args.flags,
+            args.require, limit=args.limit, workers=args.workers,
+            cache=args.cache, progress=True)
+    except ValueError, e:
+        parser.error(str(e))
+    for r in args.require:
+        print "Required: %s" % parse_predicate(r)
+    for seed in found:
+        print seed
+    print "Found %s of %s in %s seeds (%.1f s)." % (
+        len(found), args.limit, tried, time() - start)
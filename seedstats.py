@@ -0,0 +1,229 @@
+from argparse import ArgumentParser
+from array import array
+from collections import Counter
+from json import dumps
+from multiprocessing import Pool, cpu_count
+from sys import argv, stderr
+from time import time
+
+import randomizer
+from randomizer import (
+    BATCH_STATE, LOADED_ROM, DESIRABLE_ITEMS, CONSUMABLES,
+    TreasureIndexObject, BattleRewardObject, BattleFormationObject,
+    FormationObject, CharacterObject, prepare_batch, restore_objects,
+    randomize_objects, parse_seeds, get_item_names)
+from columns import get_numpy
+
+
+# Randomizes many seeds in memory, without writing roms, and reports how
+# the results are distributed. Each worker process gathers its seeds into
+# a SeedStats, and the parent merges them.
+
+SEEDS = "1-1000"
+CHUNK_SIZE = 25
+PERCENTILES = [0, 5, 25, 50, 75, 95, 100]
+PLACES = ["chest", "hidden", "reward", "boss", "none"]
+CHARACTER_STATS = ["max_hp", "attack", "defense", "speed", "magic",
+                   "accuracy", "white", "black", "wizard"]
+MAX_SPECIAL = 5
+
+
+def is_boss_battlefield(bf):
+    return any([f.special_boss for f in bf.formations])
+
+
+def get_placements():
+    # Where each desirable item ended up in the current seed. Hidden items
+    # are in chests that held consumables, boss items are the rewards of
+    # battlefields that became boss fights.
+    places = {}
+    for t in TreasureIndexObject.every:
+        if t.contents in DESIRABLE_ITEMS:
+            hidden = t.old_data["contents"] in CONSUMABLES
+            places.setdefault(t.contents, set()).add(
+                "hidden" if hidden else "chest")
+    for br in BattleRewardObject.every:
+        if br.is_item and (br.reward & 0xFF) in DESIRABLE_ITEMS:
+            boss = is_boss_battlefield(BattleFormationObject.get(br.index))
+            places.setdefault(br.reward & 0xFF, set()).add(
+                "boss" if boss else "reward")
+    return places
+
+
+def get_percentiles(values, percentiles=PERCENTILES):
+    # Nearest rank percentiles.
+    if not values:
+        return [None] * len(percentiles)
+    numpy = get_numpy()
+    if numpy is not None:
+        values = numpy.sort(numpy.array(values))
+    else:
+        values = sorted(values)
+    return [float(values[int(round((len(values) - 1) * p / 100.0))])
+            for p in percentiles]
+
+
+class SeedStats(object):
+    # Values are kept in typed arrays and counters, so that tens of
+    # thousands of seeds fit in memory and travel quickly between
+    # processes.
+    def __init__(self):
+        self.seeds = 0
+        self.places = dict((i, Counter()) for i in DESIRABLE_ITEMS)
+        self.formation_ranks = array("d")
+        self.battle_formation_ranks = array("d")
+        self.num_special = Counter()
+        self.character_stats = dict((attr, array("l"))
+                                    for attr in CHARACTER_STATS)
+
+    def add_seed(self):
+        self.seeds += 1
+        places = get_placements()
+        for item in DESIRABLE_ITEMS:
+            for place in places.get(item, ["none"]):
+                self.places[item][place] += 1
+        self.formation_ranks.extend([f.rank for f in FormationObject.every
+                                     if f.rank >= 0])
+        self.battle_formation_ranks.extend(
+            [bf.rank for bf in BattleFormationObject.every])
+        self.num_special[len([bf for bf in BattleFormationObject.every[:20]
+                              if is_boss_battlefield(bf)])] += 1
+        for c in CharacterObject.every:
+            for attr in CHARACTER_STATS:
+                self.character_stats[attr].append(getattr(c, attr))
+
+    def merge(self, other):
+        self.seeds += other.seeds
+        for item, places in other.places.items():
+            self.places[item].update(places)
+        self.formation_ranks.extend(other.formation_ranks)
+        self.battle_formation_ranks.extend(other.battle_formation_ranks)
+        self.num_special.update(other.num_special)
+        for attr, values in other.character_stats.items():
+            self.character_stats[attr].extend(values)
+
+    def get_summary(self):
+        names = get_item_names()
+        summary = {"seeds": self.seeds, "percentiles": PERCENTILES}
+        summary["items"] = dict(
+            (names[i], dict((p, self.places[i][p]) for p in PLACES))
+            for i in DESIRABLE_ITEMS)
+        summary["ranks"] = {
+            "formation": get_percentiles(self.formation_ranks),
+            "battle_formation": get_percentiles(self.battle_formation_ranks)}
+        summary["num_special"] = dict(self.num_special)
+        summary["characters"] = dict(
+            (attr, get_percentiles(values))
+            for (attr, values) in self.character_stats.items())
+        return summary
+
+
+def gather_seeds(seeds):
+    stats = SeedStats()
+    for seed in seeds:
+        restore_objects(LOADED_ROM["snapshot"])
+        randomize_objects(randomizer.ALL_OBJECTS, seed, BATCH_STATE["flags"])
+        stats.add_seed()
+    return stats
+
+
+def run_stats(sourcefile, seeds, flags, workers=1, columns=False,
+              cache=None, progress=False):
+    prepare_batch(sourcefile, flags, columns=columns, cache=cache)
+    chunks = [seeds[i:i+CHUNK_SIZE] for i in xrange(0, len(seeds),
+                                                      CHUNK_SIZE)]
+    stats = SeedStats()
+    if workers <= 1:
+        results = (gather_seeds(chunk) for chunk in chunks)
+        pool = None
+    else:
+        # Created after loading so that the workers inherit the objects.
+        pool = Pool(workers)
+        results = pool.imap_unordered(gather_seeds, chunks)
+    try:
+        for result in results:
+            stats.merge(result)
+            if progress:
+                stderr.write("\r%s/%s seeds" % (stats.seeds, len(seeds)))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    if progress:
+        stderr.write("\n")
+    return stats
+
+
+def format_value(value):
+    if value is None:
+        return "-"
+    if abs(value) >= 10**7:
+        return "%.3e" % value
+    return "%.0f" % value
+
+
+def format_summary(summary, flags, elapsed=None):
+    lines = ["%s seeds, flags %s%s" % (
+        summary["seeds"], flags or "(all)",
+        ", %.1f s" % elapsed if elapsed is not None else "")]
+    seeds = float(summary["seeds"]) or 1
+    lines.append("")
+    lines.append("Items can end up in more than one place.")
+    lines.append("%-16s" % "ITEM" + "".join(["%8s" % p.upper()
+                                             for p in PLACES]))
+    for name, places in sorted(summary["items"].items()):
+        lines.append("%-16s" % name + "".join(
+            ["%7.1f%%" % (100 * places[p] / seeds) for p in PLACES]))
+
+    lines.append("")
+    header = "%-22s" % "PERCENTILE" + "".join(
+        ["%12s" % ("P%s" % p) for p in summary["percentiles"]])
+    lines.append(header)
+    rows = [("formation rank", summary["ranks"]["formation"]),
+            ("battle formation rank", summary["ranks"]["battle_formation"])]
+    rows += [("character %s" % attr, summary["characters"][attr])
+             for attr in CHARACTER_STATS]
+    for label, values in rows:
+        lines.append("%-22s" % label + "".join(
+            ["%12s" % format_value(v) for v in values]))
+
+    lines.append("")
+    lines.append("BOSS BATTLEFIELDS (num_special)")
+    for count in sorted(summary["num_special"]):
+        lines.append("%4s %7.1f%%" % (
+            count, 100 * summary["num_special"][count] / seeds))
+    lines.append("%s or more: %.1f%%" % (MAX_SPECIAL, 100 * sum(
+        [n for (count, n) in summary["num_special"].items()
+         if count >= MAX_SPECIAL]) / seeds))
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(
+        description="Gather statistics over many seeds, without writing "
+                    "roms.")
+    parser.add_argument("sourcefile")
+    parser.add_argument("--seeds", default=SEEDS)
+    parser.add_argument("--flags", default="")
+    parser.add_argument("--workers", type=int, default=cpu_count())
+    parser.add_argument("--columns", action="store_true")
+    parser.add_argument("--cache", default=None)
+    parser.add_argument("--json", default=None)
+    parser.add_argument("--vector-stats", action="store_true")
+    args = parser.parse_args(argv[1:])
+    if args.vector_stats:
+        try:
+            randomizer.use_stat_engine()
+        except RuntimeError, e:
+            parser.error(str(e))
+
+    start = time()
+    stats = run_stats(args.sourcefile, parse_seeds(args.seeds), args.flags,
+                      workers=args.workers, columns=args.columns,
+                      cache=args.cache, progress=True)
+    summary = stats.get_summary()
+    print format_summary(summary, BATCH_STATE["flags"], time() - start)
+    if args.json:
+        f = open(args.json, "w")
+        f.write(dumps(summary, indent=2, sort_keys=True))
+        f.close()
@@ -0,0 +1,327 @@
+from argparse import ArgumentParser
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import OrderedDict, deque
+from json import dumps, loads
+from multiprocessing import Pool, TimeoutError
+from SocketServer import ThreadingMixIn
+from sys import argv, stdout
+from threading import Event, Lock
+from time import time
+from urllib import urlencode
+from urllib2 import urlopen
+from urlparse import urlparse, parse_qs
+
+import randomizer
+from randomizer import (LOADED_ROM, load_rom, read_rom, make_patch,
+                        use_state_cache, get_seed_outfile, get_all_flags,
+                        VERSION)
+from statecache import STATE_CACHE_BYTES
+from romimage import apply_ips
+
+
+DEFAULT_PORT = 8713
+MAX_PENDING = 32
+CACHE_BYTES = 16 * 1024 * 1024
+JOB_TIMEOUT = 120
+LATENCY_SAMPLES = 1000
+
+
+class ServiceBusy(Exception):
+    pass
+
+
+class PatchCache(object):
+    # Least recently used patches, bounded by their total size in bytes.
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.patches = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self.patches)
+
+    def get(self, key):
+        if key not in self.patches:
+            return None
+        patch = self.patches.pop(key)
+        self.patches[key] = patch
+        return patch
+
+    def add(self, key, patch):
+        if key in self.patches or len(patch) > self.max_bytes:
+            return
+        self.patches[key] = patch
+        self.size += len(patch)
+        while self.size > self.max_bytes:
+            _, old = self.patches.popitem(last=False)
+            self.size -= len(old)
+
+
+class PendingSeed(object):
+    # A seed that is being made. Python 2's pool results wake only one of
+    # the threads waiting on them, so requests wait on an event instead.
+    def __init__(self):
+        self.done = Event()
+        self.result = None
+
+
+def run_job(seed, flags, enemy_jump):
+    # Errors come back as results, since the pool only calls back for jobs
+    # that succeed.
+    try:
+        return True, make_patch(seed, flags, enemy_jump)
+    except Exception, e:
+        return False, "%s: %s" % (type(e).__name__, e)
+
+
+def get_percentile(values, percentile):
+    if not values:
+        return None
+    values = sorted(values)
+    index = int(round((len(values) - 1) * percentile / 100.0))
+    return values[index]
+
+
+class SeedService(object):
+    # Keeps the parsed rom resident and hands seeds to a fixed pool of
+    # worker processes. Requests for a seed that is already being made
+    # wait on the same job, and finished patches are kept in a cache. A
+    # job stays pending until it is done, even if the requests waiting on
+    # it time out, so that retries wait for it instead of starting another.
+    # Each worker also keeps mutated tables for reuse by the same seed with
+    # other flags.
+    def __init__(self, rom_data, workers=2, max_pending=MAX_PENDING,
+                 cache_bytes=CACHE_BYTES, state_cache_bytes=STATE_CACHE_BYTES):
+        load_rom(rom_data)
+        if state_cache_bytes:
+            use_state_cache(state_cache_bytes)
+        self.md5 = LOADED_ROM["md5"]
+        self.max_pending = max_pending
+        self.cache = PatchCache(cache_bytes)
+        self.pending = {}
+        self.lock = Lock()
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+        self.requests = 0
+        self.hits = 0
+        self.shared = 0
+        self.rejected = 0
+        # Created after loading so that the workers inherit the objects.
+        self.pool = Pool(workers)
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+    def get_key(self, seed, flags, enemy_jump):
+        # Flags that make the same seed share a key, e.g. "" and "cfmt", or
+        # "tfc" and "cft". The seed is made with the flags in the key.
+        all_flags = get_all_flags(randomizer.ALL_OBJECTS)
+        flags = "".join(sorted(set(flags.lower() or all_flags)))
+        unknown = [f for f in flags if f not in all_flags]
+        if unknown:
+            raise ValueError("Unknown flags: %s" % "".join(unknown))
+        return (self.md5, int(seed) % (10**10), flags, bool(enemy_jump))
+
+    def get_patch(self, seed, flags="", enemy_jump=False):
+        start = time()
+        key = self.get_key(seed, flags, enemy_jump)
+        try:
+            with self.lock:
+                self.requests += 1
+                patch = self.cache.get(key)
+                job = self.pending.get(key)
+                if patch is not None:
+                    self.hits += 1
+                    return patch
+                elif job is not None:
+                    self.shared += 1
+                elif len(self.pending) >= self.max_pending:
+                    self.rejected += 1
+                    raise ServiceBusy("Too many seeds are being made.")
+                else:
+                    job = self.pending[key] = PendingSeed()
+                    self.pool.apply_async(
+                        run_job, key[1:],
+                        callback=lambda result: self.finish(key, result))
+            if not job.done.wait(JOB_TIMEOUT):
+                raise TimeoutError
+            success, result = job.result
+            if not success:
+                raise RuntimeError(result)
+            return result
+        finally:
+            with self.lock:
+                self.latencies.append(time() - start)
+
+    def finish(self, key, result):
+        # Called by the pool once a job is done, whether or not anything is
+        # still waiting for it. Failed jobs are not cached, so the next
+        # request retries.
+        success, patch = result
+        with self.lock:
+            job = self.pending.pop(key)
+            if success:
+                self.cache.add(key, patch)
+        job.result = result
+        job.done.set()
+
+    def get_rom(self, seed, flags="", enemy_jump=False):
+        patch = self.get_patch(seed, flags, enemy_jump)
+        return str(apply_ips(LOADED_ROM["rom_data"], patch))
+
+    def get_stats(self):
+        with self.lock:
+            latencies = list(self.latencies)
+            stats = {
+                "version": VERSION,
+                "rom": self.md5,
+                "requests": self.requests,
+                "queue_depth": len(self.pending),
+                "shared": self.shared,
+                "rejected": self.rejected,
+                "cache_entries": len(self.cache),
+                "cache_bytes": self.cache.size,
+                "cache_hit_rate": (float(self.hits) / self.requests
+                                   if self.requests else None),
+                }
+        for p in [50, 90, 99]:
+            stats["latency_p%s" % p] = get_percentile(latencies, p)
+        return stats
+
+
+class SeedRequestHandler(BaseHTTPRequestHandler):
+    # GET /seed?seed=N&flags=cfmt&jump=1&format=ips|rom
+    # GET /stats
+    def send(self, code, data, content_type="text/plain", headers=None):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = dict((k, v[-1]) for (k, v) in parse_qs(url.query).items())
+        service = self.server.service
+        if url.path == "/stats":
+            self.send(200, dumps(service.get_stats()), "application/json")
+            return
+        if url.path != "/seed":
+            self.send(404, "Not found.\n")
+            return
+
+        try:
+            seed = int(query["seed"])
+            flags = query.get("flags", "")
+            enemy_jump = query.get("jump", "0") not in ["", "0", "n", "no"]
+            fmt = query.get("format", "ips")
+            if fmt not in ["ips", "rom"]:
+                raise ValueError("Unknown format: %s" % fmt)
+            service.get_key(seed, flags, enemy_jump)
+        except KeyError:
+            self.send(400, "Bad request: no seed.\n")
+            return
+        except ValueError, e:
+            self.send(400, "Bad request: %s\n" % e)
+            return
+
+        try:
+            if fmt == "rom":
+                data = service.get_rom(seed, flags, enemy_jump)
+            else:
+                data = service.get_patch(seed, flags, enemy_jump)
+        except ServiceBusy, e:
+            self.send(503, "%s\n" % e, headers={"Retry-After": "1"})
+            return
+        except TimeoutError:
+            self.send(504, "Timed out.\n")
+            return
+        except Exception, e:
+            self.send(500, "%s\n" % e)
+            return
+        filename = get_seed_outfile("ffmq.smc", seed)
+        if fmt == "ips":
+            filename = "%s.ips" % filename.rsplit(".", 1)[0]
+        self.send(200, data, "application/octet-stream",
+                  {"Content-Disposition":
+                   'attachment; filename="%s"' % filename})
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            BaseHTTPRequestHandler.log_message(self, format, *args)
+
+
+class SeedServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def serve(sourcefile, port=DEFAULT_PORT, host="127.0.0.1", workers=2,
+          max_pending=MAX_PENDING, cache_bytes=CACHE_BYTES,
+          state_cache_bytes=STATE_CACHE_BYTES, verbose=False):
+    service = SeedService(read_rom(sourcefile), workers=workers,
+                          max_pending=max_pending, cache_bytes=cache_bytes,
+                          state_cache_bytes=state_cache_bytes)
+    server = SeedServer((host, port), SeedRequestHandler)
+    server.service = service
+    server.verbose = verbose
+    print "Serving %s on http://%s:%s/" % (service.md5, host, port)
+    stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.close()
+
+
+def fetch_seed(seed, flags="", enemy_jump=False, fmt="ips",
+               host="127.0.0.1", port=DEFAULT_PORT):
+    query = urlencode({"seed": seed, "flags": flags,
+                       "jump": int(bool(enemy_jump)), "format": fmt})
+    return urlopen("http://%s:%s/seed?%s" % (host, port, query)).read()
+
+
+def fetch_stats(host="127.0.0.1", port=DEFAULT_PORT):
+    return loads(urlopen("http://%s:%s/stats" % (host, port)).read())
+
+
+if __name__ == "__main__":
+    parser = ArgumentParser(description="Local seed generation service.")
+    parser.add_argument("sourcefile", nargs="?")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--max-pending", type=int, default=MAX_PENDING)
+    parser.add_argument("--cache-bytes", type=int, default=CACHE_BYTES)
+    parser.add_argument("--state-cache-bytes", type=int,
+                        default=STATE_CACHE_BYTES)
+    parser.add_argument("--verbose", action="store_true")
+    parser.add_argument("--client", action="store_true",
+                        help="request seeds from a running service")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--flags", default="")
+    parser.add_argument("--jump", action="store_true")
+    parser.add_argument("--output", default=None)
+    args = parser.parse_args(argv[1:])
+    if args.client:
+        if args.seed is not None:
+            data = fetch_seed(args.seed, args.flags, args.jump,
+                              host=args.host, port=args.port)
+            outfile = args.output or "%s.ips" % get_seed_outfile(
+                "ffmq.smc", args.seed).rsplit(".", 1)[0]
+            f = open(outfile, "wb")
+            f.write(data)
+            f.close()
+            print "Wrote %s (%s bytes)." % (outfile, len(data))
+        print dumps(fetch_stats(args.host, args.port), indent=2,
+                    sort_keys=True)
+    else:
+        if args.sourcefile is None:
+            parser.error("a source rom is required")
+        serve(args.sourcefile, port=args.port, host=args.host,
+              workers=args.workers, max_pending=args.max_pending,
+              cache_bytes=args.cache_bytes,
+              state_cache_bytes=args.state_cache_bytes, verbose=args.verbose)
@@ -0,0 +1,96 @@
+from collections import OrderedDict
+from hashlib import md5
+from os import getpid, listdir, makedirs, remove, rename
+from os.path import exists, join
+
+
+# Keeps the state of groups of tables right after they were mutated, under
+# a digest of everything that state depends on, so that making the same
+# seed again with other flags only mutates the tables the change affects.
+# Entries are kept in memory, least recently used first out, and also in
+# a directory if one is given.
+
+STATE_CACHE_BYTES = 64 * 1024 * 1024
+STATE_SUFFIX = ".states"
+
+
+def get_state_key(*parts):
+    return md5(repr(parts)).hexdigest()
+
+
+class StateCache(object):
+    def __init__(self, max_bytes=STATE_CACHE_BYTES, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.states = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.states)
+
+    def get_filename(self, key):
+        return join(self.directory, "%s%s" % (key, STATE_SUFFIX))
+
+    def get(self, key):
+        if key in self.states:
+            data = self.states.pop(key)
+            self.states[key] = data
+            self.hits += 1
+            return data
+        if self.directory is not None and exists(self.get_filename(key)):
+            try:
+                f = open(self.get_filename(key), "rb")
+                try:
+                    data = f.read()
+                finally:
+                    f.close()
+            except IOError:
+                data = None
+            if data:
+                self.remember(key, data)
+                self.hits += 1
+                return data
+        self.misses += 1
+        return None
+
+    def add(self, key, data):
+        self.remember(key, data)
+        if self.directory is None:
+            return
+        if not exists(self.directory):
+            try:
+                makedirs(self.directory)
+            except OSError:
+                if not exists(self.directory):
+                    raise
+        filename = self.get_filename(key)
+        tempname = "%s.%s.tmp" % (filename, getpid())
+        f = open(tempname, "wb")
+        f.write(data)
+        f.close()
+        try:
+            rename(tempname, filename)
+        except OSError:
+            # Windows will not rename over an existing file.
+            if exists(filename):
+                remove(filename)
+            rename(tempname, filename)
+
+    def remember(self, key, data):
+        if key in self.states or len(data) > self.max_bytes:
+            return
+        self.states[key] = data
+        self.size += len(data)
+        while self.size > self.max_bytes:
+            _, old = self.states.popitem(last=False)
+            self.size -= len(old)
+
+
+def clear_states(directory):
+    if not exists(directory):
+        return
+    for filename in listdir(directory):
+        if filename.endswith(STATE_SUFFIX):
+            remove(join(directory, filename))
@@ -0,0 +1,74 @@
+from bitfields import shuffle_column_bits
+from columns import get_numpy
+
+
+# Mutates the stats and bit fields of a whole table at once with NumPy,
+# instead of one object and one attribute at a time. Every table gets
+# its own generator, seeded with the first draw of the table's stream, so
+# a seed always gives the same stats. They are not the stats that the
+# same seed gets without the engine.
+
+STAT_WIDTH = 8
+
+
+def get_generator(seed):
+    return get_numpy().random.RandomState(seed & 0xFFFFFFFF)
+
+
+def get_bounds(objtype):
+    # The range of every attribute in mutate_attributes. None stands for
+    # the range of the values that were read from the rom.
+    bounds = {}
+    for attr, minmax in objtype.mutate_attributes.items():
+        if minmax is None:
+            values = [o.old_data[attr] for o in objtype.every]
+            minmax = (min(values), max(values))
+        bounds[attr] = minmax
+    return bounds
+
+
+def shuffle_columns(objs, groups, generator):
+    # One permutation per group of attributes, which move between objects
+    # together.
+    for attributes in groups:
+        if isinstance(attributes, basestring):
+            attributes = [attributes]
+        rows = [[getattr(o, attr) for attr in attributes] for o in objs]
+        for o, i in zip(objs, generator.permutation(len(objs))):
+            for attr, value in zip(attributes, rows[i]):
+                setattr(o, attr, value)
+
+
+def draw_stats(objs, bounds, generator):
+    # Draws new values for every attribute of every object in one call,
+    # from a normal distribution around the current value that is an
+    # eighth of the attribute's range wide. Values that are already out of
+    # range are kept. Returns {obj: {attr: value}}.
+    if not objs or not bounds:
+        return {}
+    numpy = get_numpy()
+    attributes = sorted(bounds)
+    values = numpy.array([[getattr(o, attr) for attr in attributes]
+                          for o in objs], dtype=float)
+    minimum = numpy.array([bounds[attr][0] for attr in attributes], float)
+    maximum = numpy.array([bounds[attr][1] for attr in attributes], float)
+    widths = numpy.maximum(1, (maximum - minimum) // STAT_WIDTH)
+    drawn = numpy.clip(numpy.rint(generator.normal(values, widths)),
+                       minimum, maximum)
+    inside = (values >= minimum) & (values <= maximum)
+    drawn = numpy.where(inside, drawn, values).astype(int)
+    return dict((o, dict(zip(attributes, row)))
+                for (o, row) in zip(objs, drawn.tolist()))
+
+
+def draw_bits(objs, fields, generator):
+    # Shuffles every (attribute, size, shift) field of every object in one
+    # call per field, like shuffle_bits(value >> shift, size) << shift.
+    # Returns {obj: {(attribute, size, shift): value}}.
+    drawn = dict((o, {}) for o in objs)
+    for attr, size, shift in fields:
+        values = [getattr(o, attr) >> shift for o in objs]
+        shuffled = shuffle_column_bits(values, size, generator)
+        for o, value in zip(objs, shuffled.tolist()):
+            drawn[o][attr, size, shift] = value << shift
+    return drawn
@@ -0,0 +1,194 @@
+from hashlib import md5
+from os import listdir, makedirs
+from os.path import abspath, dirname, exists, join
+from random import Random
+from shutil import copy
+from sys import argv
+
+from textcodec import TextCodec
+
+
+# Builds a stand-in for the FFMQ rom out of random but plausible records,
+# so that the randomizer can be run and timed without the real game.
+# Every table in tables_list.txt is filled in, at its real address, and
+# the result is registered in a copy of the tables directory.
+
+ROM_SIZE = 0x200000
+SEED = 1
+LABEL = "FFMQ_NA_1.1"
+TABLES = join(dirname(abspath(__file__)), "tables")
+TABLES_LIST = "tables_list.txt"
+SNES_TITLE = "FINAL FANTASY USA   "
+
+NUM_NORMAL_MONSTERS = 0x40
+NUM_FORMATIONS = 234
+
+
+def read_specs(tablefile):
+    fields = []
+    for line in open(join(TABLES, tablefile)):
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+        parts = line.split(",")
+        fields.append((parts[0], int(parts[1])))
+    return fields
+
+
+def read_tables_list(filename=TABLES_LIST):
+    tables = []
+    for line in open(join(TABLES, filename)):
+        line = line.strip()
+        if not line or line[0] == "#":
+            continue
+        parts = line.split()
+        objname, tablefile, address, count = parts[:4]
+        table = {"name": objname, "fields": read_specs(tablefile),
+                 "address": int(address, 0x10), "count": int(count)}
+        if len(parts) >= 7 and parts[4] == "pointed":
+            table["pointers"] = int(parts[5], 0x10)
+            table["pointer_size"] = int(parts[6])
+        tables.append(table)
+    return tables
+
+
+def int_bytes(value, length):
+    return [(value >> (8 * i)) & 0xFF for i in xrange(length)]
+
+
+def get_record(r, name, index, fields, text):
+    values = {}
+    if name == "TreasureIndexObject":
+        values["contents"] = r.choice([
+            r.randint(0, 0xF), r.choice([0x10, 0x11, 0x13, 0xDD, 0xDE]),
+            r.randint(0x14, 0x3F)])
+    elif name in ["WeaponObject", "AttackObject", "ArmorObject"]:
+        values["power"] = r.randint(1, 120)
+    elif name == "DropObject":
+        values["xp"] = r.randint(1, 200)
+        values["gp"] = r.randint(1, 200)
+        values["unknown"] = 0
+    elif name == "MonsterObject":
+        if index < NUM_NORMAL_MONSTERS:
+            values["hp"] = r.randint(50, 5000)
+        else:
+            values["hp"] = r.randint(3000, 30000)
+        for attr in ["strength", "defense", "speed", "magic"]:
+            values[attr] = r.randint(5, 200)
+    elif name == "FormationObject":
+        normal = lambda: r.randint(0, NUM_NORMAL_MONSTERS-1)
+        if index < 100:
+            ids = [normal(), normal(), r.choice([0xFF, normal()])]
+        elif index < 150:
+            ids = [normal(), r.randint(NUM_NORMAL_MONSTERS,
+                                      NUM_NORMAL_MONSTERS+0xF), 0xFF]
+        else:
+            ids = [normal(), normal(), 0xFF]
+        values["enemy_ids"] = ids
+        values["misc"] = r.randint(0, 3)
+    elif name == "BattleFormationObject":
+        if index < 20:
+            values["formation_ids"] = [r.randint(0, 99) for _ in xrange(3)]
+        else:
+            values["formation_ids"] = [r.randint(0, NUM_FORMATIONS-1)] * 3
+    elif name == "BattleRewardObject":
+        values["reward"] = r.choice([0x8000 | r.randint(1, 0x3FF),
+                                     0x4000 | r.randint(0x14, 0x3F),
+                                     r.randint(1, 0x3FF)])
+    elif name == "BattleRoundsObject":
+        values["num_rounds"] = r.randint(1, 10)
+    elif name == "MonsterNameObject":
+        values["text"] = text.encode("MONSTER %s" % index, 16)
+    elif name == "CharacterObject":
+        values["name_text"] = text.encode("HERO %s" % index, 16)
+        values["level"] = r.randint(1, 40)
+        values["max_hp"] = values["current_hp"] = 40 * r.randint(1, 100)
+        for attr in ["white", "black", "wizard",
+                     "white2", "black2", "wizard2"]:
+            values[attr] = r.randint(0, 30)
+        for attr in ["attack", "defense", "speed", "magic", "accuracy"]:
+            values[attr] = r.randint(1, 99)
+        for attr in ["attack2", "defense2", "speed2", "magic2"]:
+            values[attr] = values[attr[:-1]]
+        values["known_magic"] = r.randint(0, 0xFF)
+        values["known_wizard"] = r.randint(0, 0xFF) & 0xF0
+    elif name == "ExitObject":
+        values["map"] = r.randint(0, 0xFF)
+
+    data = []
+    for field, size in fields:
+        if field not in values:
+            value = [r.randint(0, 0xFF) for _ in xrange(size)]
+        elif isinstance(values[field], list):
+            value = values[field]
+        else:
+            value = int_bytes(values[field], size)
+        assert len(value) == size
+        data.extend(value)
+    return data
+
+
+def write_snes_header(rom):
+    # LoROM, 2MB, with a valid checksum.
+    rom[0x7FC0:0x7FD4] = SNES_TITLE
+    rom[0x7FD5] = 0x20
+    rom[0x7FD7] = 0x0B
+    rom[0x7FDC:0x7FE0] = [0xFF, 0xFF, 0x00, 0x00]
+    checksum = sum(rom) & 0xFFFF
+    rom[0x7FDC:0x7FE0] = int_bytes(checksum ^ 0xFFFF, 2) + int_bytes(
+        checksum, 2)
+
+
+def make_rom(seed=SEED):
+    r = Random(seed)
+    text = TextCodec(join(TABLES, "mq.tbl"))
+    rom = bytearray(ROM_SIZE)
+    for table in read_tables_list():
+        size = sum([s for (_, s) in table["fields"]])
+        if "pointers" in table:
+            # Pointed tables get one record per pointer, packed in the
+            # space before the pointer list.
+            numrecords = (table["pointers"] - table["address"]) / size
+            for i in xrange(table["count"]):
+                target = table["address"] + (
+                    size * ((i * numrecords) / table["count"]))
+                address = table["pointers"] + (i * table["pointer_size"])
+                rom[address:address+table["pointer_size"]] = int_bytes(
+                    target & 0xFFFF, table["pointer_size"])
+            count = numrecords
+        else:
+            count = table["count"]
+        for i in xrange(count):
+            address = table["address"] + (i * size)
+            rom[address:address+size] = get_record(
+                r, table["name"], i, table["fields"], text)
+    write_snes_header(rom)
+    return str(rom)
+
+
+def make_fixture(directory, seed=SEED):
+    # Writes synthetic.sfc and a copy of the tables that recognizes it.
+    # Returns the path of the rom; run the randomizer from the directory.
+    rom = make_rom(seed)
+    tables = join(directory, "tables")
+    if not exists(tables):
+        makedirs(tables)
+    for filename in listdir(TABLES):
+        copy(join(TABLES, filename), tables)
+    f = open(join(tables, "master.txt"), "a")
+    f.write("%s    %s    %s\n" % (LABEL, md5(rom).hexdigest(), TABLES_LIST))
+    f.close()
+    romfile = join(directory, "synthetic.sfc")
+    f = open(romfile, "wb")
+    f.write(rom)
+    f.close()
+    return romfile
+
+
+if __name__ == "__main__":
+    if len(argv) < 2:
+        print "Usage: python synthrom.py <directory> [seed]"
+    else:
+        seed = int(argv[2]) if len(argv) > 2 else SEED
+        romfile = make_fixture(argv[1], seed)
+        print "Wrote %s." % romfile
@@ -0,0 +1,33 @@
+from atexit import register
+from os import chdir
+from os.path import abspath, dirname
+from shutil import rmtree
+from tempfile import mkdtemp
+import sys
+
+from synthrom import make_fixture
+
+
+# The randomizer finds its tables relative to the working directory and
+# only ever loads one rom per process, so every test shares one synthetic
+# rom, loaded the first time a test asks for it.
+
+FIXTURE = {}
+ROOT = dirname(dirname(abspath(__file__)))
+
+
+def get_randomizer():
+    if not FIXTURE:
+        directory = mkdtemp(prefix="ffmq-test-")
+        register(rmtree, directory, True)
+        romfile = make_fixture(directory)
+        # After chdir the modules can only be found through ROOT.
+        if ROOT not in sys.path:
+            sys.path.insert(0, ROOT)
+        chdir(directory)
+        import randomizer
+        randomizer.open_rom(romfile)
+        FIXTURE["directory"] = directory
+        FIXTURE["romfile"] = romfile
+        FIXTURE["randomizer"] = randomizer
+    return FIXTURE["randomizer"]
@@ -0,0 +1,45 @@
+from unittest import TestCase, skipIf
+
+from randomtools import utils
+from randomtools.utils import utilrandom as random
+from bitfields import (
+    shuffle_bits, popcount, shuffle_column_bits, get_permutation_table)
+from columns import get_numpy
+
+
+class ShuffleBitsTest(TestCase):
+    def test_same_draws_as_randomtools(self):
+        # Seeds made before bitfields must still come out the same.
+        for size in [4, 5, 8]:
+            for value in xrange(1 << size):
+                random.seed(value + (size << 8))
+                expected = utils.shuffle_bits(value, size=size)
+                after = random.random()
+                random.seed(value + (size << 8))
+                self.assertEqual(shuffle_bits(value, size=size), expected)
+                self.assertEqual(random.random(), after)
+
+    def test_popcount(self):
+        for value in xrange(0x200):
+            self.assertEqual(popcount(value), bin(value).count("1"))
+
+
+@skipIf(get_numpy() is None, "needs NumPy")
+class ShuffleColumnBitsTest(TestCase):
+    def test_permutation_table(self):
+        for size in [4, 5]:
+            table = get_permutation_table(size)
+            for row in table.tolist():
+                self.assertEqual(sorted(row), range(1 << size))
+                self.assertEqual([popcount(v) for v in row],
+                                 [popcount(v) for v in xrange(1 << size)])
+
+    def test_keeps_popcount(self):
+        numpy = get_numpy()
+        generator = numpy.random.RandomState(1)
+        for size in [4, 5, 8]:
+            values = range(1 << size) * 4
+            shuffled = shuffle_column_bits(values, size, generator).tolist()
+            self.assertEqual([popcount(v) for v in shuffled],
+                             [popcount(v) for v in values])
+            self.assertTrue(all([v < (1 << size) for v in shuffled]))
@@ -0,0 +1,124 @@
+from cPickle import dumps, loads
+from unittest import TestCase, skipIf
+
+from columns import ColumnStore, World, get_numpy
+from tests.fixture import get_randomizer
+
+
+RANKED = ["MonsterObject", "FormationObject", "BattleFormationObject"]
+
+
+class Record(object):
+    size = 0
+
+    def __init__(self, index, ids, size):
+        self.index = index
+        self.ids = ids
+        self.size = size
+        self.changes = []
+
+    def __setattr__(self, name, value):
+        if name == "ids" and hasattr(self, "changes"):
+            self.changes.append(value)
+        super(Record, self).__setattr__(name, value)
+
+
+class ColumnStoreTest(TestCase):
+    def setUp(self):
+        Record.every = [Record(i, [i, i+1, 0xFF], i * 100)
+                        for i in xrange(4)]
+        self.store = ColumnStore(Record, ["ids", "size"],
+                                 {"ids": "B", "size": "H"})
+
+    def tearDown(self):
+        self.store.detach()
+        del(Record.every)
+
+    def test_views(self):
+        r = Record.every[2]
+        self.assertEqual(r.ids, [2, 3, 0xFF])
+        self.assertEqual(r.size, 200)
+        self.assertFalse("ids" in r.__dict__)
+        r.ids = [7, 8, 9]
+        r.size = 5
+        self.assertEqual((r.ids, r.size), ([7, 8, 9], 5))
+        self.assertEqual(Record.every[1].ids, [1, 2, 0xFF])
+
+    def test_in_place(self):
+        r = Record.every[1]
+        r.ids[0] = 9
+        self.assertEqual(r.ids, [9, 2, 0xFF])
+        r.ids.sort()
+        self.assertEqual(r.ids, [2, 9, 0xFF])
+        r.ids[1:] = [4, 4]
+        self.assertEqual(r.ids, [2, 4, 4])
+        self.assertEqual(r.changes, [[9, 2, 0xFF], [2, 9, 0xFF], [2, 4, 4]])
+        self.assertTrue(self.store.changed)
+
+    def test_length_is_fixed(self):
+        r = Record.every[1]
+        for change in [lambda ids: ids.append(1), lambda ids: ids.pop(),
+                       lambda ids: ids.extend([1])]:
+            self.assertRaises(AssertionError, change, r.ids)
+            self.assertEqual(r.ids, [1, 2, 0xFF])
+
+    def test_pickle(self):
+        ids = loads(dumps(Record.every[3].ids, 2))
+        self.assertEqual(type(ids), list)
+        self.assertEqual(ids, [3, 4, 0xFF])
+
+    def test_world(self):
+        world = World([self.store])
+        Record.every[0].ids[2] = 1
+        Record.every[3].size = 1
+        world.restore()
+        self.assertEqual(Record.every[0].ids, [0, 1, 0xFF])
+        self.assertEqual(Record.every[3].size, 300)
+
+    def test_detach(self):
+        Record.every[0].ids[1] = 6
+        self.store.detach()
+        r = Record.every[0]
+        self.assertEqual(type(r.__dict__["ids"]), list)
+        self.assertEqual(r.ids, [0, 6, 0xFF])
+        self.assertEqual(Record.every[1].size, 100)
+        self.assertEqual(Record.size, 0)
+
+
+@skipIf(get_numpy() is None, "needs NumPy")
+class ColumnRanksTest(TestCase):
+    # The rank caches rank whole tables at once when the tables are in
+    # columns, and must come out as if every object was ranked by itself.
+    # The columns are taken out again afterwards, since the other tests
+    # share the objects.
+    def setUp(self):
+        r = self.randomizer = get_randomizer()
+        self.classes = [getattr(r, name) for name in RANKED]
+
+    def tearDown(self):
+        r = self.randomizer
+        for store in r.COLUMN_STORES.values():
+            store.detach()
+        r.COLUMN_STORES.clear()
+        r.restore_objects(r.LOADED_ROM["snapshot"])
+
+    def get_ranks(self):
+        return [[o.rank for o in c.every] for c in self.classes]
+
+    def test_ranks(self):
+        r = self.randomizer
+        for seed in [3, 99]:
+            r.restore_objects(r.LOADED_ROM["snapshot"])
+            r.randomize_objects(r.ALL_OBJECTS, seed, "cfmt")
+            r.reset_class_state()
+            expected = self.get_ranks()
+            r.use_columns()
+            r.reset_class_state()
+            self.assertEqual(self.get_ranks(), expected)
+            self.assertTrue(max(expected[0]) >= 2 ** 32)
+            monster_ranks = r.get_monster_ranks()
+            formation_ranks = r.get_formation_ranks(monster_ranks)
+            self.assertEqual(
+                [monster_ranks, formation_ranks,
+                 r.get_battle_formation_ranks(formation_ranks)], expected)
+            self.tearDown()
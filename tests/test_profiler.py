@@ -0,0 +1,25 @@
+from time import sleep, time
+from unittest import TestCase
+
+from profiler import Profiler
+
+
+class ProfilerTest(TestCase):
+    def test_nested_phases(self):
+        profiler = Profiler()
+        profiler.enable()
+        start = time()
+        with profiler.phase("outer"):
+            sleep(0.02)
+            with profiler.phase("inner", "Object"):
+                sleep(0.02)
+            with profiler.phase("inner", "Object"):
+                pass
+        elapsed = time() - start
+        outer, inner = profiler.get_stats()
+        self.assertEqual((outer.calls, inner.calls), (1, 2))
+        self.assertTrue(inner.wall >= 0.02)
+        self.assertTrue(0.02 <= outer.wall < elapsed - inner.wall + 0.001)
+        totals = profiler.get_totals()
+        self.assertTrue(sum([t.wall for t in totals]) <= elapsed)
+        self.assertEqual(profiler.stack, [])
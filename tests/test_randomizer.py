@@ -0,0 +1,322 @@
+from os.path import join
+from shutil import rmtree
+from cPickle import loads
+from itertools import combinations
+from StringIO import StringIO
+from tempfile import mkdtemp
+from unittest import TestCase
+import sys
+
+from profiler import PROFILER
+from randomtools import interface
+from romimage import apply_ips, write_objects, get_layout
+from tests.fixture import get_randomizer
+
+
+FLAGS = ["cfmt", "cm", "cmf", "f", "ft", "mt"]
+SEEDS = [3, 99]
+
+
+class RandomizeTest(TestCase):
+    def setUp(self):
+        self.randomizer = get_randomizer()
+
+    def test_deterministic(self):
+        r = self.randomizer
+        for flags in FLAGS:
+            a = r.make_patch(SEEDS[0], flags, enemy_jump=True)
+            self.assertEqual(r.make_patch(SEEDS[0], flags, enemy_jump=True),
+                             a)
+
+    def test_patch_matches_rom(self):
+        r = self.randomizer
+        source = r.LOADED_ROM["source"]
+        for flags in FLAGS:
+            patch = r.make_patch(SEEDS[0], flags)
+            self.assertEqual(str(apply_ips(source, patch)),
+                             r.randomize(source, SEEDS[0], flags))
+
+    def test_branches_match_serial(self):
+        r = self.randomizer
+        for flags in FLAGS:
+            for seed in SEEDS:
+                serial = r.make_patch(seed, flags, enemy_jump=True)
+                for branches in [2, 4]:
+                    self.assertEqual(
+                        r.make_patch(seed, flags, enemy_jump=True,
+                                     branches=branches),
+                        serial, "%s %s %s" % (flags, seed, branches))
+
+
+class WriteObjectsTest(TestCase):
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        self.randomizer.restore_objects(self.randomizer.LOADED_ROM["snapshot"])
+        self.image = bytearray(self.randomizer.LOADED_ROM["rom_data"])
+
+    def tearDown(self):
+        self.randomizer.restore_objects(self.randomizer.LOADED_ROM["snapshot"])
+
+    def get_record(self, obj):
+        size = get_layout(type(obj)).size
+        return str(self.image[obj.pointer:obj.pointer+size])
+
+    def test_unchanged(self):
+        r = self.randomizer
+        r.FormationObject.get(3).enemy_ids = list(
+            r.FormationObject.get(3).enemy_ids)
+        self.assertEqual(write_objects(r.ALL_OBJECTS, self.image), [])
+        self.assertEqual(self.image, r.LOADED_ROM["rom_data"])
+
+    def test_changed(self):
+        r = self.randomizer
+        m = r.MonsterObject.get(5)
+        m.hp = m.hp + 1
+        regions = write_objects(r.ALL_OBJECTS, self.image)
+        size = get_layout(r.MonsterObject).size
+        self.assertEqual(len(regions), 1)
+        self.assertTrue(m.pointer <= regions[0][0]
+                        and regions[0][1] <= m.pointer + size)
+        self.assertEqual(self.get_record(m),
+                         get_layout(r.MonsterObject).pack([m]))
+
+    def test_list_changed_in_place(self):
+        r = self.randomizer
+        f = r.FormationObject.get(7)
+        old = f.enemy_ids[0]
+        f.enemy_ids[0] = (old + 1) % 0x40
+        self.assertEqual(f.old_data["enemy_ids"][0], old)
+        regions = write_objects(r.ALL_OBJECTS, self.image)
+        self.assertEqual(len(regions), 1)
+        self.assertEqual(self.image[f.pointer], (old + 1) % 0x40)
+
+
+class WritePathTest(TestCase):
+    # The rom image against what the randomizer used to do: write every
+    # table into a copy of the rom with clean_and_write, patch the title
+    # screen and the jump flag into the file, and fix the header with
+    # randomtools' rewrite_snes_meta.
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        self.directory = mkdtemp(prefix="ffmq-write-")
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write_old(self, seed, flags):
+        r = self.randomizer
+        outfile = join(self.directory, "old.%s.%s.sfc" % (flags, seed))
+        f = open(outfile, "wb")
+        f.write(r.LOADED_ROM["rom_data"])
+        f.close()
+        r.restore_objects(r.LOADED_ROM["snapshot"])
+        interface.seed, interface.flags = seed, flags
+        interface.outfile = outfile
+        stdout, sys.stdout = sys.stdout, StringIO()
+        try:
+            r.rename_demo_character()
+            interface.clean_and_write(r.ALL_OBJECTS)
+            f = open(outfile, "r+b")
+            f.seek(r.TITLE_SCREEN_POINTER)
+            f.write(r.get_title_screen_data(seed, flags))
+            f.seek(r.get_enemy_jump_address())
+            f.write(chr(0x80))
+            f.close()
+            interface.rewrite_snes_meta("FFMQ-R", r.VERSION, megabits=24,
+                                        lorom=True)
+        finally:
+            sys.stdout = stdout
+        f = open(outfile, "rb")
+        data = f.read()
+        f.close()
+        return data
+
+    def test_same_rom(self):
+        r = self.randomizer
+        for flags in FLAGS:
+            for seed in SEEDS:
+                old = self.write_old(seed, flags)
+                new = r.randomize(r.LOADED_ROM["source"], seed, flags,
+                                  enemy_jump=True)
+                self.assertEqual(new, old, "%s %s" % (flags, seed))
+
+
+class StateCacheTest(TestCase):
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        self.expected = {}
+        for flags in FLAGS:
+            for seed in SEEDS:
+                self.expected[flags, seed] = self.randomizer.make_patch(
+                    seed, flags, enemy_jump=True)
+        self.directory = mkdtemp(prefix="ffmq-states-")
+
+    def tearDown(self):
+        self.randomizer.STATE_CACHE.clear()
+        rmtree(self.directory)
+
+    def check(self, cache, branches=1):
+        for flags in FLAGS + list(reversed(FLAGS)):
+            for seed in SEEDS:
+                self.assertEqual(
+                    self.randomizer.make_patch(seed, flags, enemy_jump=True,
+                                               branches=branches),
+                    self.expected[flags, seed], "%s %s" % (flags, seed))
+        self.assertTrue(cache.hits)
+        self.assertTrue(cache.misses)
+
+    def test_hits_match_misses(self):
+        self.check(self.randomizer.use_state_cache())
+
+    def test_hits_match_misses_with_branches(self):
+        self.check(self.randomizer.use_state_cache(), branches=3)
+
+    def test_reuse(self):
+        # Adding "f" only mutates the tables that depend on it.
+        r = self.randomizer
+        r.use_state_cache()
+        r.make_patch(SEEDS[0], "cm", enemy_jump=True)
+        PROFILER.reset()
+        PROFILER.enable()
+        try:
+            patch = r.make_patch(SEEDS[0], "cmf", enemy_jump=True)
+        finally:
+            PROFILER.disable()
+        mutated = set([s.name for s in PROFILER.get_stats()
+                       if s.phase == "mutate"])
+        PROFILER.reset()
+        self.assertEqual(patch, self.expected["cmf", SEEDS[0]])
+        self.assertTrue("FormationObject" in mutated)
+        self.assertFalse(mutated & set(["AttackObject", "ArmorObject",
+                                        "CharacterObject", "MonsterObject",
+                                        "WeaponObject"]))
+
+    def test_directory(self):
+        self.check(self.randomizer.use_state_cache(directory=self.directory))
+        # A new cache over the same directory starts with every state.
+        cache = self.randomizer.use_state_cache(directory=self.directory)
+        for flags in FLAGS:
+            for seed in SEEDS:
+                self.assertEqual(
+                    self.randomizer.make_patch(seed, flags, enemy_jump=True),
+                    self.expected[flags, seed])
+        self.assertFalse(cache.misses)
+
+
+class Recorder(object):
+    # A state cache that never has anything, and keeps every state it is
+    # given.
+    def __init__(self):
+        self.states = {}
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        return None
+
+    def add(self, key, data):
+        self.states.setdefault(key, []).append(loads(data))
+
+
+class ClassKeyTest(TestCase):
+    # Every table is cached under a key of its own. Tables cached under the
+    # same key must have mutated into the same state, whatever the other
+    # flags are, and a table's key may only change with the flags it
+    # depends on besides its own.
+    DEPENDS = {"BattleFormationObject": "ft", "BattleRewardObject": "f",
+               "BattleRoundsObject": "f", "FormationObject": "t"}
+
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        self.get_state_key = self.randomizer.get_state_key
+        # Keys that still say which table they are for.
+        self.randomizer.get_state_key = lambda *parts: (parts[1],
+                                                        repr(parts))
+
+    def tearDown(self):
+        self.randomizer.get_state_key = self.get_state_key
+        self.randomizer.STATE_CACHE.clear()
+
+    def test_keys(self):
+        r = self.randomizer
+        r.use_state_cache()
+        states = {}
+        for seed in SEEDS:
+            keys = {}
+            for n in xrange(1, 5):
+                for flags in combinations("cfmt", n):
+                    flags = "".join(flags)
+                    recorder = r.STATE_CACHE["cache"] = Recorder()
+                    r.make_patch(seed, flags)
+                    for key, data in recorder.states.items():
+                        keys[key[0], flags] = key
+                        states.setdefault(key, []).extend(data)
+            for (name, flags), key in keys.items():
+                depends = self.DEPENDS.get(name, "")
+                for f in "cfmt":
+                    other = "".join(sorted(set(flags + f)))
+                    if f in depends or (name, other) not in keys:
+                        continue
+                    self.assertEqual(keys[name, other], key,
+                                     "%s %s %s" % (name, flags, other))
+        self.assertTrue([key for key in states if len(states[key]) > 1])
+        for key, data in states.items():
+            for d in data[1:]:
+                self.assertTrue(d == data[0], key[0])
+
+
+class ItemLedgerTest(TestCase):
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        self.roll_reward = self.randomizer.BattleRewardObject.roll_reward
+        self.randomizer.reset_class_state()
+
+    def tearDown(self):
+        r = self.randomizer
+        r.BattleRewardObject.roll_reward = self.roll_reward
+        r.restore_objects(r.LOADED_ROM["snapshot"])
+        r.reset_class_state()
+
+    def roll(self, items):
+        # Battlefield rewards roll the given items, and then keep rolling
+        # the last one.
+        rolls = []
+
+        def roll_reward(br):
+            rolls.append(items[min(len(rolls), len(items)-1)])
+            br.reward = 0x4000 | rolls[-1]
+        self.randomizer.BattleRewardObject.roll_reward = roll_reward
+        return rolls
+
+    def test_reserve(self):
+        ledger = self.randomizer.ItemLedger()
+        self.assertTrue(ledger.reserve(0x20))
+        self.assertFalse(ledger.reserve(0x20))
+        self.assertTrue(ledger.is_reserved(0x20))
+        ledger.release(0x20)
+        self.assertFalse(ledger.is_reserved(0x20))
+        self.assertTrue(ledger.reserve(0x20))
+
+    def test_reroll(self):
+        r = self.randomizer
+        r.ITEMS.reserve(0x20)
+        r.ITEMS.reserve(0x23)
+        br = r.BattleRewardObject.get(1)
+        br.reward = 0
+        rolls = self.roll([0x20, 0x23, 0x26])
+        br.mutate()
+        self.assertEqual(rolls, [0x20, 0x23, 0x26])
+        self.assertEqual(br.reward, 0x4000 | 0x26)
+        self.assertTrue(r.ITEMS.is_reserved(0x26))
+
+    def test_give_up(self):
+        r = self.randomizer
+        items = sorted(set(r.DESIRABLE_ITEMS + r.UNDESIRABLE_ITEMS))
+        for i in items[1:]:
+            r.ITEMS.reserve(i)
+        br = r.BattleRewardObject.get(1)
+        br.reward = 0
+        rolls = self.roll([items[-1]])
+        br.mutate()
+        self.assertEqual(len(rolls), r.MAX_REWARD_ATTEMPTS)
+        self.assertEqual(br.reward, 0x4000 | items[0])
+        self.assertTrue(r.ITEMS.is_reserved(items[0]))
@@ -0,0 +1,130 @@
+from marshal import dumps
+from os import listdir, mkdir, utime
+from os.path import basename, join
+from shutil import rmtree
+from tempfile import mkdtemp
+from unittest import TestCase
+
+import romcache
+from romcache import (read_cache, write_cache, clear_cache,
+                      get_cache_filename, get_tables_key, CACHE_VERSION)
+from tests.fixture import get_randomizer, FIXTURE
+
+
+RECORDS = {"MonsterObject": {0x1000: [("hp", 40), ("name", [1, 2, 3])]}}
+
+
+class RomCacheTest(TestCase):
+    def setUp(self):
+        self.directory = mkdtemp(prefix="ffmq-test-")
+        self.cache = join(self.directory, "cache")
+        self.romfile = join(self.directory, "rom.sfc")
+        self.tblpath = join(self.directory, "tables")
+        mkdir(self.tblpath)
+        self.write(self.romfile, "rom")
+        self.write(join(self.tblpath, "monster.txt"), "hp,1")
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def write(self, filename, data, mtime=1000000000):
+        f = open(filename, "wb")
+        f.write(data)
+        f.close()
+        utime(filename, (mtime, mtime))
+
+    def write_cache(self, md5hash="abc"):
+        return write_cache(self.cache, self.romfile,
+                           get_tables_key(self.tblpath), md5hash, "FFMQ",
+                           "tables.txt", RECORDS)
+
+    def read_cache(self):
+        return read_cache(self.cache, self.romfile,
+                          get_tables_key(self.tblpath))
+
+    def test_round_trip(self):
+        self.assertEqual(self.read_cache(), None)
+        self.write_cache()
+        entry = self.read_cache()
+        self.assertEqual((entry["md5"], entry["label"], entry["tablefile"]),
+                         ("abc", "FFMQ", "tables.txt"))
+        self.assertEqual(entry["records"], RECORDS)
+        clear_cache(self.cache, self.romfile)
+        self.assertEqual(self.read_cache(), None)
+
+    def test_stale(self):
+        self.write_cache()
+        tables_key = get_tables_key(self.tblpath)
+        self.write(join(self.tblpath, "monster.txt"), "hp,2", 1000000001)
+        self.assertNotEqual(get_tables_key(self.tblpath), tables_key)
+        self.assertEqual(self.read_cache(), None)
+
+        self.write_cache()
+        self.write(join(self.tblpath, "formation.txt"), "")
+        self.assertEqual(self.read_cache(), None)
+
+        self.write_cache()
+        self.write(self.romfile, "ROM", 1000000001)
+        self.assertEqual(self.read_cache(), None)
+
+    def test_corrupt(self):
+        self.write_cache()
+        filename = get_cache_filename(self.cache, self.romfile)
+        data = open(filename, "rb").read()
+        entry = self.read_cache()
+        for bad in [data[:len(data) / 2], data[:1], "", "not marshal",
+                    dumps([1, 2, 3]), dumps(dict(entry, version=0))]:
+            self.write(filename, bad)
+            self.assertEqual(self.read_cache(), None, repr(bad[:20]))
+        self.write(filename, data)
+        self.assertEqual(self.read_cache(), entry)
+        self.assertEqual(entry["version"], CACHE_VERSION)
+
+    def test_rename(self):
+        # Entries are written beside the old one and renamed over it, so a
+        # reader never sees a partly written entry.
+        self.write_cache("old")
+        filename = get_cache_filename(self.cache, self.romfile)
+        renamed = []
+        rename = romcache.rename
+
+        def check_rename(source, destination):
+            self.assertEqual(destination, filename)
+            self.assertTrue(source.endswith(".tmp"))
+            if not renamed:
+                self.assertEqual(self.read_cache()["md5"], "old")
+                # As on Windows, which will not rename over a file.
+                renamed.append(source)
+                raise OSError("File exists.")
+            rename(source, destination)
+        romcache.rename = check_rename
+        try:
+            self.write_cache("new")
+        finally:
+            romcache.rename = rename
+        self.assertEqual(self.read_cache()["md5"], "new")
+        self.assertEqual(listdir(self.cache), [basename(filename)])
+
+
+class VerifyCacheTest(TestCase):
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        self.cache = mkdtemp(prefix="ffmq-test-")
+
+    def tearDown(self):
+        rmtree(self.cache)
+
+    def test_verify(self):
+        # An entry that does not match the rom is used unless the cache is
+        # verified, and then it is made again.
+        r = self.randomizer
+        romfile = FIXTURE["romfile"]
+        tables_key = get_tables_key(r.tblpath)
+        write_cache(self.cache, romfile, tables_key, "0" * 32,
+                    r.LOADED_ROM["label"], r.LOADED_ROM["tablefile"], {})
+        self.assertRaises(RuntimeError, r.open_rom, romfile, cache=self.cache)
+        r.open_rom(romfile, cache=self.cache, verify_cache=True)
+        entry = read_cache(self.cache, romfile, tables_key)
+        self.assertEqual(entry["md5"], r.LOADED_ROM["md5"])
+        self.assertEqual(entry["records"], r.get_all_records())
+        r.open_rom(romfile, cache=self.cache, verify_cache=True)
@@ -0,0 +1,198 @@
+from os import close, remove
+from random import Random
+from tempfile import mkstemp
+from unittest import TestCase
+
+from randomtools import utils
+from romimage import (
+    make_ips, apply_ips, get_changes, merge_regions, rewrite_snes_meta,
+    TableLayout, IPS_EOF_OFFSET, IPS_MAX_RECORD, IPS_MERGE_GAP)
+
+
+def get_records(patch):
+    # (offset, size) of every record, with RLE records counted by size.
+    patch = bytearray(patch)
+    records = []
+    i = 5
+    while str(patch[i:i+3]) != "EOF":
+        offset = (patch[i] << 16) | (patch[i+1] << 8) | patch[i+2]
+        size = (patch[i+3] << 8) | patch[i+4]
+        i += 5
+        if size:
+            i += size
+        else:
+            size = (patch[i] << 8) | patch[i+1]
+            i += 3
+        records.append((offset, size))
+    assert i + 3 == len(patch)
+    return records
+
+
+class IPSTest(TestCase):
+    def setUp(self):
+        r = Random(1)
+        self.original = bytearray(r.randint(0, 0xFF)
+                                  for _ in xrange(0x1000))
+        self.modified = bytearray(self.original)
+
+    def change(self, start, end, value=None):
+        for i in xrange(start, end):
+            if value is None:
+                self.modified[i] = self.original[i] ^ 0xFF
+            else:
+                self.modified[i] = value
+
+    def test_round_trip(self):
+        for start, end in [(0, 1), (0x10, 0x18), (0x20, 0x21),
+                           (0x400, 0x480), (0xFFF, 0x1000)]:
+            self.change(start, end)
+        patch = make_ips(self.original, self.modified)
+        self.assertEqual(apply_ips(self.original, patch), self.modified)
+
+    def test_no_changes(self):
+        patch = make_ips(self.original, self.modified)
+        self.assertEqual(patch, "PATCHEOF")
+        self.assertEqual(apply_ips(self.original, patch), self.original)
+
+    def test_regions(self):
+        self.change(0x10, 0x20)
+        self.change(0x800, 0x810)
+        patch = make_ips(self.original, self.modified, [(0x800, 0x900)])
+        self.assertEqual(get_records(patch), [(0x800, 0x10)])
+        for regions in [[(0, 0x1000)], [(0, 0x15), (0x15, 0x1000)],
+                        [(0x10, 0x20), (0x800, 0x810)]]:
+            patch = make_ips(self.original, self.modified, regions)
+            self.assertEqual(apply_ips(self.original, patch), self.modified)
+
+    def test_gaps(self):
+        # Runs closer than a record header are joined, others are not.
+        self.change(0x10, 0x12)
+        self.change(0x12 + IPS_MERGE_GAP, 0x14 + IPS_MERGE_GAP)
+        self.change(0x100, 0x102)
+        self.change(0x103 + IPS_MERGE_GAP, 0x105 + IPS_MERGE_GAP)
+        changes = [(offset, len(run)) for (offset, run)
+                   in get_changes(self.original, self.modified)]
+        self.assertEqual(changes, [(0x10, 4 + IPS_MERGE_GAP), (0x100, 2),
+                                   (0x103 + IPS_MERGE_GAP, 2)])
+
+    def test_split_regions(self):
+        # How the regions are split does not change the runs.
+        self.change(0x10, 0x14)
+        self.change(0x16, 0x18)
+        whole = list(get_changes(self.original, self.modified))
+        split = list(get_changes(self.original, self.modified,
+                                 [(0x10, 0x15), (0x15, 0x18)]))
+        self.assertEqual(whole, split)
+
+    def test_long_run(self):
+        original = bytearray(0x30000)
+        modified = bytearray(original)
+        modified[0x100:0x100 + (2 * IPS_MAX_RECORD) + 10] = (
+            "\x01" * ((2 * IPS_MAX_RECORD) + 10))
+        patch = make_ips(original, modified, [(0, 0x30000)])
+        records = get_records(patch)
+        self.assertEqual(records, [
+            (0x100, IPS_MAX_RECORD), (0x100 + IPS_MAX_RECORD, IPS_MAX_RECORD),
+            (0x100 + (2 * IPS_MAX_RECORD), 10)])
+        self.assertEqual(apply_ips(original, patch), modified)
+
+    def test_eof_offset(self):
+        # A record at 0x454F46 would read as the footer, so it starts one
+        # byte early instead.
+        original = bytearray(IPS_EOF_OFFSET + 0x100)
+        modified = bytearray(original)
+        modified[IPS_EOF_OFFSET:IPS_EOF_OFFSET+4] = "\x01\x02\x03\x04"
+        regions = [(IPS_EOF_OFFSET - 0x10, IPS_EOF_OFFSET + 0x10)]
+        patch = make_ips(original, modified, regions)
+        self.assertEqual(get_records(patch), [(IPS_EOF_OFFSET - 1, 5)])
+        self.assertEqual(apply_ips(original, patch), modified)
+
+    def test_eof_offset_long_run(self):
+        original = bytearray(IPS_EOF_OFFSET + IPS_MAX_RECORD + 0x100)
+        modified = bytearray(original)
+        modified[IPS_EOF_OFFSET:IPS_EOF_OFFSET + IPS_MAX_RECORD + 2] = (
+            "\x07" * (IPS_MAX_RECORD + 2))
+        regions = [(IPS_EOF_OFFSET - 0x10, len(original))]
+        patch = make_ips(original, modified, regions)
+        offsets = [offset for (offset, size) in get_records(patch)]
+        self.assertNotIn(IPS_EOF_OFFSET, offsets)
+        self.assertEqual(apply_ips(original, patch), modified)
+
+    def test_longer_image(self):
+        modified = self.modified + bytearray("\x05" * 0x20)
+        patch = make_ips(self.original, modified)
+        self.assertEqual(apply_ips(self.original, patch), modified)
+
+
+class TableLayoutTest(TestCase):
+    def test_unsupported(self):
+        try:
+            TableLayout([("hp", 2, None), ("name", 8, "text")],
+                        tablename="MonsterObject")
+        except ValueError, e:
+            self.assertTrue("MonsterObject" in str(e))
+            self.assertTrue("name" in str(e))
+        else:
+            self.fail("ValueError not raised")
+
+
+class MergeRegionsTest(TestCase):
+    def test_merge(self):
+        self.assertEqual(merge_regions([(10, 20), (0, 5), (5, 8), (30, 40)]),
+                         [(0, 8), (10, 20), (30, 40)])
+        self.assertEqual(merge_regions([(10, 20), (0, 5)], gap=5),
+                         [(0, 20)])
+
+
+class SNESMetaTest(TestCase):
+    # rewrite_snes_meta against randomtools' own, which works on a file.
+    def check(self, size, megabits, lorom):
+        r = Random(size)
+        block = bytearray(r.randint(0, 0xFF) for _ in xrange(0x1001))
+        original = str((block * ((size / len(block)) + 1))[:size])
+        # Changes to the image, including the old checksum, overlapping
+        # regions, and bytes past the end of the checksummed part.
+        mask = 0x7FFF if lorom else 0xFFFF
+        changes = [(0x100, 0x180), (0x140, 0x1C0),
+                   (0xFFD0 & mask, 0xFFE0 & mask), (size - 0x10, size)]
+        image = bytearray(original)
+        for start, end in changes:
+            for i in xrange(start, end):
+                image[i] = r.randint(0, 0xFF)
+        handle, filename = mkstemp(suffix=".sfc")
+        close(handle)
+        try:
+            f = open(filename, "wb")
+            f.write(image)
+            f.close()
+            utils.rewrite_snes_title("FFMQ-R 12345", filename, 8,
+                                     lorom=lorom)
+            utils.rewrite_snes_checksum(filename, megabits=megabits,
+                                        lorom=lorom)
+            f = open(filename, "rb")
+            expected = f.read()
+            f.close()
+        finally:
+            remove(filename)
+        for regions in [None, changes]:
+            before = bytearray(image)
+            after = bytearray(image)
+            written = rewrite_snes_meta(
+                after, "FFMQ-R 12345", 8, megabits=megabits, lorom=lorom,
+                original=original, regions=regions)
+            self.assertEqual(str(after), expected)
+            # Nothing changed outside the regions it returns.
+            for start, end in written:
+                before[start:end] = after[start:end]
+            self.assertEqual(before, after)
+
+    def test_lorom(self):
+        for size in [0x80000, 0x200000, 0x280000, 0x300000]:
+            self.check(size, 24, True)
+
+    def test_megabits(self):
+        for megabits in [8, 16, 32]:
+            self.check(0x280000, megabits, True)
+
+    def test_hirom(self):
+        self.check(0x200000, 24, False)
@@ -0,0 +1,43 @@
+from unittest import TestCase
+
+from randomtools.interface import get_seed
+from tests.fixture import get_randomizer, FIXTURE
+
+
+class RunSearchTest(TestCase):
+    def setUp(self):
+        get_randomizer()
+        import seedsearch
+        self.seedsearch = seedsearch
+        self.search_seeds = seedsearch.search_seeds
+        self.chunks = []
+
+        def search_seeds(seeds):
+            self.chunks.append(seeds)
+            return self.search_seeds(seeds)
+
+        seedsearch.search_seeds = search_seeds
+        self.predicate = seedsearch.Predicate(
+            "seed is a multiple of 7", lambda: get_seed() % 7 == 0)
+
+    def tearDown(self):
+        self.seedsearch.search_seeds = self.search_seeds
+
+    def search(self, limit, workers=1):
+        return self.seedsearch.run_search(
+            FIXTURE["romfile"], range(1, 201), "m", [self.predicate],
+            limit=limit, workers=workers)
+
+    def test_stops_at_limit(self):
+        size = self.seedsearch.CHUNK_SIZE
+        found, tried = self.search(3)
+        self.assertEqual(found, [7, 14, 21])
+        self.assertEqual(tried, 21)
+        self.assertEqual(self.chunks, [range(1, size + 1),
+                                       range(size + 1, (2 * size) + 1)])
+
+    def test_workers(self):
+        # The pool pickles search_seeds by name, so it must be the real one.
+        self.seedsearch.search_seeds = self.search_seeds
+        self.assertEqual(self.search(3, workers=2), ([7, 14, 21], 21))
+        self.assertEqual(self.search(5, workers=3)[0], range(7, 36, 7))
@@ -0,0 +1,92 @@
+from unittest import TestCase
+
+from tests.fixture import get_randomizer, FIXTURE
+
+
+class PlacementTest(TestCase):
+    # A seed built by hand, with every item placed on purpose.
+    def setUp(self):
+        r = self.randomizer = get_randomizer()
+        import seedstats
+        self.seedstats = seedstats
+        r.restore_objects(r.LOADED_ROM["snapshot"])
+        self.hidden, self.chest, self.reward = r.DESIRABLE_ITEMS[1:4]
+        # Hidden items are in chests that held consumables in the rom.
+        chests = {}
+        for t in r.TreasureIndexObject.every:
+            t.contents = 0x10
+            chests[t.old_data["contents"] in r.CONSUMABLES] = t
+        chests[True].contents = self.hidden
+        chests[False].contents = self.chest
+        for br in r.BattleRewardObject.every:
+            br.reward = 0x8001
+        r.BattleRewardObject.get(0).reward = 0x4000 | self.reward
+        r.BattleRewardObject.get(1).reward = 0x4000 | self.chest
+        boss = r.FormationObject.get(0)
+        boss.special_boss = True
+        r.BattleFormationObject.get(1).formation_ids = [boss.index] * 3
+        for bf in r.BattleFormationObject.every[:20]:
+            if bf.index != 1 and boss.index in bf.formation_ids:
+                bf.formation_ids = [1] * 3
+
+    def tearDown(self):
+        r = self.randomizer
+        r.restore_objects(r.LOADED_ROM["snapshot"])
+
+    def test_placements(self):
+        self.assertEqual(self.seedstats.get_placements(),
+                         {self.hidden: set(["hidden"]),
+                          self.chest: set(["chest", "boss"]),
+                          self.reward: set(["reward"])})
+
+    def test_add_seed(self):
+        r = self.randomizer
+        stats = self.seedstats.SeedStats()
+        stats.add_seed()
+        stats.add_seed()
+        self.assertEqual(stats.seeds, 2)
+        self.assertEqual(stats.places[self.hidden], {"hidden": 2})
+        self.assertEqual(stats.places[self.chest], {"chest": 2, "boss": 2})
+        self.assertEqual(stats.places[self.reward], {"reward": 2})
+        self.assertEqual(stats.places[r.DESIRABLE_ITEMS[0]], {"none": 2})
+        self.assertEqual(stats.num_special, {1: 2})
+        self.assertEqual(len(stats.character_stats["max_hp"]),
+                         2 * len(r.CharacterObject.every))
+        summary = stats.get_summary()
+        self.assertEqual(summary["items"][r.get_item_names()[self.chest]],
+                         {"chest": 2, "boss": 2, "hidden": 0, "reward": 0,
+                          "none": 0})
+
+
+class SeedStatsTest(TestCase):
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        import seedstats
+        self.seedstats = seedstats
+
+    def test_percentiles(self):
+        get_percentiles = self.seedstats.get_percentiles
+        self.assertEqual(get_percentiles(range(100, -1, -1)),
+                         map(float, self.seedstats.PERCENTILES))
+        self.assertEqual(get_percentiles([7], [0, 50, 100]), [7.0] * 3)
+        self.assertEqual(get_percentiles([], [0, 50]), [None, None])
+
+    def test_same_seeds(self):
+        # The same seeds give the same summary, however they are split
+        # between workers and chunks.
+        s = self.seedstats
+        seeds = range(1, 7)
+        summary = s.run_stats(FIXTURE["romfile"], seeds, "cfmt").get_summary()
+        self.assertEqual(summary["seeds"], 6)
+        self.assertEqual(sum(summary["num_special"].values()), 6)
+        self.assertEqual(
+            s.run_stats(FIXTURE["romfile"], seeds, "cfmt").get_summary(),
+            summary)
+        self.assertEqual(
+            s.run_stats(FIXTURE["romfile"], seeds, "cfmt",
+                        workers=2).get_summary(), summary)
+        merged = s.gather_seeds(seeds[3:])
+        merged.merge(s.gather_seeds(seeds[:3]))
+        self.assertEqual(merged.get_summary(), summary)
+        self.assertTrue(s.format_summary(summary, "cfmt").startswith(
+            "6 seeds, flags cfmt"))
@@ -0,0 +1,227 @@
+from json import loads
+from multiprocessing import TimeoutError
+from threading import Thread
+from time import sleep, time
+from unittest import TestCase
+from urllib2 import urlopen, HTTPError
+
+from tests.fixture import get_randomizer
+
+
+class FakeJob(object):
+    # A pool job that finishes when the test says so.
+    def __init__(self, callback):
+        self.callback = callback
+        self.done = False
+
+    def finish(self, result):
+        self.done = True
+        self.callback(result)
+
+
+class FakePool(object):
+    def __init__(self):
+        self.jobs = []
+
+    def apply_async(self, function, args, callback=None):
+        self.jobs.append(FakeJob(callback))
+        return self.jobs[-1]
+
+    def close(self):
+        pass
+
+    def join(self):
+        pass
+
+
+def wait_for(condition):
+    for _ in xrange(500):
+        if condition():
+            return
+        sleep(0.01)
+    raise AssertionError("Timed out waiting.")
+
+
+class ServiceTest(TestCase):
+    def setUp(self):
+        r = self.randomizer = get_randomizer()
+        import service
+        self.module = service
+        self.timeout = service.JOB_TIMEOUT
+        self.service = service.SeedService(
+            r.LOADED_ROM["source"], workers=1, max_pending=2,
+            state_cache_bytes=0)
+        self.service.pool.terminate()
+        self.pool = self.service.pool = FakePool()
+        self.results = []
+        self.threads = []
+
+    def tearDown(self):
+        self.module.JOB_TIMEOUT = self.timeout
+        for job in self.pool.jobs:
+            if not job.done:
+                job.finish((False, "Stopped."))
+        for t in self.threads:
+            t.join()
+
+    def request(self, seed, flags="cm"):
+        def run():
+            try:
+                self.results.append(self.service.get_patch(seed, flags))
+            except Exception, e:
+                self.results.append(e)
+        t = Thread(target=run)
+        t.start()
+        self.threads.append(t)
+
+    def test_same_flags_same_key(self):
+        get_key = self.service.get_key
+        key = get_key(5, "cfmt", True)
+        for flags in ["", "CFMT", "tmfc", "ccffmmtt"]:
+            self.assertEqual(get_key(5, flags, True), key)
+        self.assertEqual(key[2], "cfmt")
+        self.assertEqual(get_key(5, "mC", False)[2], "cm")
+        self.assertNotEqual(get_key(5, "cm", True), key)
+        self.assertRaises(ValueError, get_key, 5, "cfmtx", True)
+
+    def test_shared_job(self):
+        for _ in xrange(3):
+            self.request(5)
+        wait_for(lambda: self.service.shared == 2)
+        self.assertEqual(len(self.pool.jobs), 1)
+        self.pool.jobs[0].finish((True, "PATCH1EOF"))
+        for t in self.threads:
+            t.join()
+        self.assertEqual(self.results, ["PATCH1EOF"] * 3)
+        self.assertEqual(self.service.get_patch(5, "mc"), "PATCH1EOF")
+        stats = self.service.get_stats()
+        self.assertEqual((stats["requests"], stats["shared"],
+                          stats["queue_depth"], stats["cache_entries"]),
+                         (4, 2, 0, 1))
+        self.assertEqual(stats["cache_hit_rate"], 0.25)
+
+    def test_timeout(self):
+        # Requests that time out leave the job running, and the next one
+        # waits for it instead of starting another.
+        self.module.JOB_TIMEOUT = 0.05
+        self.assertRaises(TimeoutError, self.service.get_patch, 5, "cm")
+        self.assertRaises(TimeoutError, self.service.get_patch, 5, "cm")
+        self.assertEqual(len(self.pool.jobs), 1)
+        self.assertEqual(len(self.service.latencies), 2)
+        self.pool.jobs[0].finish((True, "PATCH2EOF"))
+        self.assertEqual(self.service.get_stats()["queue_depth"], 0)
+        self.assertEqual(self.service.get_patch(5, "cm"), "PATCH2EOF")
+        self.assertEqual(len(self.pool.jobs), 1)
+
+    def test_failed_job(self):
+        self.request(5)
+        wait_for(lambda: self.pool.jobs)
+        self.pool.jobs[0].finish((False, "ValueError: broken"))
+        self.threads[0].join()
+        self.assertEqual(str(self.results[0]), "ValueError: broken")
+        self.request(5)
+        wait_for(lambda: len(self.pool.jobs) == 2)
+
+    def test_busy(self):
+        self.request(5)
+        self.request(6)
+        wait_for(lambda: len(self.pool.jobs) == 2)
+        self.assertRaises(self.module.ServiceBusy,
+                          self.service.get_patch, 7, "cm")
+        # Seeds that are already being made are still shared.
+        self.request(5)
+        wait_for(lambda: self.service.shared == 1)
+        self.assertEqual(self.service.get_stats()["rejected"], 1)
+
+
+class PatchCacheTest(TestCase):
+    def test_lru(self):
+        from service import PatchCache
+        cache = PatchCache(max_bytes=10)
+        cache.add("a", "1234")
+        cache.add("b", "1234")
+        self.assertEqual(cache.get("a"), "1234")
+        cache.add("c", "1234")
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual((cache.get("a"), cache.get("c")), ("1234", "1234"))
+        self.assertEqual((len(cache), cache.size), (2, 8))
+        cache.add("d", "12345678901")
+        self.assertEqual(cache.get("d"), None)
+        self.assertEqual(len(cache), 2)
+
+
+class ServerTest(TestCase):
+    def setUp(self):
+        r = self.randomizer = get_randomizer()
+        from service import SeedService, SeedServer, SeedRequestHandler
+        self.service = SeedService(r.LOADED_ROM["source"], workers=1,
+                                   max_pending=1, state_cache_bytes=0)
+        self.server = SeedServer(("127.0.0.1", 0), SeedRequestHandler)
+        self.server.service = self.service
+        self.server.verbose = False
+        self.thread = Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        self.server.server_close()
+        self.service.close()
+
+    def get(self, path):
+        url = "http://127.0.0.1:%s%s" % (self.server.server_port, path)
+        try:
+            f = urlopen(url)
+        except HTTPError, e:
+            return e.code, e.read(), e.info()
+        return f.getcode(), f.read(), f.info()
+
+    def test_seed(self):
+        code, data, _ = self.get("/seed?seed=3&flags=mc&jump=1")
+        self.assertEqual(code, 200)
+        self.assertEqual(data, self.randomizer.make_patch(3, "cm",
+                                                          enemy_jump=True))
+        stats = loads(self.get("/stats")[1])
+        self.assertEqual(stats["requests"], 1)
+
+    def test_shared_seed(self):
+        # Everything waiting on a seed is woken when it is done, not only
+        # the first request.
+        import service
+        timeout, service.JOB_TIMEOUT = service.JOB_TIMEOUT, 10
+        try:
+            threads = [Thread(target=self.service.get_patch, args=(3, "t"))
+                       for _ in xrange(3)]
+            start = time()
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            service.JOB_TIMEOUT = timeout
+        self.assertTrue(time() - start < 5)
+        self.assertEqual(self.service.get_stats()["queue_depth"], 0)
+        self.assertEqual(self.service.get_patch(3, "t"),
+                         self.randomizer.make_patch(3, "t"))
+
+    def test_bad_requests(self):
+        for path, message in [("/seed?flags=cm", "no seed"),
+                              ("/seed?seed=x", "invalid literal"),
+                              ("/seed?seed=3&flags=cfmtx", "Unknown flags"),
+                              ("/seed?seed=3&format=zip", "Unknown format")]:
+            code, data, _ = self.get(path)
+            self.assertEqual(code, 400)
+            self.assertTrue(message in data, data)
+
+    def test_busy(self):
+        self.service.pool.terminate()
+        pool = self.service.pool = FakePool()
+        thread = Thread(target=self.get, args=("/seed?seed=5",))
+        thread.start()
+        wait_for(lambda: pool.jobs)
+        code, data, info = self.get("/seed?seed=6")
+        self.assertEqual(code, 503)
+        self.assertEqual(info["Retry-After"], "1")
+        pool.jobs[0].finish((True, "PATCH3EOF"))
+        thread.join()
+        self.assertEqual(self.get("/seed?seed=5")[:2], (200, "PATCH3EOF"))
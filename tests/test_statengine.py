@@ -0,0 +1,135 @@
+from unittest import TestCase, skipIf
+
+from randomtools import utils
+from randomtools.utils import utilrandom as random
+from bitfields import popcount
+from columns import get_numpy
+from tests.fixture import get_randomizer
+
+
+SEEDS = range(1, 21)
+
+
+class Row(object):
+    def __init__(self, **values):
+        self.__dict__.update(values)
+
+
+def get_mean(values):
+    return sum(values) / float(len(values))
+
+
+def get_deviation(values):
+    mean = get_mean(values)
+    return get_mean([(v - mean) ** 2 for v in values]) ** 0.5
+
+
+@skipIf(get_numpy() is None, "needs NumPy")
+class DrawTest(TestCase):
+    # Each draw against what the pure Python path does for one object.
+    def setUp(self):
+        import statengine
+        self.statengine = statengine
+        self.generator = statengine.get_generator(1)
+
+    def test_stats_like_mutate_normal(self):
+        bounds = {"hp": (40, 32000), "speed": (1, 99)}
+        for value in [1, 50, 99, 16000, 32000]:
+            objs = [Row(hp=max(value, 40), speed=min(value, 99))
+                    for _ in xrange(2000)]
+            drawn = self.statengine.draw_stats(objs, bounds, self.generator)
+            random.seed(value)
+            for attr, (low, high) in bounds.items():
+                values = [drawn[o][attr] for o in objs]
+                expected = [utils.mutate_normal(getattr(o, attr), low, high)
+                            for o in objs]
+                self.assertTrue(all([low <= v <= high for v in values]))
+                width = max(1, (high - low) // 8)
+                self.assertTrue(abs(get_mean(values) - get_mean(expected))
+                                < width / 4.0, (attr, value))
+                self.assertTrue(abs(get_deviation(values)
+                                    - get_deviation(expected))
+                                < width / 4.0, (attr, value))
+
+    def test_out_of_range_kept(self):
+        objs = [Row(hp=0), Row(hp=40000), Row(hp=100)]
+        drawn = self.statengine.draw_stats(objs, {"hp": (40, 32000)},
+                                           self.generator)
+        self.assertEqual([drawn[o]["hp"] for o in objs[:2]], [0, 40000])
+
+    def test_bits_like_shuffle_bits(self):
+        fields = [("status", 8, 0), ("element", 5, 3), ("element", 4, 4)]
+        objs = [Row(status=v, element=v) for v in xrange(0x100)] * 4
+        drawn = self.statengine.draw_bits(objs, fields, self.generator)
+        for o in objs:
+            for attr, size, shift in fields:
+                value = drawn[o][attr, size, shift]
+                expected = utils.shuffle_bits(getattr(o, attr) >> shift,
+                                              size=size)
+                self.assertEqual(popcount(value), popcount(expected << shift))
+                self.assertFalse(value & ~(((1 << size) - 1) << shift))
+
+    def test_shuffle_columns(self):
+        # Like intershuffle, attributes in a group move together.
+        objs = [Row(a=i, b=-i, c=i) for i in xrange(50)]
+        self.statengine.shuffle_columns(objs, ["c", ("a", "b")],
+                                        self.generator)
+        self.assertEqual(sorted([o.a for o in objs]), range(50))
+        self.assertEqual(sorted([o.c for o in objs]), range(50))
+        self.assertTrue(all([o.b == -o.a for o in objs]))
+        self.assertNotEqual([o.a for o in objs], range(50))
+        self.assertNotEqual([o.a for o in objs], [o.c for o in objs])
+
+
+@skipIf(get_numpy() is None, "needs NumPy")
+class StatEngineTest(TestCase):
+    # Seeds made with the engine are not the seeds made without it, but
+    # over many seeds their stats are spread the same way.
+    def setUp(self):
+        self.randomizer = get_randomizer()
+        self.tables = [o for o in self.randomizer.ALL_OBJECTS
+                       if issubclass(o, self.randomizer.StatMutationMixin)]
+
+    def tearDown(self):
+        self.randomizer.STAT_ENGINE.clear()
+
+    def get_stats(self, flags):
+        r = self.randomizer
+        stats = {}
+        for seed in SEEDS:
+            r.restore_objects(r.LOADED_ROM["snapshot"])
+            r.randomize_objects(r.ALL_OBJECTS, seed, flags)
+            for o in self.tables:
+                for attr in o.mutate_attributes:
+                    stats.setdefault((o, attr), []).extend(
+                        [getattr(obj, attr) for obj in o.every])
+        return stats
+
+    def test_same_seed(self):
+        r = self.randomizer
+        r.use_stat_engine()
+        patch = r.make_patch(SEEDS[0], "cfmt")
+        self.assertEqual(r.make_patch(SEEDS[0], "cfmt"), patch)
+        r.STAT_ENGINE.clear()
+        self.assertNotEqual(r.make_patch(SEEDS[0], "cfmt"), patch)
+
+    def test_other_tables(self):
+        # Flags without stat tables make the same seeds either way.
+        r = self.randomizer
+        patch = r.make_patch(SEEDS[0], "f")
+        r.use_stat_engine()
+        self.assertEqual(r.make_patch(SEEDS[0], "f"), patch)
+
+    def test_same_stats(self):
+        r = self.randomizer
+        expected = self.get_stats("cmt")
+        r.use_stat_engine()
+        stats = self.get_stats("cmt")
+        for (o, attr), values in sorted(stats.items()):
+            low, high = r.get_bounds(o)[attr]
+            self.assertTrue(all([low <= v <= high for v in values]))
+            self.assertTrue(all([low <= v <= high
+                                 for v in expected[o, attr]]))
+            self.assertTrue(
+                abs(get_mean(values) - get_mean(expected[o, attr]))
+                < (high - low) / 32.0, (o.__name__, attr))
@@ -0,0 +1,48 @@
+from os.path import join
+from unittest import TestCase
+
+from textcodec import TextCodec
+from tests.fixture import ROOT
+
+
+class TextCodecTest(TestCase):
+    def setUp(self):
+        self.codec = TextCodec(join(ROOT, "tables", "mq.tbl"))
+
+    def test_longest_match(self):
+        encode = self.codec.encode
+        wait = [0xB0, 0xB4, 0xBC, 0xC7]
+        self.assertEqual(encode("Wait..."), wait + [0xD8])
+        self.assertEqual(encode("Wait.."), wait + [0xD2, 0xD2])
+        self.assertEqual(encode('Wait."'), wait + [0xD5])
+        self.assertEqual(encode('Wait...."'), wait + [0xD8, 0xD5])
+        self.assertEqual(encode("Wait? a"), wait + [0xCF, 0xB4])
+        self.assertEqual(encode("Wait a"), wait + [0x03, 0xB4])
+
+    def test_round_trip(self):
+        for text in ["Wait...", 'Wait."', "Wait? a", 'a...."? ...',
+                     "...", '."', "? "]:
+            data = self.codec.encode(text)
+            self.assertEqual(self.codec.decode(data), text)
+            self.assertEqual(self.codec.decode(bytearray(data)), text)
+            self.assertEqual(self.codec.decode(str(bytearray(data))), text)
+
+    def test_unknown(self):
+        self.assertEqual(self.codec.decode([0x00, 0x9A, 0xD6, 0xFF]), "~A~~")
+        self.assertEqual(TextCodec(self.codec.filename,
+                                   unknown="#").decode([0x00]), "#")
+        # "?" is only in the table followed by a space.
+        self.assertRaises(ValueError, self.codec.encode, "Wait?")
+        self.assertRaises(ValueError, self.codec.encode, "Wait~")
+
+    def test_shared_text(self):
+        # Two bytes decode to '"', and the one listed last encodes it.
+        self.assertEqual(self.codec.decode([0xD3, 0xD4]), '""')
+        self.assertEqual(self.codec.encode('"'), [0xD4])
+
+    def test_length(self):
+        encode_bytes = self.codec.encode_bytes
+        self.assertEqual(self.codec.encode("A...", length=4),
+                         [0x9A, 0xD8, 0x03, 0x03])
+        self.assertEqual(encode_bytes("A...", length=1), "\x9a")
+        self.assertEqual(encode_bytes("A", length=2, pad=0xFE), "\x9a\xfe")
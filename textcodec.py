@@ -0,0 +1,72 @@
+from codecs import CodecInfo, register
+
+
+UNKNOWN = "~"
+PAD = 0x03
+
+
+class TextCodec(object):
+    # Converts between game text and strings using a .tbl file. Decoding
+    # is one lookup per byte in a 256 entry table. Some bytes stand for
+    # several characters (e.g. "..."), so encoding takes the longest match.
+    # When several bytes share the same text, the last one listed wins.
+    # The file is read the first time the codec is used.
+    def __init__(self, filename, unknown=UNKNOWN):
+        self.filename = filename
+        self.unknown = unknown
+        self.decode_table = None
+        self.encode_map = None
+
+    def load(self):
+        self.decode_table = [self.unknown] * 0x100
+        self.encode_map = {}
+        for line in open(self.filename):
+            line = line.rstrip("\r\n")
+            if not line:
+                continue
+            value, text = line.split("=", 1)
+            value = int(value, 0x10)
+            self.decode_table[value] = text
+            self.encode_map[text] = value
+        self.max_length = max([len(text) for text in self.encode_map])
+
+    def decode(self, data):
+        # Accepts a list of ints, a bytearray or a byte string.
+        if self.decode_table is None:
+            self.load()
+        if isinstance(data, str):
+            data = bytearray(data)
+        table = self.decode_table
+        return "".join([table[d] for d in data])
+
+    def encode(self, text, length=None, pad=PAD):
+        # Returns a list of ints, padded or truncated to length if given.
+        if self.encode_map is None:
+            self.load()
+        encode_map = self.encode_map
+        data = []
+        i = 0
+        while i < len(text):
+            for size in xrange(min(self.max_length, len(text) - i), 0, -1):
+                if text[i:i+size] in encode_map:
+                    data.append(encode_map[text[i:i+size]])
+                    i += size
+                    break
+            else:
+                raise ValueError("Cannot encode %r." % text[i])
+        if length is not None:
+            data = (data + ([pad] * length))[:length]
+        return data
+
+    def encode_bytes(self, text, length=None, pad=PAD):
+        return str(bytearray(self.encode(text, length=length, pad=pad)))
+
+    def register(self, name):
+        # Makes the table available as e.g. "ABC".encode("ffmq").
+        info = CodecInfo(
+            name=name,
+            encode=lambda text, errors="strict": (
+                self.encode_bytes(text), len(text)),
+            decode=lambda data, errors="strict": (
+                self.decode(data), len(data)))
+        register(lambda n: info if n == name else None)